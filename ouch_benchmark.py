@@ -0,0 +1,75 @@
+import argparse
+import sys
+
+from tabulate import tabulate
+
+from src.benchmark import Benchmark, OrderMix
+from src.histogram import LatencyHistogram
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the throughput and latency of the OUCH exchange server.")
+    parser.add_argument("--sessions", type=int, default=10,
+        help="Number of concurrent client sessions.")
+    parser.add_argument("--rate", type=float, default=1000,
+        help="Total orders sent per second across every session.")
+    parser.add_argument("--duration", type=float, default=10,
+        help="Seconds to send orders for.")
+    parser.add_argument("--mix", default="60:25:15", metavar="ENTER:REPLACE:CANCEL",
+        help="Relative weights of enter, replace and cancel orders.")
+    parser.add_argument("--price-distribution", default="uniform", choices=OrderMix.PRICE_DISTRIBUTIONS,
+        help="Distribution of order prices around the mid price.")
+    parser.add_argument("--price-spread", type=int, default=20,
+        help="Spread (uniform) or standard deviation (normal) of order prices in ticks of 0.1.")
+    parser.add_argument("--max-quantity", type=int, default=100,
+        help="Order quantities are drawn uniformly from 1 to this quantity.")
+    parser.add_argument("--skew", type=float, default=0.0,
+        help="Concentration of orders on the lowest orderbook IDs. 0 spreads orders evenly.")
+    parser.add_argument("--seed", type=int, default=0,
+        help="Seed of the random order generators.")
+    parser.add_argument("--server", default=None, metavar="ARGS",
+        help="Start ouch_server.py with these arguments for the benchmark, e.g. \"none asyncio --batch-size 64\". "
+            "By default, a server which is already running is used. The session receiver is not supported.")
+    parser.add_argument("--output", default=None, metavar="PATH",
+        help="Save the results as JSON.")
+    parser.add_argument("--baseline", default=None, metavar="PATH",
+        help="Compare the results with the saved results of a previous run, and exit with status 1 if they regressed.")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+        help="Relative change allowed before a metric counts as a regression.")
+    args = parser.parse_args()
+
+    weights = [float(weight) for weight in args.mix.split(":")]
+    if len(weights) != 3:
+        parser.error("--mix must have three weights.")
+    mix = OrderMix(*weights, price_distribution=args.price_distribution, price_spread=args.price_spread,
+        max_quantity=args.max_quantity, skew=args.skew)
+    try:
+        benchmark = Benchmark(args.sessions, args.rate, args.duration, mix, seed=args.seed,
+            server_args=args.server.split() if args.server is not None else None)
+    except ValueError as e:
+        parser.error(str(e))
+    results = benchmark.run()
+
+    print(f"Sent {results['throughput']['sent']:.0f} orders/s, "
+        f"answered {results['throughput']['answered']:.0f} orders/s, "
+        f"{results['unanswered']} unanswered.")
+    percentiles = [f"p{percentile}" for percentile in LatencyHistogram.PERCENTILES]
+    rows = [
+        [name, latency["count"]] + [latency[key] / 1000 for key in ["min", "mean"] + percentiles + ["max"]]
+        for name, latency in results["latency_ns"].items()
+    ]
+    print(tabulate(rows, headers=["Type", "Count", "Min", "Mean"] + percentiles + ["Max"], floatfmt=".1f"))
+    print("Latencies in microseconds.")
+
+    if args.output is not None:
+        Benchmark.save(results, args.output)
+
+    if args.baseline is not None:
+        comparison = Benchmark.compare(results, Benchmark.load(args.baseline), args.tolerance)
+        print(tabulate(
+            [[metric, old, new, f"{change:+.1%}", "REGRESSED" if regressed else ""]
+                for metric, old, new, change, regressed in comparison],
+            headers=["Metric", "Baseline", "Result", "Change", ""], floatfmt=".0f"
+        ))
+        print("Throughput in orders per second, latencies in nanoseconds.")
+        if any(regressed for *_, regressed in comparison):
+            sys.exit(1)
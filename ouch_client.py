@@ -1,10 +1,54 @@
-import sys
+import argparse
+import json
 
-from src.client import Client
+from src.client import Client, ScriptedClient
+from src.histogram import LatencyHistogram
 
 if __name__ == "__main__":
-    if len(sys.argv) == 2:
-        orderlist_path = sys.argv[1]
+    parser = argparse.ArgumentParser(description="Connect to the OUCH exchange server as a client.")
+    parser.add_argument("path", nargs="?", default=None,
+        help="JSON file of actions to send (see test_inputs).")
+    parser.add_argument("--headless", action="store_true",
+        help="Send every action without waiting for the enter key, and report the latency of each.")
+    parser.add_argument("--rate", type=float, default=None,
+        help="Actions sent per second in headless mode. By default, actions are sent as fast as possible.")
+    parser.add_argument("--verbose", action="store_true",
+        help="Print every response from the exchange in headless mode.")
+    parser.add_argument("--timeout", type=float, default=5.0,
+        help="Seconds to wait for further responses in headless mode.")
+    parser.add_argument("--output", default=None, metavar="PATH",
+        help="Save the response type and latency of every action as JSON in headless mode.")
+    parser.add_argument("--username", default=None,
+        help="Log in to a sequenced session with this username, for a server using the session receiver.")
+    parser.add_argument("--sequence", type=int, default=0,
+        help="Sequence number of the first reply to receive in the session, e.g. 1 to receive every reply "
+            "sent to the username. By default, only new replies are received.")
+    parser.add_argument("--shm", action="store_true",
+        help="Connect through the shared memory gateway of a server on the same machine started with --shm-gateway.")
+    args = parser.parse_args()
+    if args.shm and args.username is not None:
+        parser.error("sessions are not available over shared memory.")
+
+    if not args.headless:
+        Client(path=args.path, username=args.username, sequence=args.sequence, shm=args.shm)
     else:
-        orderlist_path = None
-    Client(path=orderlist_path)
\ No newline at end of file
+        if args.path is None:
+            parser.error("headless mode requires a JSON file of actions.")
+        client = ScriptedClient(Client.load_actions(args.path), rate=args.rate, verbose=args.verbose,
+            username=args.username, sequence=args.sequence, shm=args.shm)
+        requests = client.run(args.timeout)
+
+        histograms = {}
+        for request in requests:
+            if request["latency_ns"] is not None:
+                histograms.setdefault(request["message_type"], LatencyHistogram()).record(request["latency_ns"])
+        answered = sum(histogram.count for histogram in histograms.values())
+        print(f"Sent {len(requests)} actions, {answered} answered.")
+        for msg_type, histogram in sorted(histograms.items()):
+            latency = histogram.to_dict()
+            print(f"{msg_type}: {latency['count']} answered, latency p50 {latency['p50']/1000:.1f}us, "
+                f"p99 {latency['p99']/1000:.1f}us, max {latency['max']/1000:.1f}us")
+
+        if args.output is not None:
+            with open(args.output, "w") as f:
+                json.dump(requests, f, indent=4)
@@ -0,0 +1,51 @@
+import argparse
+import sys
+
+from tabulate import tabulate
+
+from src.benchmark import Benchmark
+from src.microbenchmark import BookFixture, Microbenchmark
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the hot paths of the OUCH exchange in isolation.")
+    parser.add_argument("cases", nargs="*", metavar="CASE",
+        help=f"Cases to run, out of {', '.join(Microbenchmark.CASES)}. By default, every case is run.")
+    parser.add_argument("--sizes", default="1000,100000,1000000",
+        help="Comma separated numbers of resting orders in the orderbook fixtures.")
+    parser.add_argument("--layouts", default=",".join(BookFixture.LAYOUTS),
+        help="Comma separated layouts of the orderbook fixtures: spread, deep and/or sparse.")
+    parser.add_argument("--number", type=int, default=1000,
+        help="Operations timed per round.")
+    parser.add_argument("--repeat", type=int, default=5,
+        help="Rounds of each case.")
+    parser.add_argument("--output", default=None, metavar="PATH",
+        help="Save the results as JSON.")
+    parser.add_argument("--baseline", default=None, metavar="PATH",
+        help="Compare the results with the saved results of a previous run, and exit with status 1 if they regressed.")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+        help="Relative change in median time allowed before a case counts as a regression.")
+    args = parser.parse_args()
+
+    microbenchmark = Microbenchmark(
+        sizes=tuple(int(size) for size in args.sizes.split(",")),
+        layouts=tuple(args.layouts.split(",")),
+        number=args.number,
+        repeat=args.repeat,
+        cases=args.cases or None
+    )
+    results = microbenchmark.run(progress=lambda name, result:
+        print(f"{name:<45} {result['median_ns']:>12.0f} ns/op  (min {result['min_ns']:.0f}, max {result['max_ns']:.0f})"))
+
+    if args.output is not None:
+        Benchmark.save(results, args.output)
+
+    if args.baseline is not None:
+        comparison = Microbenchmark.compare(results, Benchmark.load(args.baseline), args.tolerance)
+        print(tabulate(
+            [[name, old, new, f"{change:+.1%}", "REGRESSED" if regressed else ""]
+                for name, old, new, change, regressed in comparison],
+            headers=["Case", "Baseline", "Result", "Change", ""], floatfmt=".0f"
+        ))
+        print("Median nanoseconds per operation.")
+        if any(regressed for *_, regressed in comparison):
+            sys.exit(1)
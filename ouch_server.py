@@ -1,20 +1,40 @@
-import sys
+import argparse
 
 from src.Exchange import Exchange
+from src.receiver import Receiver
 
 if __name__ == "__main__":
-    exchange = None
-    if len(sys.argv) == 2:
-        if sys.argv[1] == "debug":
-            # Exchange outputs using debug mode.
-            exchange = Exchange(debug="dump")
-        elif sys.argv[1] == "none":
-            # Exchange won't output anything.
-            exchange = Exchange(debug="none")
-        else:
-            raise Exception("Command line argument should be either 'dump' or 'none'")
-    else:
-        exchange = Exchange()
+    parser = argparse.ArgumentParser(description="Start the OUCH exchange server.")
+    parser.add_argument("mode", nargs="?", default="default", choices=("default", "debug", "none"),
+        help="Output mode: print the orderbook every second, debugging output, or no output.")
+    parser.add_argument("receiver", nargs="?", default="thread", choices=tuple(Exchange.RECEIVERS),
+        help="Receive client connections with one thread per client, one asyncio event loop, "
+            "or one thread per client with sequenced sessions.")
+    parser.add_argument("--batch-size", type=int, default=1,
+        help="Maximum number of queued messages processed together under one orderbook lock.")
+    parser.add_argument("--shards", type=int, default=0,
+        help="Number of matching processes, split by orderbook ID. Requires the none output mode.")
+    parser.add_argument("--journal", metavar="DIRECTORY", default=None,
+        help="Record every message in a journal in this directory, and recover the orderbook from it on startup.")
+    parser.add_argument("--snapshot", metavar="PATH", default=None,
+        help="Load the orderbook from a CSV or binary snapshot on startup.")
+    parser.add_argument("--market-data", action="store_true",
+        help="Publish a UDP multicast market data feed of the orderbook.")
+    parser.add_argument("--instrument", action="store_true",
+        help="Measure the time messages spend in each stage of the exchange, dumped on SIGUSR2.")
+    parser.add_argument("--send-buffer", type=int, default=Receiver.SEND_BUFFER, metavar="BYTES",
+        help="Bytes of replies each client may leave unread before the slow consumer policy is applied.")
+    parser.add_argument("--slow-consumer", default="disconnect", choices=Receiver.SLOW_CONSUMER_POLICIES,
+        help="Disconnect a client which does not read its replies, or drop the replies which do not fit.")
+    parser.add_argument("--shm-gateway", action="store_true",
+        help="Also accept clients on the same machine over shared memory rings, at the path in config.ini.")
+    args = parser.parse_args()
+
+    exchange = Exchange(debug=args.mode, receiver=args.receiver, batch_size=args.batch_size,
+        shards=args.shards, journal=args.journal,
+        snapshot=args.snapshot, market_data=args.market_data,
+        instrument=args.instrument, send_buffer=args.send_buffer,
+        slow_consumer=args.slow_consumer, shm_gateway=args.shm_gateway)
     exchange.open_exchange()
     input() # Pressing the enter key will cause the server process to terminate.
     exchange.close_exchange()
\ No newline at end of file
@@ -5,47 +5,169 @@ Exchange Integration
 Integration of all required classes together into a working implementation. Will be changed
 as new components are added. This is mostly for knowing what we have to implement in future modules.
 """
+import json
+import signal
 import threading
 import time
 
 from src.OrderBook import OrderBook
+from src.processor import MessageProcessor
 from src.receiver import Receiver
+from src.async_receiver import AsyncReceiver
+from src.session import SessionReceiver
+from src.shm_gateway import ShmGateway
+from src.sharding import ShardRouter
+from src.journal import Journal
+from src.snapshot import Snapshot
+from src.market_data import MarketDataPublisher
+from src.instrumentation import StageStats
 from src.util import Util
-from src.console import Console
+from src.console import Console, DepthRenderer
 
 
-class Exchange():
-    PRICE_MAX = 214748364.6
-    QUANTITY_MAX = 2147483647 
+class Exchange(MessageProcessor):
+    # File which the orderbook is dumped into when a dump signal is caught, formatted with the
+    # server time in nanoseconds since midnight.
+    DUMP_PATH = "orderbook_{}.csv"
 
-    def __init__(self, debug="default"):
+    # File which the stage statistics are dumped into when a stats signal is caught, formatted
+    # in the same way.
+    STATS_PATH = "stats_{}.json"
+
+    # Most consecutive messages of one type applied together when replaying the journal.
+    REPLAY_BATCH_SIZE = 4096
+
+    # Connection receivers which can be selected on startup.
+    RECEIVERS = {
+        "thread": Receiver, # One thread per client connection.
+        "asyncio": AsyncReceiver, # All client connections on one asyncio event loop.
+        "session": SessionReceiver # Sequenced sessions with login, heartbeats and replay.
+    }
+
+    def __init__(self, debug="default", receiver="thread", batch_size=1, shards=0, journal=None, snapshot=None, market_data=False, instrument=False, send_buffer=Receiver.SEND_BUFFER, slow_consumer="disconnect", shm_gateway=False):
         """
         An instance of this class should be initialised before trying to establish a connection using client.py.
         All program components are integrated together with this class, connecting the 
         receiver, orderbook, and output components. When this program is called, it will output 
         the Orderbook to the console once every second.
+
+        :param debug: Output mode, one of "default", "debug" or "none".
+        :param receiver: Connection receiver, one of the keys of RECEIVERS.
+        :param batch_size: Maximum number of queued messages processed together under one lock
+            acquisition. 1 processes messages one at a time.
+        :param shards: Number of matching processes, which each hold the orderbooks of a subset
+            of the orderbook IDs. 0 matches every order in this process. The orderbooks are not
+            available to this process when sharded, so debug must be "none".
+        :param journal: Directory of the journal which every message to and from clients is
+            recorded in, or None for no journal. If the journal already holds messages, the
+            orderbook is rebuilt from them before any client can connect. Replies are sent
+            before their records are flushed to disk (see Journal).
+        :param snapshot: Path of an orderbook snapshot (see Snapshot) to load on startup, or
+            None to start with an empty orderbook.
+        :param market_data: Whether to publish every change to the orderbook on the UDP
+            multicast market data feed (see MarketDataPublisher).
+        :param instrument: Whether to measure the time each message spends in each stage of
+            the exchange (see StageStats). The statistics are returned by get_stats, and dumped
+            into STATS_PATH when SIGUSR2 is caught.
+        :param send_buffer: Bytes of replies each client may leave unread before the
+            slow_consumer policy is applied to it.
+        :param slow_consumer: Whether a client which does not read its replies is
+            disconnected, or its replies are dropped, one of Receiver.SLOW_CONSUMER_POLICIES.
+            Sequenced sessions can only be disconnected.
+        :param shm_gateway: Whether to also accept clients on the same machine over shared
+            memory rings (see ShmGateway), alongside the receiver's clients.
         """
         # Exchange state variables
         self.open = True
 
-        # Connection receiver
-        self.connection_manager = Receiver()
-        self.msg_queue = self.connection_manager.get_queue()
+        if shards < 0:
+            raise ValueError(f"Number of shards {shards} must not be negative.")
+        if shards > 0 and debug != "none":
+            raise ValueError(f"Output mode {debug} is not supported by a sharded exchange.")
+        if shards > 0 and (journal is not None or snapshot is not None):
+            raise ValueError("A sharded exchange cannot be journaled or loaded from a snapshot.")
+        if shards > 0 and market_data:
+            raise ValueError("A sharded exchange cannot publish market data.")
+        if shards > 0 and instrument:
+            raise ValueError("A sharded exchange cannot be instrumented.")
+        if journal is not None and snapshot is not None:
+            raise ValueError("An exchange cannot be loaded from both a journal and a snapshot.")
+        if receiver not in self.RECEIVERS:
+            raise ValueError(f"Receiver {receiver} not defined.")
 
         # Orderbook
         self.orderbook_lock = threading.Lock()
         self.orderbook = OrderBook()
 
+        # Journal or snapshot, loaded into the orderbook before accepting connections.
+        self.journal = None
+        client_no = 0
+        if journal is not None:
+            self.journal = Journal(journal)
+            client_no = self._recover()
+        elif snapshot is not None:
+            Snapshot.load(self.orderbook, snapshot)
+            client_ids = [client_id for client_id in self.orderbook.greatest_tokens if client_id != Snapshot.CSV_CLIENT_ID]
+            client_no = max(client_ids) + 1 if client_ids else 0
+        # Every client of a previous run has disconnected.
+        for client_id in list(self.orderbook.greatest_tokens):
+            self.orderbook.end_session(client_id)
+
+        # Market data feed, starting from the recovered orderbook.
+        self.publisher = MarketDataPublisher(self.orderbook) if market_data else None
+
+        # Stage statistics, or None if the exchange is not instrumented.
+        self.stats = StageStats() if instrument else None
+
+        # Connection receiver
+        self.connection_manager = self.RECEIVERS[receiver](client_no, stamp=instrument,
+            send_buffer=send_buffer, slow_consumer=slow_consumer)
+        if shm_gateway:
+            self.connection_manager = ShmGateway(self.connection_manager)
+        self.msg_queue = self.connection_manager.get_queue()
+
         # Outputting orderbook once per second, change to silent-mode later.
         self.debug = debug
         self.print_dict = threading.Event()
+        # In the default mode, the depth of the orderbook is drawn rather than every order.
+        self.renderer = DepthRenderer() if debug == "default" else None
 
         self.printer = threading.Thread(name="printer", target=lambda: self._print_orderbook_thread(), daemon=True)
         self.printer.start()
 
-        self.operation_thread = threading.Thread(name="operate", target=lambda: self._operate(), daemon=True)
+        # Process messages one at a time, or in batches, or route them to matching processes.
+        if batch_size < 1:
+            raise ValueError(f"Batch size {batch_size} must be at least 1.")
+        self.batch_size = batch_size
+        self.router = None
+        if shards > 0:
+            self.router = ShardRouter(shards, self.connection_manager)
+            operate = self._operate_sharded
+        elif batch_size == 1:
+            operate = self._operate
+        else:
+            operate = self._operate_batch
+        self.operation_thread = threading.Thread(name="operate", target=lambda: operate(), daemon=True)
         self.operation_thread.start()
 
+        # In silent mode, the orderbook is dumped on request from a signal. The signal handler
+        # only requests the dump, which is written by the dumper thread.
+        self.dump_requested = threading.Event()
+        if debug == "none" and shards == 0 and threading.current_thread() is threading.main_thread():
+            self.dumper = threading.Thread(name="dumper", target=lambda: self._dump_orderbook_thread(), daemon=True)
+            self.dumper.start()
+            # SIGUSR1 does not exist on Windows, where Ctrl+Break (SIGBREAK) is used instead.
+            dump_signal = getattr(signal, "SIGUSR1", None) or getattr(signal, "SIGBREAK")
+            signal.signal(dump_signal, self._handle_signal)
+
+        # The stage statistics are dumped on request from SIGUSR2, which has no equivalent on
+        # Windows, where they are only available from get_stats.
+        self.stats_requested = threading.Event()
+        if instrument and hasattr(signal, "SIGUSR2") and threading.current_thread() is threading.main_thread():
+            self.stats_dumper = threading.Thread(name="stats", target=lambda: self._dump_stats_thread(), daemon=True)
+            self.stats_dumper.start()
+            signal.signal(signal.SIGUSR2, self._handle_stats_signal)
+
     def open_exchange(self):
         """Open the exchange and allow clients to place orders."""
         self.open = True
@@ -54,7 +176,59 @@ class Exchange():
         """Close the exchange and prevent clients from place orders."""
         self.open = False
         self.connection_manager.terminate()
+        if self.renderer is not None:
+            self.renderer.close()
+        if self.router is not None:
+            self.router.terminate()
+        if self.publisher is not None:
+            self.publisher.terminate()
+        if self.journal is not None:
+            self.orderbook_lock.acquire()
+            self.journal.close()
+            self.journal = None
+            self.orderbook_lock.release()
     
+    def dump_orderbook(self, path: str, binary: bool = False) -> threading.Thread:
+        """
+        Writes a snapshot of the orderbook as it is now to a file, in the CSV format of
+        res/orderbookFormat.md or the binary snapshot format. The orderbook lock is only held
+        while the snapshot is taken, not while it is written.
+
+        :returns: SnapshotWriter thread which finishes once the snapshot has been written, or
+            has failed to be (see SnapshotWriter.wait).
+        """
+        if self.router is not None:
+            raise ValueError("The orderbook of a sharded exchange cannot be dumped.")
+        return Snapshot.dump_background(self.orderbook, self.orderbook_lock, path, binary)
+
+    def get_stats(self) -> dict:
+        """
+        Returns the time messages have spent in each stage of the exchange so far, as
+        histograms in nanoseconds (see StageStats), and the objects held by the exchange as
+        "objects" (see get_counts).
+        """
+        if self.stats is None:
+            raise ValueError("The exchange is not instrumented.")
+        stats = self.stats.to_dict()
+        stats["objects"] = self.get_counts()
+        return stats
+
+    def get_counts(self) -> dict:
+        """
+        Returns the number of live and retained objects held by the exchange: orders, price
+        levels and client state in the orderbook (see OrderBook.get_counts), and connections
+        and threads in the receiver. The orderbooks of a sharded exchange are held by its
+        matching processes, so only the router's state is counted instead.
+        """
+        counts = {"receiver": self.connection_manager.get_session_counts()}
+        if self.router is not None:
+            counts["router"] = self.router.get_counts()
+        else:
+            self.orderbook_lock.acquire()
+            counts["orderbook"] = self.orderbook.get_counts()
+            self.orderbook_lock.release()
+        return counts
+
     def _operate(self):
         """
         Exchange's main function. Continuously retrieves messages from the reveiver's
@@ -63,122 +237,203 @@ class Exchange():
 
         A thread of this function is automatically created upon initialisation.
         """
+        stats = self.stats
+        perf_counter_ns = time.perf_counter_ns
         while True:
             # Wait until queue has messages, then retrieve it.
             # The message is a dictionary with {"client_id": int, "header": bytes, "body": bytes}
             msg = self.msg_queue.get()
+            if stats is not None:
+                dequeued = perf_counter_ns()
+                depth = self.msg_queue.qsize()
 
-            # A new client has established a connection.
-            if msg["type"] == "C":
-                # Acknowledge the connection by returning a server event message.
-                if not self.open:
-                    outbound = ["S", Util.get_server_time(), "S"]
-                else:
-                    outbound = ["S", Util.get_server_time(), "E"]
-                self.connection_manager.send_message(msg["id"], Util.package(outbound))
-            else:
-                # Parse message if it's not a connection.
-                client_id = msg["id"]
-                content = Util.unpackage(msg["header"], msg["body"])
-
-                # Validate order fields according to the OUCH protocol.
-                valid, outbound = self._validate_order_syntax(content, client_id)
-
-                msg_type = content["message_type"]
-                cancel_repl_reason = None
-                if not valid:
-                    # If a replacement order is not valid, cancel the order.
-                    if msg_type == 'U':
-                        # Section 6.3
-                        msg_type == "X"
-                        content = {
-                            "message_type": "X",
-                            "order_token": content["existing_order_token"],
-                            "quantity": content["quantity"]
-                        }
-                        valid = True
-                        cancel_repl_reason = outbound[0] # Remember order cancelled reason
-                
-                # Pass valid order into the orderbook
-                if valid:
-                    self.orderbook_lock.acquire()
-                    success, outbound = self.orderbook.handle_order(client_id, content)
-                    self.orderbook_lock.release()
-
-                if len(outbound) == 0: 
-                    self.print_dict.set()
-                    continue
-
-                # Send outbound message back to client.
-                if cancel_repl_reason != None:
-                    if len(outbound) != 5:
-                        raise ValueError("Expected cancel message but was not the same length.")
+            self.orderbook_lock.acquire()
+            if stats is not None:
+                locked = perf_counter_ns()
+            Util.freeze_server_time()
+            replies = self.process_message(msg)
+            Util.unfreeze_server_time()
+            if self.journal is not None:
+                self._journal_message(msg, replies)
+            if self.publisher is not None:
+                self.publisher.publish(self.orderbook.get_book_events())
+            self.orderbook_lock.release()
+            if stats is not None:
+                processed = perf_counter_ns()
+
+            # Send outbound messages back to clients.
+            for client_id, reply in replies:
+                self.connection_manager.send_message(client_id, reply)
+            if stats is not None:
+                stats.record(msg, dequeued, locked, processed, perf_counter_ns(), depth)
+            if self.debug == "debug":
+                self.print_dict.set()
+
+    def _operate_batch(self):
+        """
+        Batched version of _operate. Waits for a message, then drains every message already
+        in the queue (up to batch_size) and processes the whole batch under one acquisition
+        of the orderbook lock. Replies are coalesced per client, so each client receives all
+        of its replies to the batch with a single send.
+
+        A thread of this function is automatically created upon initialisation if batch_size
+        is greater than one.
+        """
+        queue = self.msg_queue
+        batch_size = self.batch_size
+        stats = self.stats
+        perf_counter_ns = time.perf_counter_ns
+        # The gateway reads local clients' rings into the batch itself.
+        get_batch = queue.get_batch if isinstance(queue, ShmGateway) else self._get_batch
+        while True:
+            batch = get_batch(batch_size)
+            if stats is not None:
+                dequeued = perf_counter_ns()
+                depth = queue.qsize()
+
+            # {client_id: [bytes, ...]} preserving the order of each client's replies.
+            replies = {}
+            self.orderbook_lock.acquire()
+            if stats is not None:
+                locked = perf_counter_ns()
+            # Every message in the batch, and every reply to it, has the same timestamp.
+            Util.freeze_server_time()
+            for msg in batch:
+                msg_replies = self.process_message(msg)
+                if self.journal is not None:
+                    self._journal_message(msg, msg_replies)
+                for client_id, reply in msg_replies:
+                    client_replies = replies.get(client_id)
+                    if client_replies is None:
+                        replies[client_id] = [reply]
                     else:
-                        outbound[4] = cancel_repl_reason
-                self.connection_manager.send_message(client_id, Util.package(outbound))
+                        client_replies.append(reply)
+            Util.unfreeze_server_time()
+            if self.publisher is not None:
+                self.publisher.publish(self.orderbook.get_book_events())
+            self.orderbook_lock.release()
+            if stats is not None:
+                processed = perf_counter_ns()
+
+            for client_id, client_replies in replies.items():
+                self.connection_manager.send_messages(client_id, client_replies)
+            if stats is not None:
+                stats.record_batch(batch, dequeued, locked, processed, perf_counter_ns(), depth)
             if self.debug == "debug":
                 self.print_dict.set()
 
-    def _validate_order_syntax(self, content: dict, client_id: int): # -> (bool, list):
-        """
-        Validates the formatting of the order from a specfic client.
-
-        :param content: Decoded and parsed messaged sent by the client.
-        :param client_id: Unique Integer ID assigned to each client by the receiver.
-        :returns: boolean of whether the order is allowed or not.
-        """
-        msg_type = content["message_type"]
-        err_code = None
-        outbound = []
-        if msg_type == 'O':
-            # Checking Error rejected reasons in Table 3 Section 7.7.
-            # Not Implemented: H, V, i, R, F, L, C, O
-            if content["orderbook_id"] > 3 or content["orderbook_id"] < 0:
-                err_code = "S"
-            elif content["price"] > self.PRICE_MAX:
-                err_code = "X"
-            elif content["quantity"] > self.QUANTITY_MAX or content["quantity"] <= 0:
-                err_code = "Z"
-            elif content["minimum_quantity"] > 0 and content["time_in_force"] != 0:
-                err_code = "N"
-            elif content["buy_sell_indicator"] not in ("B", "S", "T", "E") or \
-                    content["order_classification"] not in ("1", "3", "4", "5", "6") or \
-                    content["time_in_force"] not in (0, 99999):
-                err_code = "Y"
-            elif content["display"] not in ("P", " "):
-                err_code = "D"
-            elif content["cash_margin_type"] not in ("1", "2", "3", "4", "5"):
-                err_code = "G"
-            else:
-                return True, outbound
-            outbound = ["J", Util.get_server_time(), content["order_token"], err_code]
-            return False, outbound
-        elif msg_type == 'U':
-            if content["price"] > self.PRICE_MAX:
-                err_code = "X"
-            elif content["quantity"] > self.QUANTITY_MAX:
-                err_code = "Z"
-            elif content["minimum_quantity"] > 0 and content["time_in_force"] != 0:
-                err_code = "N"
-            elif content["time_in_force"] not in (0, 99999):
-                err_code = "Y"
-            elif content["display"] not in ("P", " "):
-                err_code = "D"
+    def _get_batch(self, batch_size: int) -> list:
+        """Waits for a message in the receiver's queue, and takes it with up to batch_size-1 more."""
+        queue = self.msg_queue
+        batch = [queue.get()]
+
+        # Take the rest of the batch with one acquisition of the queue's own lock, rather than
+        # one per get_nowait. The receiver's queue is unbounded, so no producer is ever waiting
+        # to be notified.
+        with queue.mutex:
+            pending = queue.queue
+            while pending and len(batch) < batch_size:
+                batch.append(pending.popleft())
+        return batch
+
+    def _operate_sharded(self):
+        """
+        Sharded version of _operate. Connections are acknowledged here, and every other message
+        is forwarded to the matching process which holds its orderbook. Replies are sent by the
+        router's collector thread.
+
+        A thread of this function is automatically created upon initialisation if shards is
+        greater than zero.
+        """
+        while True:
+            msg = self.msg_queue.get()
+            if msg["type"] == "C":
+                for client_id, reply in self.process_message(msg):
+                    self.connection_manager.send_message(client_id, reply)
+            elif msg["type"] == "D":
+                self.router.end_session(msg["id"])
             else:
-                return True, outbound
-            outbound = [err_code]
-            return False, outbound
-        elif msg_type == 'X':
-            return True, outbound
-        else:
-            raise ValueError(f"Invalid header detected in Exchange validation.")
+                self.router.route(msg)
+
+    def _journal_message(self, msg: dict, replies: list):
+        """
+        Records a message from a client, once it has been applied, and the replies to it in the
+        journal. The replies are sent as soon as this returns, before the records are flushed
+        to disk, so they acknowledge messages which a machine failure may still lose.
+        """
+        journal = self.journal
+        if msg["type"] == "M":
+            journal.append(Journal.INBOUND, msg["id"], msg["header"] + msg["body"])
+        for client_id, reply in replies:
+            journal.append(Journal.OUTBOUND, client_id, reply)
 
+    def _recover(self) -> int:
+        """
+        Rebuilds the orderbook by replaying every client message in the journal in sequence.
+        Replies are not rebuilt, as they have already been sent.
+
+        :returns: The lowest client id which does not appear in the journal.
+        """
+        client_no = 0
+        # Consecutive inbound messages of one type are applied together (see _apply_batch).
+        client_ids = []
+        messages = []
+        header = None
+        for _, kind, client_id, message in self.journal.replay():
+            if kind == Journal.INBOUND:
+                if message[0:1] != header or len(messages) == self.REPLAY_BATCH_SIZE:
+                    if messages:
+                        self._apply_batch(client_ids, header, b"".join(messages))
+                    client_ids = []
+                    messages = []
+                    header = message[0:1]
+                client_ids.append(client_id)
+                messages.append(message)
+            if client_id >= client_no:
+                client_no = client_id + 1
+        if messages:
+            self._apply_batch(client_ids, header, b"".join(messages))
+        return client_no
 
-    def _handle_signal(self):
-        """Handler which dumps the orderbook into a csv file when SIGUSR1 or SIGILL is caught in silent mode."""
-        # implement with sigill in windows and sigusr1 in linux
-        # use sys.platform to check operating system
-        pass 
+    def _handle_signal(self, signum, frame):
+        """
+        Handler which dumps the orderbook into a csv file when SIGUSR1 (SIGBREAK on Windows)
+        is caught in silent mode. The handler only requests the dump, so it never waits for
+        the orderbook lock.
+        """
+        self.dump_requested.set()
+
+    def _dump_orderbook_thread(self):
+        """
+        Dumper thread: writes each requested dump to DUMP_PATH. The orderbook lock is only held
+        while the snapshot is taken (see dump_orderbook), so matching carries on while the dump
+        is written. Requests made while a dump is being written are served by one more dump.
+        """
+        while True:
+            self.dump_requested.wait()
+            self.dump_requested.clear()
+            path = self.DUMP_PATH.format(Util.get_server_time())
+            try:
+                self.dump_orderbook(path).wait()
+            except OSError as e:
+                # Includes a dump by a child process which exited with an error.
+                print(f"Orderbook dump to {path} failed: {e}")
+
+    def _handle_stats_signal(self, signum, frame):
+        """Handler which requests a dump of the stage statistics when SIGUSR2 is caught."""
+        self.stats_requested.set()
+
+    def _dump_stats_thread(self):
+        """Stats thread: writes the stage statistics to STATS_PATH on each request."""
+        while True:
+            self.stats_requested.wait()
+            self.stats_requested.clear()
+            path = self.STATS_PATH.format(Util.get_server_time())
+            try:
+                with open(path, "w") as f:
+                    json.dump(self.get_stats(), f, indent=4)
+            except OSError as e:
+                print(f"Stats dump to {path} failed: {e}")
 
     def _print_orderbook_thread(self):
         """Threading wrapper for print_orderbook which outputs once every second."""
@@ -194,13 +449,16 @@ class Exchange():
                 raise Exception(f"Output mode {self.debug} not defined.")
 
     def _print_orderbook(self):
-        """Prints the Orderbook to the console in a nice format."""
+        """
+        Draws the aggregated depth of the orderbook on the console. The orderbook lock is only
+        held while the depth snapshot is taken, not while it is drawn.
+        """
         if self.debug == "none":
             raise Exception("Normal printing when should be debugging")
         self.orderbook_lock.acquire()
-        Console(loadfrom=self.orderbook.get_book()).print()
-        self.connection_manager.print_connections()
+        depth = self.orderbook.get_depth(self.renderer.levels)
         self.orderbook_lock.release()
+        self.renderer.render(depth, self.connection_manager.get_connection_log(DepthRenderer.CONNECTION_LOG_LINES))
     
     def _print_orderbook_debug(self):
         """Prints the Orderbook to the console in a nice format."""
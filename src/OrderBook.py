@@ -1,38 +1,77 @@
 import time
 import pprint
-import copy
 
 from src.util import Util
+from src.ladder import PriceLadder
+from src.order import OrderStore, OrderIndex, IdAllocator
 
 class OrderBook:
     PRICE_MAX = 214748364.6
     QUANTITY_MAX = 2147483647
 
-    def __init__(self):
-        # Limit order book.
-        # {price: [<order>, <order>, ...]} where each order is a list
-        self.order_book = {}
+    # Buy/sell indicators which rest on the ask side of the book (sell, short sell, short exempt).
+    SELL_INDICATORS = ("S", "T", "E")
 
-        # Tokens in use dict:{client_id: [int, int, ...]}
-        self.tokens_used = {} 
+    def __init__(self, shard: int = 0, shards: int = 1):
+        """
+        :param shard: Index of this orderbook when the exchange is split across several
+            orderbooks, each matching different instruments.
+        :param shards: Number of orderbooks the exchange is split across. Order numbers and
+            match numbers are interleaved between orderbooks so they stay unique exchange-wide.
+        """
+        # Limit order book, one pair of price ladders per instrument.
+        # {orderbook_id: (<bid ladder>, <ask ladder>)} where each resting order is a slot of
+        # the order store
+        self.ladders = {}
+
+        # Fields of the live orders. Orders are forgotten as soon as they leave the book.
+        self.orders = OrderStore()
+
+        # Match number of the most recent execution.
+        self.match_numbers = IdAllocator(start=shard+1, step=shards)
+        self.match_number = 0
+
+        # Execution messages produced since the last call to get_executions.
+        # [(client_id, <outbound>), ...]
+        self.executions = []
+
+        # Greatest order token used by each client, as tokens must increase across all of a
+        # client's orders. dict:{client_id: int}
+        self.greatest_tokens = {}
+
+        # Order numbers are allocated once when an order is entered, and kept after replacement.
+        self.order_ids = IdAllocator(start=shard+1, step=shards)
 
-        # Order hashmap dict:{order_id: <order>}
-        self.order_hashmap = {}
+        # Slots of the live orders by client and the token currently referring to them. This
+        # is the only per-order index: orders are never looked up by order number.
+        self.order_index = OrderIndex()
 
-        # Hashmap to support keeping order_id the same after replacement.
-        # dict:{latest order_id: first order_id}
-        self.order_id_aliases = {}
+        # Clients which have disconnected but still have live orders. The state of a client
+        # which has disconnected is forgotten once it has no live orders (see end_session).
+        self.ended_sessions = set()
 
-        # List of active order ids
-        self.active_order_ids = []
+        # Changes to the resting orders since the last call to get_book_events, or None if
+        # book events are not recorded. Each event is a tuple starting with its type:
+        # ("A", orderbook_id, order_id, indicator, price, quantity) - order added to the book
+        # ("M", orderbook_id, order_id, price, quantity) - order replaced, losing time priority
+        # ("D", orderbook_id, order_id) - order removed from the book
+        # ("T", orderbook_id, order_id, quantity, price, match_number) - resting order traded
+        self.book_events = None
+
+        # Aggregated depth snapshots, rebuilt only for instruments which changed since they
+        # were last taken.
+        # {orderbook_id: (<bids>, <asks>)} where each side is a tuple of (price, quantity, count)
+        self.depth_levels = 0
+        self.depth_snapshots = {}
+        self.depth_changed = set()
 
         # For debugging
         self.debug_cycle = 1
     
     def debug(self):
         """Outputs all fields of the orderbook onto the console."""
-        names = ("Order Book: ", "Tokens Used: ", "Order Hashmap: ", "Order ID Aliases: ")
-        books = (self.order_book, self.tokens_used, self.order_hashmap, self.order_id_aliases, self.active_order_ids)
+        names = ("Order Book: ", "Greatest Tokens: ", "Live Orders: ", "Ended Sessions: ")
+        books = (self.get_book(), self.greatest_tokens, len(self.order_index), self.ended_sessions)
         print(f"-----------------DEBUG CYCLE {self.debug_cycle}------------------")
         for i in range(len(names)):
             print(names[i])
@@ -42,12 +81,99 @@ class OrderBook:
 
     def get_book(self) -> dict:
         """
-        Return a deepcopy of the orderbook. A deepcopy is returned as the console output 
-        implementation modifies the list referenced in the orderbook. To improve performance, 
-        the output implementation must be modified to not change the orderbook. So a shallow
-        copy can be used instead.
+        Return a copy of the orderbook as {price: [<order>, ...]}, merging every instrument
+        and both sides. Each order is copied into a new list (see OrderStore.to_list), so the
+        result can be used without holding the orderbook lock.
+        """
+        book = {}
+        for ladder_pair in self.ladders.values():
+            for ladder in ladder_pair:
+                for price in ladder.prices():
+                    orders = book.setdefault(price, [])
+                    for slot in ladder.levels[ladder.key(price)]:
+                        orders.append(self.orders.to_list(slot))
+        return book
+
+    def get_depth(self, levels: int = 5) -> dict:
+        """
+        Return the aggregated depth of every instrument as {orderbook_id: (bids, asks)}, where
+        each side is a tuple of up to levels (price, total quantity, order count) tuples, best
+        first. Levels are aggregated as orders are entered, replaced, cancelled and executed,
+        so individual orders are never copied, and the snapshot of an instrument is only
+        rebuilt if it has changed since the last call. The result is immutable (apart from
+        the outer dictionary, which is new on every call) and can be used without holding the
+        orderbook lock.
+        """
+        snapshots = self.depth_snapshots
+        if levels != self.depth_levels:
+            self.depth_levels = levels
+            self.depth_changed.update(self.ladders)
+        for orderbook_id in self.depth_changed:
+            bids, asks = self.ladders[orderbook_id]
+            snapshots[orderbook_id] = (bids.depth(levels), asks.depth(levels))
+        self.depth_changed.clear()
+        return dict(snapshots)
+
+    def get_top_of_book(self) -> dict:
+        """
+        Return the best bid and ask price of every instrument as
+        {orderbook_id: (best bid, best ask)}, where an empty side is None.
+        """
+        return {
+            orderbook_id: (bids.best_price(), asks.best_price())
+            for orderbook_id, (bids, asks) in self.ladders.items()
+        }
+
+    def get_counts(self) -> dict:
+        """
+        Returns the number of live orders and price levels, and of the order slots and clients
+        whose state is held. Dead orders are never held, but retained_orders includes the free
+        slots kept for reuse by later orders, and clients only includes disconnected clients
+        with live orders.
+        """
+        return {
+            "live_orders": len(self.order_index),
+            "retained_orders": self.orders.capacity(),
+            "price_levels": sum(len(ladder.levels) for ladders in self.ladders.values() for ladder in ladders),
+            "clients": len(self.greatest_tokens),
+            "ended_sessions": len(self.ended_sessions)
+        }
+
+    def end_session(self, client_id: int):
+        """
+        Forgets the state of a client which has disconnected. Its live orders stay in the
+        book, and the rest of its state is forgotten once the last of them leaves the book.
+        Client ids are never reused, so the client's tokens are never needed again.
+        """
+        if self.order_index.count(client_id):
+            self.ended_sessions.add(client_id)
+        else:
+            self._forget_client(client_id)
+
+    def record_book_events(self):
+        """Starts recording changes to the resting orders, for get_book_events."""
+        if self.book_events is None:
+            self.book_events = []
+
+    def get_book_events(self) -> list:
+        """
+        Returns and clears the changes to the resting orders since the last call, in the order
+        they happened. A resting order which trades its whole quantity leaves the book without
+        a separate "D" event.
+        """
+        events = self.book_events
+        self.book_events = []
+        return events
+
+    def get_executions(self) -> list:
+        """
+        Returns and clears the execution messages produced by the most recent orders, as a list
+        of (client_id, outbound) pairs. Both the resting and the incoming order of a match
+        receive an execution message.
         """
-        return copy.deepcopy(self.order_book)
+        executions = self.executions
+        self.executions = []
+        return executions
 
     def handle_order(self, client_id: int, msg: dict): # -> (bool, dict):
         """Handles an incoming order from a client."""
@@ -78,11 +204,10 @@ class OrderBook:
         :returns : whether or not the order should be accepted.
         """
         token = msg["order_token"]
-        if not client_id in self.tokens_used.keys():
-            self.tokens_used[client_id] = []
+        if not client_id in self.greatest_tokens:
             return True, None
         else:
-            greatest_token = self.tokens_used[client_id][-1]
+            greatest_token = self.greatest_tokens[client_id]
             if token <= greatest_token:
                 return False, []
             else:
@@ -92,11 +217,10 @@ class OrderBook:
         """Checks contextual validity of a replace order."""
         exst_token = msg["existing_order_token"]
         repl_token = msg["replacement_order_token"]
-        exst_order_id = self._get_order_id(client_id, exst_token)
-        if not exst_order_id in self.active_order_ids:
+        if self.order_index.get(client_id, exst_token) == OrderStore.NONE:
             return False, []
         else:
-            greatest_token = self.tokens_used[client_id][-1]
+            greatest_token = self.greatest_tokens[client_id]
             if repl_token <= greatest_token:
                 return False, []
             else:
@@ -104,8 +228,7 @@ class OrderBook:
     
     def _validate_cancel_order(self, client_id: int, msg: dict): # -> (bool, list):
         """Checks contextual validity of a cancel order."""
-        order_id = self._get_order_id(client_id, msg["order_token"])
-        if not order_id in self.active_order_ids:
+        if self.order_index.get(client_id, msg["order_token"]) == OrderStore.NONE:
             return False, []
         else:
             return True, None
@@ -129,27 +252,33 @@ class OrderBook:
         return outbound
 
     def _process_enter_order(self, client_id: int, msg: dict) -> list:
-        """Adds an order to the orderbook."""
+        """Matches an order against the opposite side of the book, then rests any remainder."""
         price = msg["price"]
-        if not price in self.order_book.keys():
-            self.order_book[price] = []
-
         token = msg["order_token"]
-        order_id = self._get_order_id(client_id, token)
-        order = self._build_order(client_id, msg)
+        indicator = msg["buy_sell_indicator"]
+        orderbook_id = msg["orderbook_id"]
+        time_in_force = msg["time_in_force"]
+        time_received = Util.get_server_time()
+        order_id = self.order_ids.allocate()
 
-        order_state = "D" if msg["time_in_force"] == 0 or msg["quantity"] == 0 else "L"
-        # Don't add the order if the order is dead, but still maintain a reference to the order and its id
-        if order_state != "D":
-            self.order_book[price].append(order)
-            self.active_order_ids.append(order_id)
-        self.order_hashmap[order_id] = order
-        self.order_id_aliases[order_id] = order_id
-        self.tokens_used[client_id].append(token)
+        # Immediate or cancel orders never rest, whether or not they trade.
+        bids, asks = self._get_ladders(orderbook_id)
+        self.depth_changed.add(orderbook_id)
+        is_bid = indicator not in self.SELL_INDICATORS
+        quantity = msg["quantity"]
+        if quantity > 0:
+            quantity = self._match(client_id, token, price, quantity, asks if is_bid else bids)
 
-        # Remove level if empty
-        if len(self.order_book[price]) == 0:
-            self.order_book.pop(price)
+        order_state = "D" if time_in_force == 0 or quantity == 0 else "L"
+        # Don't add the order if the order is dead. Its order number is never reused.
+        if order_state != "D":
+            slot = self.orders.add(indicator, price, quantity, orderbook_id, time_in_force,
+                time_received, order_id, token, client_id)
+            (bids if is_bid else asks).add(slot)
+            self.order_index.add(client_id, token, slot)
+            if self.book_events is not None:
+                self.book_events.append(("A", orderbook_id, order_id, indicator, price, quantity))
+        self.greatest_tokens[client_id] = token
 
         # Create outbound message
         msg["price"] = int(price*10)
@@ -165,75 +294,66 @@ class OrderBook:
         outbound.insert(15, order_state)
         return outbound
 
-    def _build_order(self, client_id: int, msg: dict) -> list:
-        """Create an order from an enter order message as a list."""
-        token = msg["order_token"]
-        order = [
-            msg["buy_sell_indicator"],
-            msg["price"],
-            msg["quantity"],
-            msg["orderbook_id"],
-            msg["time_in_force"],
-            Util.get_server_time(),
-            self._get_order_id(client_id,token),
-            token
-        ]
-        return order
-
     def _process_replace_order(self, client_id: int, msg: dict) -> list:
-        """Replace a live order in the orderbook."""
-        # Find the original order id if the order has been replaced before
+        """
+        Replace a live order in the orderbook. The replaced order loses time priority, and 
+        trades immediately if its new price crosses the opposite side of the book.
+        """
+        # The order keeps its order number, but is now referred to by the replacement token.
         exst_token = msg["existing_order_token"]
         repl_token = msg["replacement_order_token"]
-        exst_order_id = self._get_order_id(client_id, exst_token)
-        repl_order_id = self._get_order_id(client_id, repl_token)
+        orders = self.orders
+        slot = self.order_index.pop(client_id, exst_token)
+        orig_order_id = orders.order_id[slot]
+        orderbook_id = orders.orderbook_id[slot]
+        indicator = chr(orders.indicator[slot])
 
-        # Update the order id alias
-        orig_order_id = self.order_id_aliases.pop(exst_order_id)
-        self.order_id_aliases[repl_order_id] = orig_order_id
-        self.active_order_ids.remove(exst_order_id)
-        self.active_order_ids.append(repl_order_id)
+        # Take the order out of its current level before changing its price.
+        price = msg["price"]
+        bids, asks = self._get_ladders(orderbook_id)
+        self.depth_changed.add(orderbook_id)
+        is_bid = indicator not in self.SELL_INDICATORS
+        (bids if is_bid else asks).remove(slot)
 
         # Replace order fields with replacement values.
-        price = msg["price"]
-        order = self.order_hashmap[orig_order_id]
-        old_price = order[1]
-        order[1] = price
-        order[2] = msg["quantity"]
-        order[4] = msg["time_in_force"]
-        order[5] = Util.get_server_time()
-        order[7] = repl_token
+        quantity = msg["quantity"]
+        time_in_force = msg["time_in_force"]
+        time_received = Util.get_server_time()
+        remaining = quantity
+        if remaining > 0:
+            remaining = self._match(client_id, repl_token, price, remaining, asks if is_bid else bids)
 
         # Remove the order if the replacement values cause it to become dead.
-        self.order_book[old_price].remove(order)
-        order_state = "D" if order[2] == 0 else "L"
+        order_state = "D" if remaining == 0 or time_in_force == 0 else "L"
         if order_state == "D":
-            self.active_order_ids.remove(repl_order_id)
+            self._forget_order(client_id, slot)
         else:
-            # Create new price level if price is new
-            if not price in self.order_book.keys():
-                self.order_book[price] = [order]
+            orders.price[slot] = price
+            orders.quantity[slot] = remaining
+            orders.time_in_force[slot] = time_in_force
+            orders.time_received[slot] = time_received
+            orders.token[slot] = repl_token
+            (bids if is_bid else asks).add(slot)
+            self.order_index.add(client_id, repl_token, slot)
+        if self.book_events is not None:
+            if order_state == "D":
+                self.book_events.append(("D", orderbook_id, orig_order_id))
             else:
-                self.order_book[price].append(order)
-
-        self.tokens_used[client_id].append(repl_token)
+                self.book_events.append(("M", orderbook_id, orig_order_id, price, remaining))
 
-        # Remove level if empty
-        if len(self.order_book[old_price]) == 0:
-            self.order_book.pop(old_price)
+        self.greatest_tokens[client_id] = repl_token
 
-        # Create outbound message
-        msg["price"] = int(price*10)
+        # Create outbound message. The Order Replaced codec converts the decimal price itself.
         outbound = [
             "U",
             Util.get_server_time(),
             repl_token,
-            order[0], # Buy/Sell Indicator
-            order[2], # Quantity,
-            order[3], # Orderbook ID
+            indicator, # Buy/Sell Indicator
+            quantity, # Quantity,
+            orderbook_id, # Orderbook ID
             "DAY ", # Group - Not implemented
-            msg["price"],
-            order[4], # Time in Force
+            price,
+            time_in_force, # Time in Force
             msg["display"],
             orig_order_id, # Order Number
             msg["minimum_quantity"], # Minimum Quantity
@@ -245,29 +365,99 @@ class OrderBook:
     def _process_cancel_order(self, client_id: int, msg: dict) -> list:
         """Cancels a live order in the orderbook."""
         token = msg["order_token"]
-        curr_order_id = self._get_order_id(client_id, token) 
-        orig_order_id = self.order_id_aliases[curr_order_id]
-        order = self.order_hashmap[orig_order_id]
-        price = order[1]
+        orders = self.orders
+        slot = self.order_index.pop(client_id, token)
+        orderbook_id = orders.orderbook_id[slot]
+        quantity = orders.quantity[slot]
 
-        self.order_book[price].remove(order)
-        self.active_order_ids.remove(curr_order_id)
-        if len(self.order_book[price]) == 0:
-            self.order_book.pop(price)
+        bids, asks = self._get_ladders(orderbook_id)
+        self.depth_changed.add(orderbook_id)
+        (asks if chr(orders.indicator[slot]) in self.SELL_INDICATORS else bids).remove(slot)
+        if self.book_events is not None:
+            self.book_events.append(("D", orderbook_id, orders.order_id[slot]))
+        self._forget_order(client_id, slot)
 
         # Create outbound message
         outbound = [
             "C",
             Util.get_server_time(),
             token,
-            order[2], # Quantity,
+            quantity, # Quantity,
             "U"
         ]
         return outbound
 
-    def _get_order_id(self, client_id: int, order_token: int):
+    def _match(self, client_id: int, token: int, price: float, remaining: int, ladder: PriceLadder) -> int:
+        """
+        Trades an incoming order against the resting orders of the opposite ladder in
+        price-time priority, until the order is filled or its price no longer crosses.
+        Each fill is executed at the resting order's price, and produces an execution
+        message for both orders.
+
+        :returns: The remaining quantity of the incoming order.
         """
-        Returns the order_id of the requested order based on the client's id and 
-        passed order token. The result will always be an unsigned 32 bit integer.
+        orders = self.orders
+        quantities = orders.quantity
+        while remaining > 0 and ladder.crosses(price):
+            level = ladder.best_level()
+            exec_price = int(level.price*10)
+            while remaining > 0 and level.count:
+                resting = level.head
+                resting_quantity = quantities[resting]
+                fill = remaining if remaining < resting_quantity else resting_quantity
+                remaining -= fill
+                resting_quantity -= fill
+                quantities[resting] = resting_quantity
+                level.quantity -= fill
+                self.match_number = self.match_numbers.allocate()
+                resting_client = orders.client_id[resting]
+                resting_token = orders.token[resting]
+                self.executions.append((resting_client, self._build_execution(resting_token, fill, exec_price, "A")))
+                self.executions.append((client_id, self._build_execution(token, fill, exec_price, "R")))
+                if self.book_events is not None:
+                    self.book_events.append(("T", orders.orderbook_id[resting], orders.order_id[resting], fill, level.price, self.match_number))
+                if resting_quantity == 0:
+                    level.unlink(resting)
+                    self.order_index.pop(resting_client, resting_token)
+                    self._forget_order(resting_client, resting)
+            if not level.count:
+                ladder.pop_best_level()
+        return remaining
+
+    def _build_execution(self, token: int, quantity: int, price: int, liquidity_flag: str) -> list:
         """
-        return abs(hash((client_id, order_token))) % 2**32
\ No newline at end of file
+        Create an order executed message. The liquidity flag is "A" for the resting order
+        which added liquidity and "R" for the incoming order which removed it.
+        """
+        return [
+            "E",
+            Util.get_server_time(),
+            token,
+            quantity, # Executed Quantity
+            price, # Execution Price
+            liquidity_flag,
+            self.match_number
+        ]
+
+    def _forget_order(self, client_id: int, slot: int):
+        """
+        Forgets an order which has left the book, once it has been removed from its ladder and
+        from the order index, freeing its slot. If its client has disconnected and this was
+        the client's last live order, the client is forgotten too.
+        """
+        self.orders.free_slot(slot)
+        if client_id in self.ended_sessions and not self.order_index.count(client_id):
+            self._forget_client(client_id)
+
+    def _forget_client(self, client_id: int):
+        """Forgets the token state of a client which has disconnected."""
+        self.ended_sessions.discard(client_id)
+        self.greatest_tokens.pop(client_id, None)
+
+    def _get_ladders(self, orderbook_id: int): # -> (PriceLadder, PriceLadder):
+        """Returns the (bids, asks) ladders of an instrument, creating them if needed."""
+        ladders = self.ladders.get(orderbook_id)
+        if ladders is None:
+            ladders = (PriceLadder(is_bid=True, orders=self.orders), PriceLadder(is_bid=False, orders=self.orders))
+            self.ladders[orderbook_id] = ladders
+        return ladders
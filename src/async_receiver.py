@@ -0,0 +1,324 @@
+"""
+The OUCH Team
+Asyncio Input Receiver
+
+Alternative to the threaded Receiver which serves every client connection from one asyncio
+event loop instead of one thread per client. It keeps the same contract with the exchange:
+messages from clients are placed into the queue returned by get_queue, and replies are sent
+with send_message.
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+from queue import Queue
+
+from src.util import Util
+from src.framing import FrameReader
+from src.receiver import Receiver
+
+
+class _ClientProtocol(asyncio.BufferedProtocol):
+    """
+    Protocol for a single client connection. Received bytes are written by the event loop
+    straight into the connection's FrameReader buffer, and complete messages are handed to
+    the receiver.
+    """
+    def __init__(self, receiver):
+        self.receiver = receiver
+        self.reader = FrameReader(None, Receiver.INBOUND_BODY_LENGTH_DICT)
+        self.transport = None
+        self.client_id = None
+
+        # Reading is paused while the client's outbound buffer is above its high-water mark,
+        # or while the exchange's inbound queue is above its high-water mark.
+        self.writing_paused = False
+        self.reading = True
+
+        # Bytes dropped since the outbound buffer last had room, under the "drop" policy.
+        self.dropped = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(
+            high=self.receiver.WRITE_HIGH_WATER,
+            low=self.receiver.WRITE_LOW_WATER
+        )
+        self.client_id = self.receiver._register(self)
+        self.update_reading()
+
+    def get_buffer(self, sizehint):
+        return self.reader.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        self.reader.buffer_updated(nbytes)
+        try:
+            # An illegal header only raises once the messages before it have been returned.
+            frames = self.reader.split_frames()
+            while frames:
+                self.receiver._put_messages(self.client_id, frames)
+                frames = self.reader.split_frames()
+        except ValueError:
+            # The stream cannot be resynchronised after an illegal header.
+            self.transport.close()
+
+    def pause_writing(self):
+        # The client is not reading its replies, so stop taking orders from it.
+        self.writing_paused = True
+        self.update_reading()
+
+    def resume_writing(self):
+        self.writing_paused = False
+        self.update_reading()
+
+    def connection_lost(self, exc):
+        self.receiver._unregister(self.client_id)
+
+    def update_reading(self):
+        """Pauses or resumes reading from the client according to both backpressure sources."""
+        if self.transport.is_closing():
+            return
+        should_read = not self.writing_paused and not self.receiver.inbound_paused
+        if should_read and not self.reading:
+            self.transport.resume_reading()
+        elif not should_read and self.reading:
+            self.transport.pause_reading()
+        self.reading = should_read
+
+
+class AsyncReceiver(Receiver):
+    """
+    AsyncReceiver
+
+    Accepts connections from many clients on a single asyncio event loop, which runs in a
+    daemon thread. Outbound messages are buffered per connection by the loop's transports, and
+    backpressure is applied in both directions:
+    - a client whose unsent replies exceed WRITE_HIGH_WATER bytes is not read from until they
+      drain below WRITE_LOW_WATER bytes. Replies to orders from other clients can still fill
+      its buffer, and once they would exceed send_buffer bytes the slow consumer policy is
+      applied to it.
+    - when the exchange falls more than QUEUE_HIGH_WATER messages behind, no client is read
+      from until the queue drains below QUEUE_LOW_WATER messages.
+    """
+    # class constants: per-connection outbound buffer limits in bytes.
+    WRITE_HIGH_WATER = 256 * 1024
+    WRITE_LOW_WATER = 64 * 1024
+
+    # class constants: inbound queue limits in messages.
+    QUEUE_HIGH_WATER = 100000
+    QUEUE_LOW_WATER = 10000
+
+    # class constant: seconds between checks of the inbound queue while reading is paused.
+    QUEUE_CHECK_INTERVAL = 0.005
+
+    def __init__(self, client_no: int = 0, stamp: bool = False, send_buffer: int = Receiver.SEND_BUFFER, slow_consumer: str = "disconnect"):
+        """
+        Starts the event loop thread and begins accepting connections. Messages from clients
+        are placed into a shared queue, which can be retrieved by a context which calls the
+        get_queue function.
+
+        :param client_no: Client id given to the first connection.
+        :param stamp: Whether to stamp each message with the perf_counter_ns time it was
+            received, as "received" (see StageStats).
+        :param send_buffer: Bytes of replies each client may leave unread.
+        :param slow_consumer: Policy applied to a client which has left send_buffer bytes
+            unread, one of SLOW_CONSUMER_POLICIES.
+        """
+        self._validate_send_options(send_buffer, slow_consumer)
+        self.send_buffer = send_buffer
+        self.slow_consumer = slow_consumer
+
+        # Message queue which will be retrieved by the exchange
+        self.queue = Queue()
+        self.stamp = stamp
+
+        # {client_id: _ClientProtocol} - only accessed from the event loop thread.
+        self.client_dict = {}
+        self.client_no = client_no
+        self.client_no_lock = threading.Lock()
+
+        # Outbound messages waiting to be written by the event loop.
+        # deque([(client_id, bytes), ...])
+        self.outbound = deque()
+        self.flush_scheduled = False
+
+        # Whether reading from all clients is paused because the queue is too long.
+        self.inbound_paused = False
+
+        # The most recent messages received by the server socket in sequence - for debugging.
+        self.message_log_lock = threading.Lock()
+        self.message_log = deque(maxlen=self.MESSAGE_LOG_SIZE)
+
+        # The most recent connections and disconnections - for debugging.
+        self.connection_log_lock = threading.Lock()
+        self.connection_log = deque(maxlen=self.CONNECTION_LOG_SIZE)
+
+        # Event loop running in a daemon thread.
+        self.loop = asyncio.new_event_loop()
+        self.server = None
+        self.started = threading.Event()
+        self.start_error = None
+        self.daemon_listener = threading.Thread(
+            name = "daemon",
+            target = lambda: self._run_loop(),
+            daemon = True
+        )
+        self.daemon_listener.start()
+        self.started.wait()
+        if self.start_error is not None:
+            raise self.start_error
+
+    def send_message(self, client_id: int, msg: bytes):
+        """
+        Queues a byte message to be written to the connection of the client_id. The message is
+        written by the event loop, so this never blocks on the socket. Messages for a client
+        which has disconnected are dropped.
+        """
+        self._validate_message(msg)
+        self.outbound.append((client_id, msg))
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.call_soon_threadsafe(self._flush)
+
+    def send_messages(self, client_id: int, msgs: list):
+        """Queues a list of byte messages to be written to the connection of the client_id."""
+        for msg in msgs:
+            self._validate_message(msg)
+        self.outbound.append((client_id, b"".join(msgs)))
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.call_soon_threadsafe(self._flush)
+
+    def get_session_counts(self) -> dict:
+        """Returns the number of connected clients. Clients are served by the event loop's thread."""
+        return {
+            "connections": len(self.client_dict),
+            "threads": 0
+        }
+
+    def terminate(self):
+        """Close all connections and stop the event loop."""
+        if self.loop.is_closed():
+            return
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.daemon_listener.join()
+        self.loop.close()
+
+    def _run_loop(self):
+        """Event loop thread: binds the server socket, then serves connections forever."""
+        asyncio.set_event_loop(self.loop)
+        try:
+            host, port = Util.get_addr()
+            self.server = self.loop.run_until_complete(self.loop.create_server(
+                lambda: _ClientProtocol(self),
+                host,
+                port,
+                backlog = 1024
+            ))
+        except Exception as e:
+            self.start_error = e
+            self.started.set()
+            return
+        self.started.set()
+        self.loop.run_forever()
+
+    async def _shutdown(self):
+        """Stops accepting connections and closes every client connection."""
+        self.server.close()
+        self._flush()
+        for protocol in list(self.client_dict.values()):
+            protocol.transport.close()
+
+    def _register(self, protocol: _ClientProtocol) -> int:
+        """Assigns a client id to a new connection and notifies the exchange."""
+        client_id = self._new_client_id()
+        self.client_dict[client_id] = protocol
+
+        self.connection_log_lock.acquire()
+        self.connection_log.append(f"{Util.get_server_time()}: client_id {client_id} connected.")
+        self.connection_log_lock.release()
+
+        self.queue.put({
+            "type": "C",
+            "id": client_id
+        })
+        return client_id
+
+    def _unregister(self, client_id: int):
+        """Forgets a connection once it has been closed, and notifies the exchange."""
+        self.client_dict.pop(client_id, None)
+        self.connection_log_lock.acquire()
+        self.connection_log.append(f"{Util.get_server_time()}: client_id {client_id} disconnected.")
+        self.connection_log_lock.release()
+
+        self.queue.put({
+            "type": "D",
+            "id": client_id
+        })
+
+    def _put_messages(self, client_id: int, frames: list):
+        """Places messages received from a client into the queue."""
+        stamp = self.stamp
+        received = time.perf_counter_ns() if stamp else None
+        for header, body in frames:
+            msg = {
+                "type": "M", # Message
+                "id": client_id,
+                "header": header,
+                "body": body
+            }
+            if stamp:
+                msg["received"] = received
+            self.queue.put(msg)
+        self.message_log_lock.acquire()
+        for header, body in frames:
+            self.message_log.append(["id: " + str(client_id), header + body])
+        self.message_log_lock.release()
+
+        if not self.inbound_paused and self.queue.qsize() > self.QUEUE_HIGH_WATER:
+            self.inbound_paused = True
+            for protocol in self.client_dict.values():
+                protocol.update_reading()
+            self.loop.call_later(self.QUEUE_CHECK_INTERVAL, self._check_inbound)
+
+    def _check_inbound(self):
+        """Resumes reading from clients once the exchange has caught up with the queue."""
+        if self.queue.qsize() > self.QUEUE_LOW_WATER:
+            self.loop.call_later(self.QUEUE_CHECK_INTERVAL, self._check_inbound)
+            return
+        self.inbound_paused = False
+        for protocol in self.client_dict.values():
+            protocol.update_reading()
+
+    def _flush(self):
+        """Writes every queued outbound message, with one write per client."""
+        self.flush_scheduled = False
+        pending = {}
+        outbound = self.outbound
+        while outbound:
+            client_id, msg = outbound.popleft()
+            msgs = pending.get(client_id)
+            if msgs is None:
+                pending[client_id] = [msg]
+            else:
+                msgs.append(msg)
+        for client_id, msgs in pending.items():
+            protocol = self.client_dict.get(client_id)
+            if protocol is None or protocol.transport.is_closing():
+                continue
+            data = b"".join(msgs)
+            limit = self.send_buffer // 2 if protocol.dropped else self.send_buffer
+            if protocol.transport.get_write_buffer_size() + len(data) > limit:
+                if self.slow_consumer == "drop":
+                    if not protocol.dropped:
+                        self._log(f"client_id {client_id} is not reading its replies, dropping them.")
+                    protocol.dropped += len(data)
+                else:
+                    self._log(f"client_id {client_id} is not reading its replies, disconnecting.")
+                    protocol.transport.abort()
+                continue
+            if protocol.dropped:
+                self._log(f"client_id {client_id} caught up after {protocol.dropped} bytes were dropped.")
+                protocol.dropped = 0
+            protocol.transport.write(data)
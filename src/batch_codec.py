@@ -0,0 +1,119 @@
+"""
+The OUCH Team
+Batch Message Decoding
+
+Decodes many inbound messages of one type at once, for journal replay and bulk ingest. Every
+inbound message type is fixed-width, so a contiguous buffer of messages of one type is viewed
+in place as a NumPy array of a big-endian structured dtype derived from the message's Codec,
+and each field becomes a column which can be checked for every message in one operation.
+
+NumPy is optional. Without it, INBOUND is empty and messages are decoded one at a time by
+their Codec.
+"""
+import functools
+import itertools
+import re
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import src.codec as codecs
+
+
+# Bytes which are decoded as a blank (" ") single character field, as str.strip removes them.
+BLANK = bytes(i for i in range(128) if chr(i).isspace())
+
+# int -> stripped str, for single character fields, which are viewed as unsigned bytes.
+_CHAR_DECODED = codecs._TextMemo(lambda value: codecs._DECODED[bytes((value, ))])
+
+
+@functools.lru_cache(maxsize=None)
+def byte_table(allowed: bytes) -> "np.ndarray":
+    """
+    Returns a table of 256 booleans which are True at the values of the allowed bytes. Indexing
+    the table with a column of single character fields checks every field at once.
+    """
+    table = np.zeros(256, dtype=bool)
+    table[list(allowed)] = True
+    return table
+
+
+class BatchCodec:
+    """
+    BatchCodec
+
+    Decodes buffers of one fixed-width OUCH message type. Integer fields are viewed as
+    big-endian unsigned integers, single character fields (the header included) as unsigned
+    bytes, and longer text fields as raw bytes. Decoded messages are identical to those of the
+    message type's Codec.
+    """
+    # Dtype of each struct format code.
+    DTYPES = {
+        "c": "u1",
+        "I": ">u4",
+        "Q": ">u8"
+    }
+
+    def __init__(self, codec: codecs.Codec):
+        """:param codec: Codec of the message type, which the dtype and fields are taken from."""
+        self.header = codec.header
+        self.message_type = codec.message_type
+        self.names = codec.names
+
+        fields = []
+        for name, (count, code) in zip(codec.names, re.findall(r"(\d*)([a-zA-Z?])", codec.struct.format[1:])):
+            fields.append((name, "V" + count if code == "s" else self.DTYPES[code]))
+        self.dtype = np.dtype(fields)
+
+        # (name, how the column is converted) of each field in the body.
+        self.columns = []
+        for name, dtype in fields[1:]:
+            if dtype == "u1":
+                convert = "char"
+            elif dtype.startswith("V"):
+                convert = "text"
+            elif name in ("price", "execution_price"):
+                convert = "price"
+            else:
+                convert = None
+            self.columns.append((name, convert))
+
+    def unpack(self, array: "np.ndarray") -> list:
+        """
+        Unpacks an array of messages returned by decode into a list of dictionaries, in the
+        same form as Codec.unpack. Each field is converted a column at a time.
+        """
+        columns = [itertools.repeat(self.message_type, len(array))]
+        for name, convert in self.columns:
+            if convert == "char":
+                columns.append(list(map(_CHAR_DECODED.__getitem__, array[name].tolist())))
+            elif convert == "text":
+                columns.append(list(map(codecs._DECODED.__getitem__, array[name].tolist())))
+            elif convert == "price":
+                columns.append((array[name] / 10).tolist())
+            else:
+                columns.append(array[name].tolist())
+        names = self.names
+        return [dict(zip(names, values)) for values in zip(*columns)]
+
+    def decode(self, buffer) -> "np.ndarray":
+        """
+        Views a buffer of consecutive messages of this type, headers included, as an array
+        with one element per message. The buffer is not copied.
+
+        :raises ValueError: The buffer does not hold a whole number of messages, or holds a
+            message of another type.
+        """
+        if len(buffer) % self.dtype.itemsize != 0:
+            raise ValueError(f"Buffer of {len(buffer)} bytes does not hold whole '{self.message_type}' messages.")
+        array = np.frombuffer(buffer, dtype=self.dtype)
+        if (array["message_type"] != self.header[0]).any():
+            raise ValueError(f"Buffer holds messages other than '{self.message_type}'.")
+        return array
+
+
+# Batch codecs of the messages sent by clients to the exchange, keyed by header byte, or no
+# batch codecs if NumPy is not installed.
+INBOUND = {} if np is None else {header: BatchCodec(codec) for header, codec in codecs.INBOUND.items()}
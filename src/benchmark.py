@@ -0,0 +1,463 @@
+"""
+The OUCH Team
+Load Generator and Latency Benchmark
+
+Drives an exchange with many concurrent client sessions, each streaming a configurable mix of
+enter, replace and cancel orders at a target rate, and measures the round-trip latency of every
+order from when it was due to be sent until the exchange's response to it is received.
+Latencies are measured from the scheduled send time rather than the actual one, so that a
+stalled exchange (or sender) shows up as latency rather than as fewer, faster orders.
+
+Results are written as JSON, and can be compared against the results of a previous run to
+catch performance regressions between versions.
+"""
+import json
+import random
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+
+import src.codec as codecs
+from src.util import Util
+from src.framing import FrameReader
+from src.histogram import LatencyHistogram
+
+
+class OrderMix:
+    """
+    OrderMix
+
+    Generates the orders sent by each session. Prices are drawn in ticks of 0.1 around a mid
+    price, identically for bids and asks so that a share of orders cross and trade, and
+    orderbook IDs are drawn with Zipf-like weights so that a skew of 0 spreads orders evenly
+    and larger skews concentrate them on the lowest IDs.
+    """
+    ORDERBOOK_IDS = 4
+    PRICE_DISTRIBUTIONS = ("uniform", "normal")
+
+    def __init__(self, enter: float = 60, replace: float = 25, cancel: float = 15,
+            mid_price: float = 100.0, price_distribution: str = "uniform", price_spread: int = 20,
+            max_quantity: int = 100, skew: float = 0.0):
+        """
+        :param enter: Relative weight of enter orders.
+        :param replace: Relative weight of replace orders.
+        :param cancel: Relative weight of cancel orders.
+        :param mid_price: Price which order prices are drawn around.
+        :param price_distribution: "uniform" draws prices up to price_spread ticks either side
+            of the mid price, "normal" draws them with a standard deviation of price_spread ticks.
+        :param price_spread: Spread of prices around the mid price in ticks.
+        :param max_quantity: Quantities are drawn uniformly from 1 to max_quantity.
+        :param skew: Exponent of the orderbook ID weights 1/(id + 1)**skew.
+        """
+        if min(enter, replace, cancel) < 0 or enter <= 0:
+            raise ValueError("Order mix weights must not be negative, and enter orders must have a weight.")
+        if price_distribution not in self.PRICE_DISTRIBUTIONS:
+            raise ValueError(f"Unsupported price distribution {price_distribution}.")
+        if price_spread < 0 or max_quantity < 1:
+            raise ValueError("Price spread must not be negative, and maximum quantity must be positive.")
+        total = enter + replace + cancel
+        self.enter = enter / total
+        self.replace = replace / total
+        self.mid_ticks = round(mid_price * 10)
+        self.price_distribution = price_distribution
+        self.price_spread = price_spread
+        self.max_quantity = max_quantity
+        self.orderbook_weights = [1 / (i + 1)**skew for i in range(self.ORDERBOOK_IDS)]
+
+    def choose_type(self, rng: random.Random) -> str:
+        r = rng.random()
+        if r < self.enter:
+            return "O"
+        return "U" if r < self.enter + self.replace else "X"
+
+    def price(self, rng: random.Random) -> float:
+        if self.price_distribution == "uniform":
+            ticks = rng.randint(-self.price_spread, self.price_spread)
+        else:
+            ticks = round(rng.gauss(0, self.price_spread))
+        return max(self.mid_ticks + ticks, 1) / 10
+
+    def quantity(self, rng: random.Random) -> int:
+        return rng.randint(1, self.max_quantity)
+
+    def orderbook_id(self, rng: random.Random) -> int:
+        return rng.choices(range(self.ORDERBOOK_IDS), self.orderbook_weights)[0]
+
+    def to_dict(self) -> dict:
+        return {
+            "enter": self.enter,
+            "replace": self.replace,
+            "cancel": 1 - self.enter - self.replace,
+            "mid_price": self.mid_ticks / 10,
+            "price_distribution": self.price_distribution,
+            "price_spread": self.price_spread,
+            "max_quantity": self.max_quantity,
+            "orderbook_weights": self.orderbook_weights
+        }
+
+
+class BenchmarkSession:
+    """
+    BenchmarkSession
+
+    One client connection, with a thread sending orders on schedule and a thread receiving
+    the exchange's responses. Every response to an order carries the order token the order
+    was sent with (the replacement token for a replace), which pairs it with its order.
+
+    The session keeps its own view of which of its orders are live, from the responses and
+    executions it receives, and only replaces and cancels live orders. An order can still
+    be filled by another session while a replace or cancel of it is on its way, in which case
+    the exchange ignores the replace or cancel and it is counted as unanswered.
+    """
+    # {header: body length} of every message the exchange sends to clients.
+    OUTBOUND_BODY_LENGTH_DICT = {header: codec.body_size for header, codec in codecs.OUTBOUND.items()}
+
+    # Offset of the order token in the body of every response.
+    TOKEN = struct.Struct("!I")
+    TOKEN_OFFSET = 8
+
+    def __init__(self, addr: tuple, mix: OrderMix, rate: float, seed: int):
+        """
+        :param addr: Address of the exchange.
+        :param mix: Orders to send.
+        :param rate: Orders to send per second.
+        :param seed: Seed of the session's random number generator.
+        """
+        self.mix = mix
+        self.interval_ns = int(1e9 / rate)
+        self.rng = random.Random(seed)
+        self.socket = socket.create_connection(addr)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = FrameReader(self.socket, self.OUTBOUND_BODY_LENGTH_DICT)
+
+        # The exchange acknowledges the connection with a system event.
+        header, _ = self.reader.read_frames()[0]
+        if header != b'S':
+            raise ConnectionError(f"Expected a system event from the exchange, got {header}.")
+
+        self.next_token = 1
+        # {response token: (message type, scheduled send time)} of orders awaiting a response.
+        self.pending = {}
+        # Tokens and remaining quantities of live orders, with the position of each token in
+        # live_tokens so that a random live order can be taken in constant time.
+        self.live_tokens = []
+        self.live = {}
+        self.positions = {}
+        self.lock = threading.Lock()
+
+        self.histograms = {msg_type: LatencyHistogram() for msg_type in ("O", "U", "X")}
+        self.sent = {msg_type: 0 for msg_type in ("O", "U", "X")}
+        self.received = {}
+        # perf_counter_ns time of the last response to an order.
+        self.last_response_ns = 0
+        self.stopped = threading.Event()
+        self.sender = None
+        self.receiver = None
+
+    def start(self, start_ns: int, end_ns: int):
+        """Starts sending orders at start_ns on the perf_counter_ns clock, until end_ns."""
+        self.sender = threading.Thread(
+            name = "benchmark-sender",
+            target = lambda: self._send_thread(start_ns, end_ns),
+            daemon = True
+        )
+        self.receiver = threading.Thread(
+            name = "benchmark-receiver",
+            target = lambda: self._receive_thread(),
+            daemon = True
+        )
+        self.receiver.start()
+        self.sender.start()
+
+    def join(self):
+        """Waits for the sender to send its last order."""
+        self.sender.join()
+
+    def stop(self, deadline: float):
+        """
+        Waits until every response has been received, or until the deadline on the monotonic
+        clock, then closes the connection.
+        """
+        while self.pending and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.stopped.set()
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.receiver.join()
+        self.socket.close()
+
+    def _send_thread(self, start_ns: int, end_ns: int):
+        rng = self.rng
+        mix = self.mix
+        scheduled = start_ns
+        while scheduled < end_ns:
+            delay = scheduled - time.perf_counter_ns()
+            if delay > 0:
+                time.sleep(delay / 1e9)
+            msg_type = mix.choose_type(rng)
+            with self.lock:
+                existing = self._take_live() if msg_type != "O" else None
+                if existing is None:
+                    msg_type = "O"
+                token = self.next_token
+                if msg_type != "X":
+                    self.next_token += 1
+                self.pending[token if msg_type != "X" else existing] = (msg_type, scheduled)
+            if msg_type == "O":
+                indicator = "B" if rng.random() < 0.5 else "S"
+                message = Util.package(["O", token, "benchmark ", indicator, mix.quantity(rng),
+                    mix.orderbook_id(rng), "DAY ", mix.price(rng), 99999, 0, "P", "P", 0, "1", "1"])
+            elif msg_type == "U":
+                message = Util.package(["U", existing, token, mix.quantity(rng), mix.price(rng),
+                    99999, "P", 0])
+            else:
+                message = Util.package(["X", existing, 0])
+            try:
+                self.socket.sendall(message)
+            except OSError:
+                return
+            self.sent[msg_type] += 1
+            scheduled += self.interval_ns
+
+    def _receive_thread(self):
+        unpack_token = self.TOKEN.unpack_from
+        offset = self.TOKEN_OFFSET
+        while not self.stopped.is_set():
+            try:
+                frames = self.reader.read_frames()
+            except (ConnectionError, OSError, ValueError):
+                return
+            now = time.perf_counter_ns()
+            with self.lock:
+                for header, body in frames:
+                    self.received[header] = self.received.get(header, 0) + 1
+                    if header == b'S':
+                        continue
+                    token, = unpack_token(body, offset)
+                    if header == b'E':
+                        self._on_execution(token, Util.unpackage(header, body))
+                        continue
+                    request = self.pending.pop(token, None)
+                    if request is not None:
+                        self.histograms[request[0]].record(now - request[1])
+                        self.last_response_ns = now
+                    if header == b'A' or header == b'U':
+                        content = Util.unpackage(header, body)
+                        if content["order_state"] == "L":
+                            self._add_live(token, content["quantity"])
+
+    def _on_execution(self, token: int, content: dict):
+        quantity = self.live.get(token)
+        if quantity is None:
+            return
+        quantity -= content["executed_quantity"]
+        if quantity > 0:
+            self.live[token] = quantity
+        else:
+            self._remove_live(token)
+
+    def _add_live(self, token: int, quantity: int):
+        self.live[token] = quantity
+        self.positions[token] = len(self.live_tokens)
+        self.live_tokens.append(token)
+
+    def _take_live(self):
+        """Removes a random live order from the live orders and returns its token."""
+        if not self.live_tokens:
+            return None
+        token = self.live_tokens[self.rng.randrange(len(self.live_tokens))]
+        self._remove_live(token)
+        return token
+
+    def _remove_live(self, token: int):
+        del self.live[token]
+        # Move the last token into the removed token's place.
+        tokens = self.live_tokens
+        index = self.positions.pop(token)
+        last = tokens.pop()
+        if last != token:
+            tokens[index] = last
+            self.positions[last] = index
+
+
+class Benchmark:
+    """
+    Benchmark
+
+    Runs a number of sessions against an exchange for a fixed duration, either against an
+    exchange server which is already running or against an ouch_server.py process started
+    and stopped by the benchmark itself.
+    """
+    # class constant: message types measured, with the name they are reported under.
+    MESSAGE_TYPES = {"O": "enter", "U": "replace", "X": "cancel"}
+
+    # Seconds to wait for a started server to accept connections.
+    SERVER_START_TIMEOUT = 10.0
+
+    def __init__(self, sessions: int, rate: float, duration: float, mix: OrderMix,
+            drain_timeout: float = 2.0, seed: int = 0, server_args: list = None):
+        """
+        :param sessions: Number of concurrent client sessions.
+        :param rate: Total orders per second, split evenly across the sessions.
+        :param duration: Seconds to send orders for.
+        :param mix: Orders to send.
+        :param drain_timeout: Seconds to wait for outstanding responses after sending stops.
+        :param seed: Seed of the sessions' random number generators.
+        :param server_args: Arguments of an ouch_server.py process to start for the benchmark,
+            or None to use an exchange which is already running.
+        :raises ValueError: If the server arguments select the session receiver, which the
+            benchmark's raw OUCH sessions cannot log in to.
+        """
+        if sessions < 1 or rate <= 0 or duration <= 0:
+            raise ValueError("Sessions, rate and duration must be positive.")
+        if server_args is not None and "session" in server_args:
+            raise ValueError("The benchmark sends raw OUCH and cannot log in to the session receiver.")
+        self.sessions = sessions
+        self.rate = rate
+        self.duration = duration
+        self.mix = mix
+        self.drain_timeout = drain_timeout
+        self.seed = seed
+        self.server_args = server_args
+
+    def run(self) -> dict:
+        """Runs the benchmark and returns its results."""
+        server = self._start_server() if self.server_args is not None else None
+        try:
+            addr = Util.get_addr()
+            sessions = [
+                BenchmarkSession(addr, self.mix, self.rate / self.sessions, self.seed + i)
+                for i in range(self.sessions)
+            ]
+            # Stagger the sessions' schedules so that they don't all send at the same instant.
+            start_ns = time.perf_counter_ns() + 100_000_000
+            end_ns = start_ns + int(self.duration * 1e9)
+            stagger = int(1e9 / self.rate)
+            for i, session in enumerate(sessions):
+                session.start(start_ns + i*stagger, end_ns)
+            for session in sessions:
+                session.join()
+            deadline = time.monotonic() + self.drain_timeout
+            for session in sessions:
+                session.stop(deadline)
+            # Time from the first order being due until the last response.
+            elapsed = (max(session.last_response_ns for session in sessions) - start_ns) / 1e9
+        finally:
+            if server is not None:
+                self._stop_server(server)
+        return self._results(sessions, elapsed)
+
+    def _results(self, sessions: list, elapsed: float) -> dict:
+        histograms = {msg_type: LatencyHistogram() for msg_type in self.MESSAGE_TYPES}
+        total = LatencyHistogram()
+        sent = dict.fromkeys(self.MESSAGE_TYPES, 0)
+        received = {}
+        unanswered = 0
+        for session in sessions:
+            for msg_type, histogram in session.histograms.items():
+                histograms[msg_type].merge(histogram)
+                total.merge(histogram)
+                sent[msg_type] += session.sent[msg_type]
+            for header, count in session.received.items():
+                received[header.decode()] = received.get(header.decode(), 0) + count
+            unanswered += len(session.pending)
+
+        latency = {self.MESSAGE_TYPES[msg_type]: histogram.to_dict() for msg_type, histogram in histograms.items()}
+        latency["all"] = total.to_dict()
+        return {
+            "version": self.version(),
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "config": {
+                "sessions": self.sessions,
+                "rate": self.rate,
+                "duration": self.duration,
+                "seed": self.seed,
+                "server_args": self.server_args,
+                "mix": self.mix.to_dict()
+            },
+            "elapsed": elapsed,
+            "sent": {self.MESSAGE_TYPES[msg_type]: count for msg_type, count in sent.items()},
+            "received": received,
+            "unanswered": unanswered,
+            "throughput": {
+                "sent": sum(sent.values()) / self.duration,
+                "answered": total.count / elapsed
+            },
+            "latency_ns": latency
+        }
+
+    def _start_server(self) -> subprocess.Popen:
+        server = subprocess.Popen([sys.executable, "ouch_server.py"] + self.server_args, stdin=subprocess.PIPE)
+        deadline = time.monotonic() + self.SERVER_START_TIMEOUT
+        while True:
+            if server.poll() is not None:
+                raise RuntimeError(f"The exchange server exited with code {server.returncode}.")
+            try:
+                socket.create_connection(Util.get_addr()).close()
+                return server
+            except OSError:
+                if time.monotonic() > deadline:
+                    self._stop_server(server)
+                    raise RuntimeError("The exchange server did not start accepting connections.")
+                time.sleep(0.1)
+
+    @staticmethod
+    def _stop_server(server: subprocess.Popen):
+        # The server terminates when the enter key is pressed.
+        try:
+            server.communicate(b"\n", timeout=10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+            server.wait()
+
+    @staticmethod
+    def version():
+        """Returns the git commit being benchmarked, if known."""
+        try:
+            return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True,
+                text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    @staticmethod
+    def save(results: dict, path: str):
+        with open(path, "w") as f:
+            json.dump(results, f, indent=4)
+
+    @staticmethod
+    def load(path: str) -> dict:
+        with open(path, "r") as f:
+            return json.load(f)
+
+    @staticmethod
+    def compare(results: dict, baseline: dict, tolerance: float = 0.1) -> list:
+        """
+        Compares results against the results of a baseline run.
+
+        :param tolerance: Fraction by which a latency percentile may rise, or throughput fall,
+            before it counts as a regression.
+        :returns: List of (metric, baseline value, value, relative change, regressed) tuples.
+        """
+        comparison = []
+        for metric in ("sent", "answered"):
+            old = baseline["throughput"][metric]
+            new = results["throughput"][metric]
+            change = (new - old) / old if old else 0.0
+            comparison.append((f"throughput.{metric}", old, new, change, change < -tolerance))
+        for name, latency in results["latency_ns"].items():
+            old_latency = baseline["latency_ns"].get(name)
+            if old_latency is None or latency["count"] == 0 or old_latency["count"] == 0:
+                continue
+            for percentile in LatencyHistogram.PERCENTILES:
+                key = f"p{percentile}"
+                old = old_latency[key]
+                new = latency[key]
+                change = (new - old) / old if old else 0.0
+                comparison.append((f"latency.{name}.{key}", old, new, change, change > tolerance))
+        return comparison
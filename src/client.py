@@ -6,12 +6,18 @@ Client
 Client for connecting to the receiver.
 """
 import socket
+import struct
 import threading
+import time
+from collections import deque
 from queue import Queue
 import json
 import configparser
 
 from src.util import Util
+from src.framing import FrameReader
+from src.session import SessionClient
+from src.shm_gateway import ShmClient
 
 class Client():
     """
@@ -39,12 +45,29 @@ class Client():
     }
 
 
-    def __init__(self, path=None):
+    def __init__(self, path=None, username=None, sequence=0, shm=False):
         """
         Prepare the client connection.
+
+        :param username: Username to log in to a sequenced session with (see SessionClient),
+            or None to connect to a receiver without sessions.
+        :param sequence: Sequence number of the first reply to receive in a session.
+        :param shm: Whether to connect through the exchange's shared memory gateway (see
+            ShmClient) rather than TCP.
         """
         # Connect to the receiver.
-        self.socket = self._connect()
+        self.session = None
+        self.shm = None
+        if shm:
+            self.shm = ShmClient()
+            print(f"Connected over shared memory as client_id {self.shm.client_id}")
+        elif username is None:
+            self.socket = self._connect()
+            self.reader = FrameReader(self.socket, self.BODY_LENGTH_DICT)
+        else:
+            self.session = SessionClient(username, sequence=sequence)
+            print(f"Logged in to session {self.session.session} as {username}, "
+                f"from sequence number {self.session.next_sequence}")
 
         # Queue for receiving messages from the exchange.
         self.queue = Queue()
@@ -61,17 +84,7 @@ class Client():
         self.listener.start()
 
         # Take and parse user input, then send to the exchange.
-        actions = []
-        if path != None:
-            with open(path, "r") as json_f:
-                data = json.load(json_f)
-                for action in data["actions"]:
-                    actions.append(list(action.values()))
-        # Convert all input numbers into unsigned 4-byte integers.
-        for action in actions:
-            for i in range(len(action)):
-                if isinstance(action[i], int):
-                    action[i] = Util.unsigned_int(action[i])
+        actions = deque(self.load_actions(path) if path != None else ())
 
         while True:
             try:
@@ -80,7 +93,7 @@ class Client():
                     return
                     package = self.user_input()
                 else:
-                    action = actions.pop(0)
+                    action = actions.popleft()
                     print("Sending: " + str(action))
                     package = Util.package(action)
                 self._sendBytestream(package[0:1], package[1:])
@@ -90,43 +103,54 @@ class Client():
             except KeyboardInterrupt:
                 self.terminated.set()
                 print("Client Main Thread Interrupted")
-                self.socket.close()
+                self._close()
                 break
-            except ConnectionResetError:
+            except ConnectionError:
                 print("Server Disconnected")
-                self.socket.close()
+                self._close()
                 break
     
+    @staticmethod
+    def load_actions(path: str) -> list:
+        """
+        Reads the actions of a client input JSON file (see test_inputs) as lists of field
+        values, with every number converted into an unsigned 4-byte integer.
+        """
+        with open(path, "r") as json_f:
+            data = json.load(json_f)
+        actions = []
+        for action in data["actions"]:
+            action = list(action.values())
+            for i in range(len(action)):
+                if isinstance(action[i], int):
+                    action[i] = Util.unsigned_int(action[i])
+            actions.append(action)
+        return actions
+
     def _listen_thread(self):
         while not self.terminated.is_set():
             self._listen()
         print("Client listener thread terminating.")
     
     def _listen(self):
-        header, body = self._receive_bytes()
-        msg_dict = Util.unpackage(header, body)
-        print("Exchange: " + json.dumps(
-            msg_dict,
-            indent = 4,
-            separators = (",", ": ")
-        ) + "\n")
-
-    def _receive_bytes(self):
-        # Store header byte
-        header = self.socket.recv(1)
-
-        # Calculates expected size of body, using bodyLengthDict
-        body_length = 0
-        if header in self.BODY_LENGTH_DICT.keys():
-            body_length = self.BODY_LENGTH_DICT[header]
-        else:
-            raise ValueError(f"Invalid header type '{header}'")
+        for header, body in self._receive_bytes():
+            msg_dict = Util.unpackage(header, body)
+            print("Exchange: " + json.dumps(
+                msg_dict,
+                indent = 4,
+                separators = (",", ": ")
+            ) + "\n")
 
-        # grab body,
-        body = self.socket.recv(body_length) if body_length != 0 else 0x00
-
-        # output
-        return header, body
+    def _receive_bytes(self) -> list:
+        """
+        Returns every complete message received from the exchange as (header, body) pairs,
+        blocking until there is at least one.
+        """
+        if self.session is not None:
+            return self.session.read_frames()
+        if self.shm is not None:
+            return self.shm.read_frames()
+        return self.reader.read_frames()
     
     def _sendBytestream(self, header: bytes, body: bytes):
         """
@@ -147,7 +171,20 @@ class Client():
         msg = header + body
 
         # Sends byte to port
-        self.socket.sendall(msg)
+        if self.session is not None:
+            self.session.send(SessionClient.wrap([msg]))
+        elif self.shm is not None:
+            self.shm.send(msg)
+        else:
+            self.socket.sendall(msg)
+
+    def _close(self):
+        if self.session is not None:
+            self.session.close()
+        elif self.shm is not None:
+            self.shm.shutdown()
+        else:
+            self.socket.close()
 
     def _connect(self):
         config = configparser.ConfigParser()
@@ -156,4 +193,214 @@ class Client():
         port = config['DEFAULT']['port']
         print("Connecting on address " + str((host, port)))
         self.socket = socket.create_connection((host, port))
-        return self.socket
\ No newline at end of file
+        return self.socket
+
+class ScriptedClient():
+    """
+    ScriptedClient
+
+    Non-interactive client which sends a whole sequence of actions to the exchange without
+    waiting for any input or response. Every action is converted to bytes before anything is
+    sent, and then the actions are pipelined to the exchange, either as fast as the connection
+    allows or at a paced rate, while a listener thread collects the exchange's responses.
+
+    Responses are matched to the actions which caused them by order token, and the latency of
+    each action is recorded from when it was sent (or due to be sent, when paced) until its
+    response arrived. Actions which the exchange ignores, such as a cancel of an unknown
+    token, are left without a response.
+    """
+    # Messages sent as one send call when sending as fast as possible.
+    SEND_CHUNK = 64
+
+    # Offset of the order token in the body of every response.
+    TOKEN = struct.Struct("!I")
+    TOKEN_OFFSET = 8
+
+    def __init__(self, actions: list, rate: float = None, verbose: bool = False, username: str = None, sequence: int = 0, shm: bool = False):
+        """
+        Connects to the exchange and converts every action to bytes.
+
+        :param actions: Actions as lists of field values (see Client.load_actions).
+        :param rate: Actions to send per second, or None to send them as fast as possible.
+        :param verbose: Whether to print every response from the exchange.
+        :param username: Username to log in to a sequenced session with (see SessionClient),
+            or None to connect to a receiver without sessions. A session logs in again if the
+            connection is lost, and receives the responses sent meanwhile.
+        :param sequence: Sequence number of the first response to receive in a session.
+        :param shm: Whether to connect through the exchange's shared memory gateway (see
+            ShmClient) rather than TCP.
+        """
+        if rate is not None and rate <= 0:
+            raise ValueError(f"Rate must be positive, not {rate}.")
+        self.rate = rate
+        self.verbose = verbose
+        self.messages = [Util.package(action) for action in actions]
+
+        # One record per action, in order:
+        # {"message_type", "order_token", "response", "latency_ns"}, where the response type
+        # and latency are None until a response arrives.
+        self.requests = []
+        # {(token, response header): deque of indices of requests awaiting that response}
+        self.pending = {}
+        for index, message in enumerate(self.messages):
+            content = Util.unpackage(message[0:1], message[1:])
+            if content["message_type"] == "O":
+                token = content["order_token"]
+                responses = ((token, b'A'), (token, b'J'))
+            elif content["message_type"] == "U":
+                token = content["replacement_order_token"]
+                # A replace which is not valid is answered by cancelling the existing order.
+                responses = ((token, b'U'), (content["existing_order_token"], b'C'))
+            else:
+                token = content["order_token"]
+                responses = ((token, b'C'), )
+            self.requests.append({
+                "message_type": content["message_type"],
+                "order_token": token,
+                "response": None,
+                "latency_ns": None
+            })
+            for response in responses:
+                self.pending.setdefault(response, deque()).append(index)
+        self.sent_ns = [0]*len(self.messages)
+        self.unanswered = len(self.messages)
+
+        # Every message received from the exchange as (perf_counter_ns, header, body).
+        self.responses = []
+        self.lock = threading.Lock()
+        self.answered = threading.Condition(self.lock)
+
+        # The bytes sent for each action, and the functions which send them and receive
+        # responses, from the session, the shared memory rings or straight from the connection.
+        self.session = None
+        self.shm = None
+        if shm:
+            self.shm = ShmClient()
+            self.wire = self.messages
+            self.sendall = self.shm.sendall
+            self.read_frames = self.shm.read_frames
+        elif username is None:
+            addr = Util.get_addr()
+            self.socket = socket.create_connection(addr)
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.reader = FrameReader(self.socket, Client.BODY_LENGTH_DICT)
+            self.wire = self.messages
+            self.sendall = self.socket.sendall
+            self.read_frames = self.reader.read_frames
+        else:
+            self.session = SessionClient(username, sequence=sequence)
+            self.wire = [SessionClient.wrap([message]) for message in self.messages]
+            self.sendall = self.session.send
+            self.read_frames = self.session.read_frames
+        self.listener = threading.Thread(
+            name = "listener",
+            target = lambda: self._listen_thread(),
+            daemon = True
+        )
+        self.listener.start()
+
+    def run(self, timeout: float = 5.0) -> list:
+        """
+        Sends every action, then waits until every action has been answered or no response
+        has arrived for timeout seconds, and closes the connection.
+
+        :returns: The request records (see __init__).
+        """
+        self.send()
+        self.wait(timeout)
+        self.close()
+        return self.requests
+
+    def send(self):
+        """Sends every action to the exchange."""
+        messages = self.wire
+        sent_ns = self.sent_ns
+        if self.rate is None:
+            for start in range(0, len(messages), self.SEND_CHUNK):
+                end = min(start + self.SEND_CHUNK, len(messages))
+                now = time.perf_counter_ns()
+                for index in range(start, end):
+                    sent_ns[index] = now
+                self.sendall(b"".join(messages[start:end]))
+        else:
+            interval = int(1e9 / self.rate)
+            scheduled = time.perf_counter_ns()
+            for index, message in enumerate(messages):
+                delay = scheduled - time.perf_counter_ns()
+                if delay > 0:
+                    time.sleep(delay / 1e9)
+                sent_ns[index] = scheduled
+                self.sendall(message)
+                scheduled += interval
+
+    def wait(self, timeout: float = 5.0) -> bool:
+        """
+        Waits until every action has been answered, or no response has arrived for timeout
+        seconds.
+
+        :returns: Whether every action has been answered.
+        """
+        with self.answered:
+            while self.unanswered > 0:
+                received = len(self.responses)
+                self.answered.wait(timeout)
+                if len(self.responses) == received:
+                    break
+            return self.unanswered == 0
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+            self.listener.join()
+            return
+        if self.shm is not None:
+            self.shm.shutdown()
+            self.listener.join()
+            self.shm.close()
+            return
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.listener.join()
+        self.socket.close()
+
+    def get_responses(self) -> list:
+        """Returns every message received from the exchange so far, decoded, in order."""
+        with self.lock:
+            return [Util.unpackage(header, body) for _, header, body in self.responses]
+
+    def _listen_thread(self):
+        unpack_token = self.TOKEN.unpack_from
+        offset = self.TOKEN_OFFSET
+        while True:
+            try:
+                frames = self.read_frames()
+            except (ConnectionError, OSError, ValueError):
+                break
+            now = time.perf_counter_ns()
+            with self.lock:
+                for header, body in frames:
+                    self.responses.append((now, header, body))
+                    # Executions and system events are not responses to an action.
+                    if header != b'E' and header != b'S':
+                        self._match(unpack_token(body, offset)[0], header, now)
+                self.answered.notify_all()
+            if self.verbose:
+                for header, body in frames:
+                    print("Exchange: " + json.dumps(Util.unpackage(header, body)))
+        with self.lock:
+            self.answered.notify_all()
+
+    def _match(self, token: int, header: bytes, now: int):
+        """Matches a response to the earliest unanswered action awaiting it."""
+        waiting = self.pending.get((token, header))
+        while waiting:
+            index = waiting.popleft()
+            request = self.requests[index]
+            # Skip actions which were already answered by their other possible response.
+            if request["response"] is None:
+                request["response"] = header.decode()
+                request["latency_ns"] = now - self.sent_ns[index]
+                self.unanswered -= 1
+                return
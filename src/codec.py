@@ -0,0 +1,219 @@
+"""
+The OUCH Team
+Message Codecs
+
+Precompiled encoders/decoders for every OUCH message type supported by the exchange. Each
+message type has one Codec holding a struct.Struct compiled once at import, and codecs are
+looked up through tables keyed by header byte instead of an if/elif chain.
+"""
+import re
+import struct
+
+
+class _TextMemo(dict):
+    """
+    Memoises text conversions across messages, as most text fields (indicators, groups, client
+    references) only take a handful of distinct values. A hit is a plain dictionary subscript;
+    a miss converts the value and remembers it while the memo holds fewer than TEXT_MEMO_SIZE
+    values.
+    """
+    def __init__(self, convert):
+        super().__init__()
+        self.convert = convert
+
+    def __missing__(self, value):
+        converted = self.convert(value)
+        if len(self) < TEXT_MEMO_SIZE:
+            self[value] = converted
+        return converted
+
+
+TEXT_MEMO_SIZE = 4096
+
+# str -> ascii bytes. Bytes are passed through unchanged.
+_ENCODED = _TextMemo(lambda value: value if isinstance(value, bytes) else bytes(value, encoding="ascii"))
+
+# bytes -> stripped str. Empty fields become a single space.
+_DECODED = _TextMemo(lambda value: value.decode("ascii").strip() or " ")
+
+
+class Codec:
+    """
+    Codec
+
+    Packs and unpacks one fixed-width OUCH message type. The struct is compiled once, along
+    with the positions of the fields which must be converted (text fields and the price), so
+    packing and unpacking a message only converts those fields and zips the values with the
+    field names.
+
+    Messages are packed into new bytes objects rather than into a reusable buffer, as every
+    reply is kept as bytes after it is sent (in the journal, the session replay history and
+    the shared memory rings), and a client's replies are joined into one send anyway. unpack_from
+    reads a message at an offset in a larger buffer, as the market data listener does.
+    """
+    def __init__(self, header: bytes, names: tuple, format_s: str, encode_price: bool = False):
+        """
+        :param header: Header byte of the message type.
+        :param names: Field names of the message body, in order, excluding the message type.
+        :param format_s: Big-endian struct format of the whole message, starting with the header.
+        :param encode_price: Whether the price field is passed to pack as a decimal which must be
+            converted to an integer (price*10).
+        """
+        self.header = header
+        self.message_type = header.decode("ascii")
+        self.names = ("message_type", ) + names
+        self.struct = struct.Struct(format_s)
+        self.body_struct = struct.Struct("!" + format_s[2:])
+        self.size = self.struct.size
+        self.body_size = self.body_struct.size
+
+        # Indices of fields in the whole message (header included) which are bytes.
+        codes = re.findall(r"\d*([a-zA-Z?])", format_s[1:])
+        self.text_fields = tuple(i for i, code in enumerate(codes) if code in ("c", "s"))
+        # The header is decoded from the codec rather than from the message.
+        self.body_text_fields = self.text_fields[1:]
+
+        # Index of the price field in the whole message (header included), or None.
+        self.price_field = None
+        for price_name in ("price", "execution_price"):
+            if price_name in self.names:
+                self.price_field = self.names.index(price_name)
+        self.encode_price = encode_price and self.price_field is not None
+
+    def pack(self, fields) -> bytes:
+        """
+        Packs a sequence of fields (header included) into bytes. String fields are encoded as
+        ascii, and the price is converted to an integer if encode_price is set.
+        """
+        values = list(fields)
+        for i in self.text_fields:
+            values[i] = _ENCODED[values[i]]
+        if self.encode_price:
+            values[self.price_field] = int(values[self.price_field]*10)
+        return self.struct.pack(*values)
+
+    def unpack_from(self, buffer, offset: int = 0) -> dict:
+        """
+        Unpacks the body of a message (header excluded) starting at offset in a buffer into a
+        dictionary. Text fields are decoded and stripped (empty fields become a single space)
+        and the price is converted to a decimal.
+        """
+        values = [self.message_type, *self.body_struct.unpack_from(buffer, offset)]
+        for i in self.body_text_fields:
+            values[i] = _DECODED[values[i]]
+        if self.price_field is not None:
+            values[self.price_field] /= 10
+        return dict(zip(self.names, values))
+
+    def unpack(self, body) -> dict:
+        """Unpacks the body of a message (header excluded) into a dictionary."""
+        return self.unpack_from(body, 0)
+
+
+ENTER_ORDER = Codec(b'O', (
+    "order_token",
+    "client_reference",
+    "buy_sell_indicator",
+    "quantity",
+    "orderbook_id",
+    "group",
+    "price",
+    "time_in_force",
+    "firm_id",
+    "display",
+    "capacity",
+    "minimum_quantity",
+    "order_classification",
+    "cash_margin_type"
+), "!cI10scII4sIIIccIcc", encode_price=True)
+
+REPLACE_ORDER = Codec(b'U', (
+    "existing_order_token",
+    "replacement_order_token",
+    "quantity",
+    "price",
+    "time_in_force",
+    "display",
+    "minimum_quantity"
+), "!cIIIIIcI", encode_price=True)
+
+CANCEL_ORDER = Codec(b'X', (
+    "order_token",
+    "quantity"
+), "!cII")
+
+SYSTEM_EVENT = Codec(b'S', (
+    "timestamp",
+    "system_event"
+), "!cQc")
+
+ORDER_ACCEPTED = Codec(b'A', (
+    "timestamp",
+    "order_token",
+    "client_reference",
+    "buy_sell_indicator",
+    "quantity",
+    "orderbook_id",
+    "group",
+    "price",
+    "time_in_force",
+    "firm_id",
+    "display",
+    "capacity",
+    "order_number",
+    "minimum_quantity",
+    "order_state",
+    "order_classification",
+    "cash_margin_type"
+), "!cQI10scII4sIIIccQIccc")
+
+ORDER_REPLACED = Codec(b'U', (
+    "timestamp",
+    "replacement_order_token",
+    "buy_sell_indicator",
+    "quantity",
+    "orderbook_id",
+    "group",
+    "price",
+    "time_in_force",
+    "display",
+    "order_number",
+    "minimum_quantity",
+    "order_state",
+    "previous_order_token"
+), "!cQIcII4sIIcQIcI", encode_price=True)
+
+ORDER_CANCELLED = Codec(b'C', (
+    "timestamp",
+    "order_token",
+    "decrement_quantity",
+    "order_cancelled_reason"
+), "!cQIIc")
+
+ORDER_EXECUTED = Codec(b'E', (
+    "timestamp",
+    "order_token",
+    "executed_quantity",
+    "execution_price",
+    "liquidity_flag",
+    "match_number"
+), "!cQIIIcQ")
+
+ORDER_REJECTED = Codec(b'J', (
+    "timestamp",
+    "order_token",
+    "order_rejected_reason"
+), "!cQIc")
+
+# Messages sent by clients to the exchange, keyed by header byte.
+INBOUND = {codec.header: codec for codec in (ENTER_ORDER, REPLACE_ORDER, CANCEL_ORDER)}
+
+# Messages sent by the exchange to clients, keyed by header byte.
+OUTBOUND = {codec.header: codec for codec in (
+    SYSTEM_EVENT,
+    ORDER_ACCEPTED,
+    ORDER_REPLACED,
+    ORDER_CANCELLED,
+    ORDER_EXECUTED,
+    ORDER_REJECTED
+)}
@@ -132,16 +132,15 @@ class Console:
     """
     def print (self):
         
-        # Reconstruct table as single double array
+        # Reconstruct table as single double array, copying each row so the book is left unchanged
         singleTable = []
         for priceGroup in self.internalBook:
-            singleTable += self.internalBook[priceGroup]
-
-        # Processing order status
-        for order in singleTable:
+            for order in self.internalBook[priceGroup]:
 
-            # Process symbol
-            order[3] = self.SYMBOLS[str(order[3])]
+                # Process symbol
+                row = list(order)
+                row[3] = self.SYMBOLS[str(order[3])]
+                singleTable.append(row)
 
         
         # Clear and resize cmd/terminal window
@@ -150,4 +149,109 @@ class Console:
         os.system(self.CMD_LIST["TITLE"][sys.platform].format("Current Time: " + datetime.now().strftime("%Y-%m-%d %H:%M:%S (Server Timestamp " + str(Util.get_server_time())) + ")"))
         
         # Print!
-        print(tabulate(singleTable, headers = ["Indicator", "Price", "Quantity", "Symbol", "Time in Force", "Time Received", "Order ID", "Order Token", "Order Status"]))    
\ No newline at end of file
+        print(tabulate(singleTable, headers = ["Indicator", "Price", "Quantity", "Symbol", "Time in Force", "Time Received", "Order ID", "Order Token", "Order Status"]))    
+
+class DepthRenderer:
+    """
+    DepthRenderer
+
+    Draws the aggregated depth of every instrument (the top levels of each side, as returned
+    by OrderBook.get_depth) using ANSI escape sequences rather than shell commands. Each frame
+    is compared line by line with the frame drawn before it, and only the lines which changed
+    are redrawn, so an idle orderbook costs one line per second (the clock).
+
+    The renderer only reads the depth snapshot it is given, so the orderbook lock is only
+    needed while the snapshot is taken, not while it is drawn.
+    """
+    # class constant: default number of levels shown on each side of each instrument.
+    LEVELS = 10
+
+    # class constant: number of connection log entries shown below the depth.
+    CONNECTION_LOG_LINES = 5
+
+    # class constants: ANSI escape sequences.
+    CLEAR_SCREEN = "\x1b[2J"
+    MOVE_TO_LINE = "\x1b[{};1H"
+    CLEAR_TO_END_OF_LINE = "\x1b[K"
+    HIDE_CURSOR = "\x1b[?25l"
+    SHOW_CURSOR = "\x1b[?25h"
+    SET_TITLE = "\x1b]0;{}\x07"
+
+    ROW = "{:>8} {:>12} {:>12} | {:<12} {:<12} {:<8}"
+
+    def __init__(self, levels: int = LEVELS, out = None):
+        """
+        :param levels: Number of levels shown on each side of each instrument.
+        :param out: Text stream to draw on, sys.stdout by default.
+        """
+        if levels < 1:
+            raise ValueError(f"Number of levels {levels} must be at least 1.")
+        self.levels = levels
+        self.out = out if out is not None else sys.stdout
+
+        # Lines of the frame currently on the screen, or None if the screen must be redrawn.
+        self.lines = None
+
+        # Windows consoles only interpret escape sequences after a console mode change, which
+        # running any command does.
+        if sys.platform == "win32":
+            os.system("")
+
+    def render(self, depth: dict, connection_log: list = ()):
+        """
+        Draws a frame, redrawing only the lines which differ from the previous frame.
+
+        :param depth: {orderbook_id: (bids, asks)} as returned by OrderBook.get_depth.
+        :param connection_log: Recent connection log entries to show below the depth.
+        """
+        lines = self._format(depth, connection_log)
+        previous = self.lines
+        output = []
+        if previous is None:
+            output.append(self.HIDE_CURSOR + self.CLEAR_SCREEN)
+            previous = []
+        output.append(self.SET_TITLE.format(lines[0]))
+        for i, line in enumerate(lines):
+            if i >= len(previous) or previous[i] != line:
+                output.append(self.MOVE_TO_LINE.format(i + 1) + line + self.CLEAR_TO_END_OF_LINE)
+        # Clear lines left over from a longer previous frame.
+        for i in range(len(lines), len(previous)):
+            output.append(self.MOVE_TO_LINE.format(i + 1) + self.CLEAR_TO_END_OF_LINE)
+        output.append(self.MOVE_TO_LINE.format(len(lines) + 1))
+        self.out.write("".join(output))
+        self.out.flush()
+        self.lines = lines
+
+    def reset(self):
+        """Redraws the whole screen on the next frame, such as after other output."""
+        self.lines = None
+
+    def close(self):
+        """Shows the cursor again."""
+        self.out.write(self.SHOW_CURSOR)
+        self.out.flush()
+
+    def _format(self, depth: dict, connection_log: list) -> list:
+        """Returns the lines of a frame."""
+        lines = [
+            "Current Time: " + datetime.now().strftime("%Y-%m-%d %H:%M:%S") +
+                f" (Server Timestamp {Util.get_server_time()})",
+            ""
+        ]
+        for orderbook_id in sorted(depth):
+            bids, asks = depth[orderbook_id]
+            symbol = Console.SYMBOLS.get(str(orderbook_id), str(orderbook_id))
+            lines.append(f"{symbol} (orderbook {orderbook_id})")
+            lines.append(self.ROW.format("Orders", "Quantity", "Bid", "Ask", "Quantity", "Orders").rstrip())
+            for i in range(max(len(bids), len(asks), 1)):
+                bid = bids[i] if i < len(bids) else None
+                ask = asks[i] if i < len(asks) else None
+                lines.append(self.ROW.format(
+                    bid[2] if bid else "", bid[1] if bid else "", bid[0] if bid else "",
+                    ask[0] if ask else "", ask[1] if ask else "", ask[2] if ask else ""
+                ).rstrip())
+            lines.append("")
+        if connection_log:
+            lines.append("Connection Log")
+            lines.extend(connection_log)
+        return lines
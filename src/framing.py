@@ -0,0 +1,192 @@
+"""
+The OUCH Team
+Framed Reader
+
+Splits a TCP byte stream into fixed-width OUCH messages. Bytes are received with recv_into
+directly into a preallocated buffer, and every complete message in the buffer is split out
+in one pass, so a burst of pipelined messages costs one system call rather than two per message.
+A message split across two reads stays in the buffer until the rest of it arrives.
+
+Sequenced sessions (see session.py) wrap messages in length-prefixed SoupBinTCP packets, which
+PacketReader splits in the same way.
+"""
+import socket
+import struct
+
+
+class FrameReader:
+    """
+    FrameReader
+
+    Reads fixed-width messages from one connection. The buffer is reused for the lifetime of
+    the connection: once every complete message has been split out, the unread bytes of a
+    partial message (at most one message long) are moved back to the start of the buffer.
+    """
+    # One single-byte bytes object per possible header, so headers are never reallocated.
+    HEADERS = tuple(bytes((i, )) for i in range(256))
+
+    def __init__(self, connection: socket.socket, body_lengths: dict, buffer_size: int = 65536):
+        """
+        :param connection: Connected socket to read from, or None if the buffer is filled
+            through get_buffer/buffer_updated.
+        :param body_lengths: {header: body length} of every message type which may be received.
+        :param buffer_size: Size of the receive buffer in bytes.
+        """
+        self.connection = connection
+
+        # {header byte value: length of the whole message}
+        self.lengths = {header[0]: length + 1 for header, length in body_lengths.items()}
+        self.max_length = max(self.lengths.values())
+        if buffer_size < self.max_length:
+            raise ValueError(f"Buffer size {buffer_size} is smaller than a message.")
+
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+
+        # Unread bytes are buffer[start:end].
+        self.start = 0
+        self.end = 0
+
+    def read_frames(self) -> list:
+        """
+        Blocks until at least one complete message has been received, then returns every
+        complete message in the buffer.
+
+        :returns: List of (header, body) bytes pairs in the order they were received.
+        :raises ConnectionError: The peer closed the connection.
+        :raises ValueError: A message has an invalid header, and every message before it has
+            already been returned. The stream cannot be resynchronised after an invalid header,
+            so the connection should be closed.
+        """
+        frames = self.split_frames()
+        while not frames:
+            self.fill()
+            frames = self.split_frames()
+        return frames
+
+    def fill(self) -> int:
+        """
+        Receives as many bytes as are available (and fit) into the buffer with one recv_into.
+
+        :returns: Number of bytes received.
+        :raises ConnectionError: The peer closed the connection.
+        """
+        received = self.connection.recv_into(self.get_buffer())
+        if received == 0:
+            raise ConnectionError("Connection closed by peer.")
+        self.buffer_updated(received)
+        return received
+
+    def get_buffer(self) -> memoryview:
+        """
+        Returns the free space at the end of the buffer, which always has room for at least one
+        whole message. Together with buffer_updated, this lets the reader be filled by something
+        other than recv_into, such as an asyncio.BufferedProtocol.
+        """
+        if len(self.buffer) - self.end < self.max_length:
+            self._compact()
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes: int):
+        """Marks nbytes written into the buffer returned by get_buffer as received."""
+        self.end += nbytes
+
+    def split_frames(self) -> list:
+        """
+        Splits every complete message out of the unread bytes of the buffer, leaving any
+        partial message at the end unread. A message with an invalid header is left unread
+        after the messages before it, and only raises once they have been returned.
+
+        :returns: List of (header, body) bytes pairs.
+        :raises ValueError: The first unread message has an invalid header.
+        """
+        buffer = self.buffer
+        view = self.view
+        lengths = self.lengths
+        headers = self.HEADERS
+        pos = self.start
+        end = self.end
+        frames = []
+        while pos < end:
+            header = buffer[pos]
+            length = lengths.get(header)
+            if length is None:
+                if frames:
+                    break
+                raise ValueError(f"Invalid header type '{headers[header]}'")
+            if pos + length > end:
+                break
+            frames.append((headers[header], view[pos+1:pos+length].tobytes()))
+            pos += length
+        if pos == end:
+            self.start = self.end = 0
+        else:
+            self.start = pos
+        return frames
+
+    def _compact(self):
+        """Moves the unread bytes to the start of the buffer."""
+        unread = self.end - self.start
+        self.buffer[:unread] = self.buffer[self.start:self.end]
+        self.start = 0
+        self.end = unread
+
+
+class PacketReader(FrameReader):
+    """
+    PacketReader
+
+    Reads SoupBinTCP packets from one connection. Each packet starts with its length as a
+    2-byte big-endian integer, which counts the packet type byte and the payload after it.
+    read_frames returns (packet type, payload) pairs.
+    """
+    LENGTH = struct.Struct("!H")
+
+    def __init__(self, connection: socket.socket, max_length: int, buffer_size: int = 65536):
+        """
+        :param connection: Connected socket to read from.
+        :param max_length: Length of the longest packet which may be received, including its
+            length field.
+        :param buffer_size: Size of the receive buffer in bytes.
+        """
+        if buffer_size < max_length:
+            raise ValueError(f"Buffer size {buffer_size} is smaller than a packet.")
+        self.connection = connection
+        self.max_length = max_length
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def split_frames(self) -> list:
+        """
+        Splits every complete packet out of the unread bytes of the buffer, leaving any
+        partial packet at the end unread. An invalid packet is left unread after the packets
+        before it, and only raises once they have been returned.
+
+        :returns: List of (packet type, payload) bytes pairs.
+        :raises ValueError: The first unread packet is empty or longer than max_length.
+        """
+        buffer = self.buffer
+        view = self.view
+        unpack_from = self.LENGTH.unpack_from
+        headers = self.HEADERS
+        max_length = self.max_length
+        pos = self.start
+        end = self.end
+        packets = []
+        while pos + 2 <= end:
+            length = unpack_from(buffer, pos)[0] + 2
+            if length == 2 or length > max_length:
+                if packets:
+                    break
+                raise ValueError(f"Invalid packet length {length - 2}")
+            if pos + length > end:
+                break
+            packets.append((headers[buffer[pos+2]], view[pos+3:pos+length].tobytes()))
+            pos += length
+        if pos == end:
+            self.start = self.end = 0
+        else:
+            self.start = pos
+        return packets
@@ -0,0 +1,80 @@
+"""
+The OUCH Team
+Histogram
+
+Histogram for recording latencies and other measurements on hot paths, where keeping every
+measured value would cost too much memory.
+"""
+import math
+
+
+class LatencyHistogram:
+    """
+    LatencyHistogram
+
+    Log-linear histogram of non-negative integers, such as nanosecond latencies. Every power
+    of two is split into 2**SUB_BUCKET_BITS buckets, so recorded values and percentiles are
+    exact to within 1% while memory use stays bounded however many values are recorded.
+
+    Only one thread may record values. Other threads may take a copy of the histogram with
+    merge or to_dict at any time without holding a lock, as the buckets are copied with one
+    operation which cannot be interrupted by the recording thread.
+    """
+    SUB_BUCKET_BITS = 7
+    PERCENTILES = (50, 90, 99, 99.9)
+
+    def __init__(self):
+        # {bucket lower bound: count}
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def record(self, value: int):
+        shift = max(value.bit_length() - self.SUB_BUCKET_BITS, 0)
+        bucket = value >> shift << shift
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Adds every value recorded by another histogram to this one."""
+        for bucket, count in list(other.counts.items()):
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percentile: float) -> int:
+        """Returns the highest value in the bucket holding the given percentile."""
+        counts = dict(self.counts)
+        count = sum(counts.values())
+        if count == 0:
+            return 0
+        rank = math.ceil(percentile / 100 * count)
+        seen = 0
+        for bucket in sorted(counts):
+            seen += counts[bucket]
+            if seen >= rank:
+                shift = max(bucket.bit_length() - self.SUB_BUCKET_BITS, 0)
+                return min(bucket + (1 << shift) - 1, self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        result = {
+            "count": self.count,
+            "min": self.min or 0,
+            "mean": self.total // self.count if self.count else 0,
+            "max": self.max
+        }
+        for percentile in self.PERCENTILES:
+            result[f"p{percentile}"] = self.percentile(percentile)
+        result["buckets"] = sorted(list(self.counts.items()))
+        return result
@@ -0,0 +1,90 @@
+"""
+The OUCH Team
+Stage Instrumentation
+
+Measures where the time taken to handle each client message goes, between the receiver
+taking it off the connection and the replies to it being handed back to the receiver:
+- queue: from being received until the exchange takes it from the queue.
+- lock: waiting for the orderbook lock.
+- match: processing under the orderbook lock, including journaling and market data.
+- send: handing the replies to the receiver.
+- total: from being received until its replies have been handed to the receiver.
+The depth of the queue is recorded whenever a message is taken from it, and the number of
+messages in each batch when messages are processed in batches.
+
+Each stage is recorded in a histogram (see LatencyHistogram) which only the exchange's
+operating thread writes to, so recording takes no lock. When instrumentation is disabled,
+messages are not timestamped and the operating thread skips every measurement.
+"""
+import time
+
+from src.histogram import LatencyHistogram
+
+
+class StageStats:
+    """
+    StageStats
+
+    Per-stage histograms of the messages handled by one exchange. Times are perf_counter_ns
+    timestamps, and receivers stamp each message with its receive time as "received".
+    """
+    STAGES = ("queue", "lock", "match", "send", "total")
+
+    def __init__(self):
+        self.started = time.perf_counter_ns()
+        self.messages = 0
+        self.stages = {stage: LatencyHistogram() for stage in self.STAGES}
+        self.queue_depth = LatencyHistogram()
+        self.batch_size = LatencyHistogram()
+
+    def record(self, msg: dict, dequeued: int, locked: int, processed: int, sent: int, depth: int):
+        """
+        Records the stages of one message processed on its own.
+
+        :param dequeued: Time the message was taken from the queue.
+        :param locked: Time the orderbook lock was acquired.
+        :param processed: Time the orderbook lock was released.
+        :param sent: Time the last reply was handed to the receiver.
+        :param depth: Messages left in the queue after the message was taken.
+        """
+        received = msg.get("received", dequeued)
+        stages = self.stages
+        stages["queue"].record(dequeued - received)
+        stages["lock"].record(locked - dequeued)
+        stages["match"].record(processed - locked)
+        stages["send"].record(sent - processed)
+        stages["total"].record(sent - received)
+        self.queue_depth.record(depth)
+        self.messages += 1
+
+    def record_batch(self, batch: list, dequeued: int, locked: int, processed: int, sent: int, depth: int):
+        """
+        Records the stages of a batch of messages processed together. The queue and total
+        stages are recorded for every message, and the other stages once for the batch.
+        """
+        queue = self.stages["queue"]
+        total = self.stages["total"]
+        for msg in batch:
+            received = msg.get("received", dequeued)
+            queue.record(dequeued - received)
+            total.record(sent - received)
+        stages = self.stages
+        stages["lock"].record(locked - dequeued)
+        stages["match"].record(processed - locked)
+        stages["send"].record(sent - processed)
+        self.queue_depth.record(depth)
+        self.batch_size.record(len(batch))
+        self.messages += len(batch)
+
+    def to_dict(self) -> dict:
+        """
+        Returns the statistics recorded so far. May be called from any thread while messages
+        are being recorded.
+        """
+        return {
+            "uptime_s": (time.perf_counter_ns() - self.started) / 1e9,
+            "messages": self.messages,
+            "stages_ns": {stage: histogram.to_dict() for stage, histogram in self.stages.items()},
+            "queue_depth": self.queue_depth.to_dict(),
+            "batch_size": self.batch_size.to_dict()
+        }
@@ -0,0 +1,229 @@
+"""
+The OUCH Team
+Message Journal
+
+Append-only journal of the messages received from and sent to clients, from which the
+orderbook is rebuilt when the exchange is restarted. Records are written into memory-mapped,
+preallocated segment files, so appending a record is a copy into memory rather than a system
+call. A background thread flushes everything appended since the previous flush to disk once
+every commit interval (group commit), so the cost of each flush is shared by every record
+appended in that interval.
+
+Records survive the exchange process crashing as soon as they are appended, as they are
+already in the operating system's page cache. Records appended within the last commit
+interval may be lost if the machine itself fails.
+
+This is not a write-ahead log. The Exchange journals each message after applying it to the
+orderbook, and sends its replies straight after journaling, without waiting for the next
+flush. Acknowledging before the record is durable is deliberate: holding every reply until
+the group commit completes would add up to a commit interval (2ms by default) to the latency
+of every message. A machine failure can therefore lose messages whose replies clients have
+already received, up to one commit interval of them. A caller which must not act before a
+record is on disk can call sync.
+"""
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+
+class Journal:
+    """
+    Journal
+
+    Segment files are named after the sequence number of their first record, and hold records
+    of the form:
+    - crc (4 bytes): CRC-32 of the rest of the record.
+    - length (2 bytes): length of the message.
+    - kind (1 byte): INBOUND or OUTBOUND.
+    - client_id (4 bytes): client which sent or receives the message.
+    - sequence (8 bytes): sequence number of the record, starting from 1.
+    - message: the OUCH message, header included.
+    The rest of a segment after its last record is zero, as segments are preallocated. Reading
+    stops at the first record which is empty, corrupt or out of sequence, which is where a
+    record was being appended when the exchange stopped.
+    """
+    # class constants: record kinds.
+    INBOUND = b'I'
+    OUTBOUND = b'O'
+
+    RECORD = struct.Struct("!IHcIQ")
+    CRC = struct.Struct("!I")
+    SUFFIX = ".journal"
+
+    def __init__(self, directory: str, segment_size: int = 64*1024*1024, commit_interval: float = 0.002):
+        """
+        Opens the journal in a directory, creating the directory if needed. New records are
+        appended after the last valid record already in the journal.
+
+        :param directory: Directory holding the segment files.
+        :param segment_size: Size of each segment file in bytes.
+        :param commit_interval: Seconds between flushes of new records to disk.
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.commit_interval = commit_interval
+        os.makedirs(directory, exist_ok=True)
+
+        # Sequence number of the most recent record.
+        self.sequence = 0
+
+        # Segment being appended to, its size, and the offset of the next record in it.
+        self.file = None
+        self.map = None
+        self.limit = 0
+        self.position = 0
+
+        # Offset in the current segment up to which records have been flushed.
+        self.synced = 0
+
+        # Held while flushing or switching segments.
+        self.lock = threading.Lock()
+
+        segments = self._segments()
+        if segments:
+            first_sequence, path = segments[-1]
+            self._open_segment(path)
+            self.sequence = first_sequence - 1
+            for end, sequence, _, _, _ in self._records(self.map, first_sequence):
+                self.position = end
+                self.sequence = sequence
+            # Clear anything after the last valid record, such as a partially written record.
+            if any(self.map[self.position:self.position+self.RECORD.size]):
+                self.map[self.position:] = bytes(self.limit - self.position)
+            self.synced = self.position
+        else:
+            self._new_segment()
+
+        # Thread which flushes new records to disk once every commit interval.
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(
+            name = "journal",
+            target = lambda: self._flush_thread(),
+            daemon = True
+        )
+        self.flusher.start()
+
+    def append(self, kind: bytes, client_id: int, message: bytes) -> int:
+        """
+        Appends a record to the journal. Only one thread may append records.
+
+        :param kind: INBOUND or OUTBOUND.
+        :param client_id: Client which sent or receives the message.
+        :param message: OUCH message, header included.
+        :returns: Sequence number of the record.
+        """
+        size = self.RECORD.size + len(message)
+        if self.position + size > self.limit:
+            self._next_segment()
+        sequence = self.sequence + 1
+        position = self.position
+        end = position + size
+        mapped = self.map
+        self.RECORD.pack_into(mapped, position, 0, len(message), kind, client_id, sequence)
+        mapped[position+self.RECORD.size:end] = message
+        self.CRC.pack_into(mapped, position, zlib.crc32(mapped[position+4:end]))
+        self.position = end
+        self.sequence = sequence
+        return sequence
+
+    def replay(self):
+        """
+        Yields every record in the journal in sequence as (sequence, kind, client_id, message)
+        tuples. Should be called before any records are appended.
+        """
+        for first_sequence, path in self._segments():
+            with open(path, "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                for _, sequence, kind, client_id, message in self._records(mapped, first_sequence):
+                    yield sequence, kind, client_id, message
+                mapped.close()
+
+    def sync(self):
+        """Flushes every record appended so far to disk, and waits until it is done."""
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        """Flushes the journal to disk and closes it."""
+        self.closed.set()
+        self.flusher.join()
+        with self.lock:
+            self._flush()
+            self.map.close()
+            self.file.close()
+
+    def _records(self, mapped, first_sequence: int):
+        """
+        Yields every valid record of a segment as (end, sequence, kind, client_id, message)
+        tuples, where end is the offset just after the record.
+        """
+        header_size = self.RECORD.size
+        unpack_from = self.RECORD.unpack_from
+        crc32 = zlib.crc32
+        limit = len(mapped)
+        expected = first_sequence
+        position = 0
+        while position + header_size <= limit:
+            crc, length, kind, client_id, sequence = unpack_from(mapped, position)
+            end = position + header_size + length
+            if length == 0 or sequence != expected or end > limit or \
+                    crc32(mapped[position+4:end]) != crc:
+                return
+            yield end, sequence, kind, client_id, mapped[position+header_size:end]
+            expected += 1
+            position = end
+
+    def _segments(self) -> list:
+        """Returns the (first sequence, path) of every segment file, in order."""
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.endswith(self.SUFFIX):
+                segments.append((int(name[:-len(self.SUFFIX)]), os.path.join(self.directory, name)))
+        segments.sort()
+        return segments
+
+    def _path(self, first_sequence: int) -> str:
+        return os.path.join(self.directory, f"{first_sequence:020d}{self.SUFFIX}")
+
+    def _open_segment(self, path: str):
+        """Maps a segment file for appending."""
+        self.file = open(path, "r+b")
+        if os.fstat(self.file.fileno()).st_size < self.segment_size:
+            self.file.truncate(self.segment_size)
+        self.limit = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), self.limit)
+        self.position = 0
+        self.synced = 0
+
+    def _new_segment(self):
+        """Creates and maps an empty segment starting at the next sequence number."""
+        path = self._path(self.sequence + 1)
+        with open(path, "wb") as f:
+            f.truncate(self.segment_size)
+        self._open_segment(path)
+
+    def _next_segment(self):
+        """Flushes and closes the current segment, and starts a new one."""
+        with self.lock:
+            self._flush()
+            self.map.close()
+            self.file.close()
+            self._new_segment()
+
+    def _flush(self):
+        """Flushes the records appended since the previous flush. The lock must be held."""
+        position = self.position
+        if position == self.synced:
+            return
+        # Flushes must start on a page boundary.
+        start = self.synced - self.synced % mmap.ALLOCATIONGRANULARITY
+        self.map.flush(start, position - start)
+        self.synced = position
+
+    def _flush_thread(self):
+        """Group commit thread: flushes new records once every commit interval."""
+        while not self.closed.wait(self.commit_interval):
+            with self.lock:
+                self._flush()
@@ -0,0 +1,185 @@
+"""
+The OUCH Team
+Price Ladder
+
+One side (bids or asks) of a single instrument's limit order book. Price levels are kept
+in a dictionary for direct access, alongside a sorted list of level keys so the best price
+is always the last element of the list. Each level is an intrusive doubly linked list of
+orders, threaded through the prev/next columns of the OrderStore, so an order can be unlinked
+in constant time from its slot.
+"""
+from bisect import bisect_left, insort
+
+from src.order import OrderStore
+
+
+class PriceLevel:
+    """
+    PriceLevel
+
+    All resting orders at one price on one side of the book, oldest (highest priority) at
+    the head, as slots of an OrderStore. Appending, and unlinking any order, are constant time.
+    The total quantity of the level is kept up to date as orders are linked and unlinked, so it
+    can be read without walking the orders. Code which changes the quantity of a linked order
+    must adjust the level's quantity by the same amount.
+    """
+    __slots__ = ("price", "orders", "head", "tail", "count", "quantity")
+
+    def __init__(self, price: float, orders: OrderStore):
+        self.price = price
+        self.orders = orders
+        self.head = OrderStore.NONE
+        self.tail = OrderStore.NONE
+        self.count = 0
+        self.quantity = 0
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """Yields the slots of the orders of the level in time priority."""
+        next_slots = self.orders.next
+        slot = self.head
+        while slot != OrderStore.NONE:
+            yield slot
+            slot = next_slots[slot]
+
+    def append(self, slot: int):
+        """Links an order to the back of the level."""
+        orders = self.orders
+        orders.prev[slot] = self.tail
+        orders.next[slot] = OrderStore.NONE
+        if self.tail == OrderStore.NONE:
+            self.head = slot
+        else:
+            orders.next[self.tail] = slot
+        self.tail = slot
+        self.count += 1
+        self.quantity += orders.quantity[slot]
+
+    def unlink(self, slot: int):
+        """Unlinks an order from anywhere in the level."""
+        orders = self.orders
+        prev = orders.prev[slot]
+        next = orders.next[slot]
+        if prev == OrderStore.NONE:
+            self.head = next
+        else:
+            orders.next[prev] = next
+        if next == OrderStore.NONE:
+            self.tail = prev
+        else:
+            orders.prev[next] = prev
+        orders.prev[slot] = orders.next[slot] = OrderStore.NONE
+        self.count -= 1
+        self.quantity -= orders.quantity[slot]
+
+
+class PriceLadder:
+    """
+    PriceLadder
+
+    Levels are stored as {key: PriceLevel} where each level holds orders in time priority.
+    Keys are the price for bids and the negated price for asks, so for both sides the best level
+    is the greatest key. This gives O(1) access to (and removal of) the best level. Inserting or
+    removing any other level finds its position in O(log n) by bisection, but the list insert or
+    delete itself is O(n), moving the keys on the better side of it. Books hold few enough levels,
+    mostly near the top, that this memmove costs less than maintaining a balanced tree in Python.
+    """
+    def __init__(self, is_bid: bool, orders: OrderStore):
+        self.is_bid = is_bid
+
+        # Store holding the orders of the levels.
+        self.orders = orders
+
+        # {key: PriceLevel}
+        self.levels = {}
+
+        # Level keys in ascending order, best level last.
+        self.keys = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def key(self, price: float) -> float:
+        """Returns the sort key of a price on this side of the book."""
+        return price if self.is_bid else -price
+
+    def best_price(self):
+        """Returns the best price on this side of the book, or None if the side is empty."""
+        if not self.keys:
+            return None
+        key = self.keys[-1]
+        return key if self.is_bid else -key
+
+    def best_level(self):
+        """Returns the PriceLevel at the best price, or None if the side is empty."""
+        if not self.keys:
+            return None
+        return self.levels[self.keys[-1]]
+
+    def crosses(self, price: float) -> bool:
+        """
+        Returns whether an incoming order on the opposite side at the given price would
+        trade against the best level of this side.
+        """
+        if not self.keys:
+            return False
+        key = self.keys[-1]
+        return price <= key if self.is_bid else price >= -key
+
+    def add(self, slot: int) -> PriceLevel:
+        """
+        Appends an order to the back of its price level, creating the level if needed.
+
+        :returns: The level the order was added to.
+        """
+        price = self.orders.price[slot]
+        key = price if self.is_bid else -price
+        level = self.levels.get(key)
+        if level is None:
+            level = PriceLevel(price, self.orders)
+            self.levels[key] = level
+            insort(self.keys, key)
+        level.append(slot)
+        return level
+
+    def remove(self, slot: int):
+        """Unlinks an order from its price level, dropping the level if it becomes empty."""
+        price = self.orders.price[slot]
+        key = price if self.is_bid else -price
+        level = self.levels[key]
+        level.unlink(slot)
+        if level.count == 0:
+            self._drop_level(key)
+
+    def pop_best_level(self):
+        """Removes the best price level. Used once matching has emptied it."""
+        key = self.keys.pop()
+        del self.levels[key]
+
+    def prices(self) -> list:
+        """Returns all prices on this side of the book, best first."""
+        if self.is_bid:
+            return self.keys[::-1]
+        return [-key for key in reversed(self.keys)]
+
+    def depth(self, levels: int) -> tuple:
+        """
+        Returns the best levels of this side of the book, best first, as a tuple of
+        (price, quantity, order count) tuples. Only the returned levels are visited.
+        """
+        keys = self.keys
+        depth = []
+        for i in range(len(keys) - 1, max(len(keys) - levels, 0) - 1, -1):
+            level = self.levels[keys[i]]
+            depth.append((level.price, level.quantity, level.count))
+        return tuple(depth)
+
+    def _drop_level(self, key: float):
+        """Removes an empty level by key."""
+        del self.levels[key]
+        if self.keys[-1] == key:
+            self.keys.pop()
+        else:
+            del self.keys[bisect_left(self.keys, key)]
@@ -0,0 +1,460 @@
+"""
+The OUCH Team
+Market Data Feed
+
+Publishes every change to the orderbook as compact binary messages over UDP multicast, so any
+number of consumers can follow the full book without connecting to the exchange. The feed has
+three channels:
+- incremental: every add, replace, delete and trade, each with a sequence number.
+- snapshot: the whole book, published periodically, for consumers joining late or which
+  cannot recover a gap.
+- recovery: consumers which miss messages request them again by sequence number, and the
+  publisher sends them back from a history of recent messages.
+
+MarketDataListener is a reference consumer which rebuilds the book from the feed.
+"""
+import select
+import socket
+import struct
+import threading
+import time
+from collections import deque
+
+from src.OrderBook import OrderBook
+from src.util import Util
+
+
+class MarketData:
+    """
+    MarketData
+
+    Wire format of the feed. All integers are big-endian, and prices are integers (price*10)
+    as in OUCH. Each UDP packet is a header followed by messages:
+    - header: channel (I incremental, S snapshot, R retransmission), sequence number of the
+      first message, number of messages. A packet with no messages is a heartbeat, and its
+      sequence number is the next sequence number to be published.
+    - A (add): orderbook ID, order number, buy/sell indicator, price, quantity. The order
+      joins the back of its price level.
+    - M (modify): orderbook ID, order number, price, quantity. The order was replaced and
+      moves to the back of its new price level.
+    - D (delete): orderbook ID, order number. The order left the book.
+    - T (trade): orderbook ID, order number of the resting order, executed quantity,
+      execution price, match number. The resting order leaves the book once its whole
+      quantity has traded.
+    Snapshot packets hold a B (begin) message, an A message for every resting order in time
+    priority, and an F (finish) message. Their sequence number is the sequence number of the
+    last incremental message the snapshot includes.
+    """
+    HEADER = struct.Struct("!cQH")
+    MESSAGES = {
+        "A": struct.Struct("!cIIcII"),
+        "M": struct.Struct("!cIIII"),
+        "D": struct.Struct("!cII"),
+        "T": struct.Struct("!cIIIIQ"),
+        "B": struct.Struct("!cI"), # number of orders in the snapshot
+        "F": struct.Struct("!c")
+    }
+    # {header byte value: (type, struct)}
+    DECODE = {ord(t): (t, codec) for t, codec in MESSAGES.items()}
+
+    # Retransmission request: sequence number of the first message, number of messages.
+    REQUEST = struct.Struct("!QH")
+    MAX_REQUEST_COUNT = 0xFFFF
+
+    # Largest packet payload, which fits in an Ethernet frame without fragmenting.
+    MAX_PACKET = 1400
+
+    INCREMENTAL = b'I'
+    SNAPSHOT = b'S'
+    RETRANSMISSION = b'R'
+
+    @staticmethod
+    def encode(event: tuple) -> bytes:
+        """Packs an OrderBook book event into a feed message."""
+        message_type = event[0]
+        if message_type == "A":
+            _, orderbook_id, order_id, indicator, price, quantity = event
+            return MarketData.MESSAGES["A"].pack(b'A', orderbook_id, order_id, indicator.encode("ascii"), round(price*10), quantity)
+        elif message_type == "M":
+            _, orderbook_id, order_id, price, quantity = event
+            return MarketData.MESSAGES["M"].pack(b'M', orderbook_id, order_id, round(price*10), quantity)
+        elif message_type == "D":
+            return MarketData.MESSAGES["D"].pack(b'D', event[1], event[2])
+        elif message_type == "T":
+            _, orderbook_id, order_id, quantity, price, match_number = event
+            return MarketData.MESSAGES["T"].pack(b'T', orderbook_id, order_id, quantity, round(price*10), match_number)
+        raise ValueError(f"Invalid book event type {message_type}.")
+
+    @staticmethod
+    def decode(packet: bytes): # -> (bytes, int, list):
+        """
+        Unpacks a packet.
+
+        :returns: channel, sequence number of the first message, and a list of messages as
+            tuples starting with the message type. Prices are converted back to decimals.
+        """
+        channel, sequence, count = MarketData.HEADER.unpack_from(packet, 0)
+        offset = MarketData.HEADER.size
+        messages = []
+        for _ in range(count):
+            message_type, codec = MarketData.DECODE[packet[offset]]
+            fields = codec.unpack_from(packet, offset)
+            offset += codec.size
+            if message_type == "A":
+                messages.append(("A", fields[1], fields[2], fields[3].decode("ascii"), fields[4]/10, fields[5]))
+            elif message_type == "M":
+                messages.append(("M", fields[1], fields[2], fields[3]/10, fields[4]))
+            elif message_type == "T":
+                messages.append(("T", fields[1], fields[2], fields[3], fields[4]/10, fields[5]))
+            else:
+                messages.append((message_type, ) + fields[1:])
+        return channel, sequence, messages
+
+
+class MarketDataPublisher:
+    """
+    MarketDataPublisher
+
+    Sequences, encodes and sends book events from a thread of its own, so the exchange only
+    hands over each batch of events. The publisher keeps its own copy of the book, built from
+    the events it has published, from which snapshots are taken without touching the
+    orderbook.
+    """
+    # class constants: seconds between snapshots and between heartbeats while idle.
+    SNAPSHOT_INTERVAL = 5.0
+    HEARTBEAT_INTERVAL = 1.0
+
+    # class constant: number of recent messages kept for retransmission.
+    HISTORY_SIZE = 100000
+
+    def __init__(self, orderbook: OrderBook):
+        """
+        Starts publishing. The orderbook's current resting orders are the starting state of
+        the feed, and the orderbook starts recording book events, which must then be passed
+        to publish.
+        """
+        self.addr = Util.get_market_data_addr()
+        self.group = self.addr["group"]
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.addr["interface"]))
+
+        self.recovery_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.recovery_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.recovery_socket.bind((self.addr["interface"], self.addr["recovery_port"]))
+
+        # Sequence number of the last message published.
+        self.sequence = 0
+
+        # Recent messages for retransmission: history[i] has sequence number history_first+i.
+        self.history_lock = threading.Lock()
+        self.history = deque(maxlen=self.HISTORY_SIZE)
+        self.history_first = 1
+
+        # Copy of the book as published: {orderbook_id: {order_id: [indicator, price, quantity]}}
+        # Each instrument's orders are kept in time priority, as dictionaries keep insertion order.
+        self.book = {}
+        store = orderbook.orders
+        for orderbook_id, ladders in orderbook.ladders.items():
+            orders = self.book.setdefault(orderbook_id, {})
+            for ladder in ladders:
+                for key in reversed(ladder.keys):
+                    level = ladder.levels[key]
+                    for slot in level:
+                        orders[store.order_id[slot]] = [chr(store.indicator[slot]), level.price, store.quantity[slot]]
+        orderbook.record_book_events()
+
+        # Batches of book events waiting to be published.
+        self.pending = deque()
+        self.wake = threading.Event()
+        self.closed = threading.Event()
+
+        self.publisher = threading.Thread(name="market data", target=lambda: self._publish_thread(), daemon=True)
+        self.publisher.start()
+        self.recovery = threading.Thread(name="market data recovery", target=lambda: self._recovery_thread(), daemon=True)
+        self.recovery.start()
+
+    def publish(self, events: list):
+        """Queues a batch of book events, in the order they happened, to be published."""
+        if events:
+            self.pending.append(events)
+            self.wake.set()
+
+    def terminate(self):
+        """Publishes any queued events, then stops the publisher."""
+        self.closed.set()
+        self.wake.set()
+        self.publisher.join()
+        try:
+            self.recovery_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.recovery_socket.close()
+        self.recovery.join()
+        self.socket.close()
+
+    def _publish_thread(self):
+        """Publisher thread: publishes queued events, heartbeats and periodic snapshots."""
+        next_snapshot = time.monotonic()
+        last_sent = time.monotonic()
+        while True:
+            self.wake.wait(min(self.HEARTBEAT_INTERVAL, self.SNAPSHOT_INTERVAL))
+            self.wake.clear()
+            if self.pending:
+                self._publish_pending()
+                last_sent = time.monotonic()
+            if self.closed.is_set():
+                return
+            now = time.monotonic()
+            if now - last_sent >= self.HEARTBEAT_INTERVAL:
+                self._send(MarketData.INCREMENTAL, self.sequence + 1, [], self.addr["port"])
+                last_sent = now
+            if now >= next_snapshot:
+                self._publish_snapshot()
+                next_snapshot = now + self.SNAPSHOT_INTERVAL
+
+    def _publish_pending(self):
+        """Encodes every queued event, applies it to the book copy, and sends it."""
+        encode = MarketData.encode
+        book = self.book
+        messages = []
+        while self.pending:
+            for event in self.pending.popleft():
+                messages.append(encode(event))
+                self._apply(book, event)
+        first = self.sequence + 1
+        self.sequence += len(messages)
+        with self.history_lock:
+            self.history.extend(messages)
+            self.history_first = self.sequence + 1 - len(self.history)
+        self._send(MarketData.INCREMENTAL, first, messages, self.addr["port"])
+
+    def _publish_snapshot(self):
+        """Sends every order of the book copy on the snapshot channel."""
+        messages = [MarketData.MESSAGES["B"].pack(b'B', sum(len(orders) for orders in self.book.values()))]
+        for orderbook_id, orders in self.book.items():
+            for order_id, (indicator, price, quantity) in orders.items():
+                messages.append(MarketData.encode(("A", orderbook_id, order_id, indicator, price, quantity)))
+        messages.append(MarketData.MESSAGES["F"].pack(b'F'))
+        self._send(MarketData.SNAPSHOT, self.sequence, messages, self.addr["snapshot_port"], sequenced=False)
+
+    def _send(self, channel: bytes, first: int, messages: list, port: int, addr: tuple = None, sequenced: bool = True):
+        """
+        Sends messages in as few packets as fit. Sequenced channels number each packet from
+        the sequence number of its first message, while snapshot packets all carry the same
+        sequence number.
+        """
+        addr = addr or (self.group, port)
+        limit = MarketData.MAX_PACKET - MarketData.HEADER.size
+        if not messages:
+            self.socket.sendto(MarketData.HEADER.pack(channel, first, 0), addr)
+            return
+        start = 0
+        while start < len(messages):
+            size = 0
+            end = start
+            while end < len(messages) and size + len(messages[end]) <= limit:
+                size += len(messages[end])
+                end += 1
+            header = MarketData.HEADER.pack(channel, first + start if sequenced else first, end - start)
+            try:
+                self.socket.sendto(header + b"".join(messages[start:end]), addr)
+            except OSError:
+                # Multicast is best effort, and consumers recover lost packets.
+                pass
+            start = end
+
+    def _recovery_thread(self):
+        """Answers retransmission requests with messages from the history, sent back unicast."""
+        while True:
+            try:
+                request, addr = self.recovery_socket.recvfrom(MarketData.REQUEST.size)
+            except OSError:
+                return
+            if len(request) != MarketData.REQUEST.size:
+                continue
+            first, count = MarketData.REQUEST.unpack(request)
+            with self.history_lock:
+                start = first - self.history_first
+                if start < 0 or count == 0 or first + count - 1 > self.history_first + len(self.history) - 1:
+                    messages = None
+                else:
+                    messages = [self.history[i] for i in range(start, start + count)]
+            if messages is None:
+                # The messages are no longer (or not yet) available: the consumer must use
+                # the snapshot channel instead.
+                self.socket.sendto(MarketData.HEADER.pack(MarketData.RETRANSMISSION, first, 0), addr)
+            else:
+                self._send(MarketData.RETRANSMISSION, first, messages, 0, addr=addr)
+
+    @staticmethod
+    def _apply(book: dict, event: tuple):
+        """Applies a book event or feed message to a book copy."""
+        message_type = event[0]
+        orders = book.get(event[1])
+        if orders is None:
+            orders = book[event[1]] = {}
+        if message_type == "A":
+            orders[event[2]] = [event[3], event[4], event[5]]
+        elif message_type == "M":
+            order = orders.pop(event[2])
+            order[1] = event[3]
+            order[2] = event[4]
+            orders[event[2]] = order
+        elif message_type == "D":
+            del orders[event[2]]
+        elif message_type == "T":
+            order = orders[event[2]]
+            order[2] -= event[3]
+            if order[2] == 0:
+                del orders[event[2]]
+
+
+class MarketDataListener:
+    """
+    MarketDataListener
+
+    Reference consumer of the feed, which rebuilds the book in the same form as the
+    publisher's copy. The listener starts from the first complete snapshot, then applies
+    incremental messages in sequence. Messages received after a gap are held back while the
+    missing ones are requested from the recovery channel. If they cannot be recovered in
+    time, or there are more than one request can ask for (MarketData.MAX_REQUEST_COUNT), the
+    listener starts again from the next snapshot.
+    """
+    # class constant: seconds to wait for a retransmission before falling back to a snapshot.
+    RECOVERY_TIMEOUT = 0.5
+
+    def __init__(self):
+        self.addr = Util.get_market_data_addr()
+
+        # {orderbook_id: {order_id: [indicator, price, quantity]}}
+        self.book = {}
+        self.book_lock = threading.Lock()
+
+        # Sequence number of the last message applied, or None while waiting for a snapshot.
+        self.sequence = None
+
+        # Messages of the snapshot being received, or None.
+        self.snapshot = None
+
+        # Packets received after a gap: {sequence number of first message: messages}
+        self.held = {}
+
+        # Last sequence number of the pending retransmission request, and when it expires.
+        self.requested_until = None
+        self.recovery_deadline = None
+
+        # Number of gaps detected, and how many were filled by retransmission.
+        self.gaps = 0
+        self.recovered = 0
+
+        self.incremental = self._join(self.addr["port"])
+        self.snapshots = self._join(self.addr["snapshot_port"])
+        self.closed = threading.Event()
+        self.listener = threading.Thread(name="market data listener", target=lambda: self._listen(), daemon=True)
+        self.listener.start()
+
+    def get_book(self) -> dict:
+        """Returns a copy of the book as {orderbook_id: {order_id: [indicator, price, quantity]}}"""
+        with self.book_lock:
+            return {orderbook_id: {order_id: list(order) for order_id, order in orders.items()}
+                for orderbook_id, orders in self.book.items() if orders}
+
+    def close(self):
+        self.closed.set()
+        self.listener.join()
+        self.incremental.close()
+        self.snapshots.close()
+
+    def _join(self, port: int) -> socket.socket:
+        """Opens a socket which receives the feed's multicast group on a port."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(("", port))
+        membership = socket.inet_aton(self.addr["group"]) + socket.inet_aton(self.addr["interface"])
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        return sock
+
+    def _listen(self):
+        """Listener thread: receives packets from both channels until closed."""
+        while not self.closed.is_set():
+            readable, _, _ = select.select([self.incremental, self.snapshots], [], [], 0.05)
+            for sock in readable:
+                channel, first, messages = MarketData.decode(sock.recv(65536))
+                with self.book_lock:
+                    if channel == MarketData.SNAPSHOT:
+                        self._on_snapshot(first, messages)
+                    elif channel == MarketData.RETRANSMISSION and not messages:
+                        self._restart()
+                    else:
+                        self._on_packet(first, messages)
+            with self.book_lock:
+                if self.recovery_deadline is not None and time.monotonic() > self.recovery_deadline:
+                    self._restart()
+
+    def _restart(self):
+        """Gives up on recovering a gap, and waits for the next snapshot."""
+        self.sequence = None
+        self.requested_until = None
+        self.recovery_deadline = None
+
+    def _on_snapshot(self, sequence: int, messages: list):
+        """Collects snapshot packets, and starts from the snapshot once it is complete."""
+        if self.sequence is not None or not messages:
+            return
+        if messages[0][0] == "B":
+            self.snapshot = (sequence, messages[0][1], [])
+            messages = messages[1:]
+        if self.snapshot is None or self.snapshot[0] != sequence:
+            self.snapshot = None
+            return
+        orders = self.snapshot[2]
+        for message in messages:
+            if message[0] == "A":
+                orders.append(message)
+            elif message[0] == "F":
+                if len(orders) == self.snapshot[1]:
+                    self.book = {}
+                    for order in orders:
+                        MarketDataPublisher._apply(self.book, order)
+                    self.sequence = sequence
+                    self.held = {first: held for first, held in self.held.items() if first + len(held) - 1 > sequence}
+                    self._drain_held()
+                self.snapshot = None
+
+    def _on_packet(self, first: int, messages: list):
+        """Applies an incremental or retransmitted packet, holding it back after a gap."""
+        if messages:
+            self.held[first] = messages
+        if self.sequence is None:
+            return
+        self._drain_held()
+        if self.requested_until is not None and self.sequence >= self.requested_until:
+            self.recovered += 1
+            self.requested_until = None
+            self.recovery_deadline = None
+
+        # A heartbeat shows the next sequence number, so also reveals lost trailing messages.
+        missing_until = (min(self.held) if self.held else first) - 1
+        if missing_until > self.sequence and self.requested_until is None:
+            self.gaps += 1
+            if missing_until - self.sequence > MarketData.MAX_REQUEST_COUNT:
+                self._restart()
+                return
+            self.requested_until = missing_until
+            self.recovery_deadline = time.monotonic() + self.RECOVERY_TIMEOUT
+            request = MarketData.REQUEST.pack(self.sequence + 1, missing_until - self.sequence)
+            self.incremental.sendto(request, (self.addr["interface"], self.addr["recovery_port"]))
+
+    def _drain_held(self):
+        """Applies held packets for as long as they continue the sequence."""
+        while self.held:
+            first = min(self.held)
+            if first > self.sequence + 1:
+                return
+            messages = self.held.pop(first)
+            for message in messages[self.sequence + 1 - first:]:
+                MarketDataPublisher._apply(self.book, message)
+            self.sequence = max(self.sequence, first + len(messages) - 1)
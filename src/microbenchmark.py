@@ -0,0 +1,389 @@
+"""
+The OUCH Team
+Microbenchmarks
+
+Times the hot paths of the exchange on their own, against repeatable fixtures: orderbook
+operations against pre-populated books of different sizes and shapes, packaging and
+unpackaging of messages, splitting of received bytes into messages, and printing of the
+orderbook to the console. Every run of a case is deterministic, so reports from different
+commits can be compared with each other.
+"""
+import gc
+import os
+import platform
+import random
+import socket
+import sys
+import time
+from datetime import datetime
+
+from src.OrderBook import OrderBook
+from src.processor import MessageProcessor
+from src.receiver import Receiver
+from src.framing import FrameReader
+from src.snapshot import Snapshot
+from src.console import Console
+from src.benchmark import Benchmark
+from src.util import Util
+
+
+class BookFixture:
+    """
+    BookFixture
+
+    An orderbook pre-populated with resting orders of one client on one orderbook ID, split
+    evenly between bids below and asks above a mid price, in one of three layouts:
+    - spread: orders spread over SPREAD_LEVELS price levels on each side.
+    - deep: every order on each side in a single price level.
+    - sparse: every order in a price level of its own.
+    """
+    LAYOUTS = ("spread", "deep", "sparse")
+    SPREAD_LEVELS = 100
+    MID_TICKS = 1_000_000
+    QUANTITY = 100
+    CLIENT_ID = 0
+    # The console has no symbol for orderbook ID 0.
+    ORDERBOOK_ID = 1
+
+    def __init__(self, orders: int, layout: str):
+        if layout not in self.LAYOUTS:
+            raise ValueError(f"Unsupported fixture layout {layout}.")
+        self.orders = orders
+        self.layout = layout
+        self.orderbook = OrderBook()
+
+        # Price levels on each side in ticks, worst first.
+        half = (orders + 1) // 2
+        if layout == "spread":
+            levels = min(self.SPREAD_LEVELS, half)
+        elif layout == "deep":
+            levels = 1
+        else:
+            levels = half
+        self.bid_ticks = [self.MID_TICKS - levels + i for i in range(levels)]
+        self.ask_ticks = [self.MID_TICKS + levels - i for i in range(levels)]
+
+        def resting_orders():
+            for i in range(orders):
+                side = i % 2
+                ticks = (self.ask_ticks if side else self.bid_ticks)[i // 2 % levels]
+                yield ("S" if side else "B", ticks / 10, self.QUANTITY, self.ORDERBOOK_ID, 99999,
+                    0, i + 1, i + 1, self.CLIENT_ID)
+
+        Snapshot._restore(self.orderbook, resting_orders(), [(self.CLIENT_ID, orders)], 0, 0)
+        self.next_token = orders + 1
+        self.rng = random.Random(0)
+
+        # Enter and replace messages as they are decoded by Util.unpackage, to copy from.
+        self.enter_template = Util.unpackage(b'O', Util.package(["O", 0, "benchmark ", "B", 1, self.ORDERBOOK_ID,
+            "DAY ", 0.1, 99999, 0, "P", "P", 0, "1", "1"])[1:])
+        self.replace_template = Util.unpackage(b'U', Util.package(["U", 0, 0, 1, 0.1, 99999, "P", 0])[1:])
+
+    def name(self) -> str:
+        return f"{self.layout}-{self.orders}"
+
+    def passive_price(self, is_bid: bool) -> float:
+        """Returns the price of a random level already on one side of the book."""
+        return self.rng.choice(self.bid_ticks if is_bid else self.ask_ticks) / 10
+
+    def enter_message(self, is_bid: bool, price: float, quantity: int) -> dict:
+        msg = dict(self.enter_template)
+        msg["order_token"] = self.next_token
+        msg["buy_sell_indicator"] = "B" if is_bid else "S"
+        msg["quantity"] = quantity
+        msg["price"] = price
+        self.next_token += 1
+        return msg
+
+    def replace_message(self, token: int, price: float, quantity: int) -> dict:
+        msg = dict(self.replace_template)
+        msg["existing_order_token"] = token
+        msg["replacement_order_token"] = self.next_token
+        msg["quantity"] = quantity
+        msg["price"] = price
+        self.next_token += 1
+        return msg
+
+    def enter_passive(self, number: int) -> list:
+        """Enters orders which rest without trading, untimed, and returns their tokens."""
+        tokens = []
+        for i in range(number):
+            msg = self.enter_message(i % 2 == 0, self.passive_price(i % 2 == 0), self.QUANTITY)
+            tokens.append(msg["order_token"])
+            self.orderbook.handle_order(self.CLIENT_ID, msg)
+        return tokens
+
+    def cancel(self, tokens: list):
+        """Cancels orders, untimed."""
+        for token in tokens:
+            self.orderbook.handle_order(self.CLIENT_ID, {"message_type": "X", "order_token": token, "quantity": 0})
+
+
+class Microbenchmark:
+    """
+    Microbenchmark
+
+    Each case times a number of operations of one kind per round, excluding the time taken
+    to prepare their inputs and to undo their effect on the fixture, and is run for several
+    rounds. The garbage collector is disabled while operations are timed. Cases which take a
+    fixture are run against every fixture, up to a maximum fixture size.
+    """
+    # {case name: (method name, whether it takes a fixture, maximum fixture size)}
+    CASES = {
+        "orderbook.enter": ("_orderbook_enter", True, None),
+        "orderbook.match": ("_orderbook_match", True, None),
+        "orderbook.replace": ("_orderbook_replace", True, None),
+        "orderbook.cancel": ("_orderbook_cancel", True, None),
+        "processor.enter": ("_processor_enter", True, None),
+        "processor.enter_batch": ("_processor_enter_batch", True, None),
+        "util.package": ("_util_package", False, None),
+        "util.unpackage": ("_util_unpackage", False, None),
+        "receiver.receive_bytes": ("_receiver_receive_bytes", False, None),
+        "framing.split_frames": ("_framing_split_frames", False, None),
+        # Tabulating the whole book takes seconds for a hundred thousand orders.
+        "console.print": ("_console_print", True, 10_000)
+    }
+
+    def __init__(self, sizes: tuple = (1000, 100_000, 1_000_000), layouts: tuple = BookFixture.LAYOUTS,
+            number: int = 1000, repeat: int = 5, cases: list = None):
+        """
+        :param sizes: Numbers of resting orders of the fixtures.
+        :param layouts: Layouts of the fixtures (see BookFixture).
+        :param number: Operations timed per round.
+        :param repeat: Rounds of each case.
+        :param cases: Names of the cases to run, or None to run every case.
+        """
+        for case in cases or ():
+            if case not in self.CASES:
+                raise ValueError(f"Unknown microbenchmark case {case}.")
+        if number < 1 or repeat < 1:
+            raise ValueError("Number and repeat must be positive.")
+        self.sizes = sizes
+        self.layouts = layouts
+        self.number = number
+        self.repeat = repeat
+        self.cases = cases or list(self.CASES)
+
+    def run(self, progress=None) -> dict:
+        """
+        Runs every case and returns the results.
+
+        :param progress: Called with the name and result of each case once it has run.
+        """
+        results = {}
+
+        def record(name, method, *args):
+            # Fixture cases run at most a tenth of the fixture size of operations per round, so
+            # operations which add orders don't change the size of small fixtures too much.
+            number = self.number if not args else min(self.number, max(args[0].orders // 10, 1))
+            if name.startswith("console."):
+                number = 1
+            rounds = [method(*args, number) / number for _ in range(self.repeat)]
+            rounds.sort()
+            result = {
+                "number": number,
+                "repeat": self.repeat,
+                "min_ns": rounds[0],
+                "median_ns": rounds[len(rounds) // 2],
+                "max_ns": rounds[-1]
+            }
+            results[name] = result
+            if progress is not None:
+                progress(name, result)
+
+        for case in self.cases:
+            method_name, uses_fixture, _ = self.CASES[case]
+            if not uses_fixture:
+                record(case, getattr(self, method_name))
+        for layout in self.layouts:
+            for size in self.sizes:
+                cases = [case for case in self.cases if self.CASES[case][1] and
+                    (self.CASES[case][2] is None or size <= self.CASES[case][2])]
+                if not cases:
+                    continue
+                fixture = BookFixture(size, layout)
+                for case in cases:
+                    record(f"{case}[{fixture.name()}]", getattr(self, self.CASES[case][0]), fixture)
+                del fixture
+
+        return {
+            "version": Benchmark.version(),
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "config": {
+                "sizes": list(self.sizes),
+                "layouts": list(self.layouts),
+                "number": self.number,
+                "repeat": self.repeat
+            },
+            "results": results
+        }
+
+    @staticmethod
+    def compare(results: dict, baseline: dict, tolerance: float = 0.1) -> list:
+        """
+        Compares results against the results of a baseline run.
+
+        :param tolerance: Fraction by which the median time of a case may rise before it counts
+            as a regression.
+        :returns: List of (case, baseline median, median, relative change, regressed) tuples
+            for every case in both runs.
+        """
+        comparison = []
+        for name, result in results["results"].items():
+            old_result = baseline["results"].get(name)
+            if old_result is None:
+                continue
+            old = old_result["median_ns"]
+            new = result["median_ns"]
+            change = (new - old) / old if old else 0.0
+            comparison.append((name, old, new, change, change > tolerance))
+        return comparison
+
+    @staticmethod
+    def _timed(operation, inputs: list) -> int:
+        """Returns the nanoseconds taken to call operation with each input in turn."""
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            start = time.perf_counter_ns()
+            for args in inputs:
+                operation(*args)
+            return time.perf_counter_ns() - start
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    # Orderbook cases. Each leaves the fixture as it found it, apart from match, which
+    # trades away one unit of resting quantity per operation.
+
+    def _orderbook_enter(self, fixture: BookFixture, number: int) -> int:
+        msgs = [fixture.enter_message(i % 2 == 0, fixture.passive_price(i % 2 == 0), fixture.QUANTITY)
+            for i in range(number)]
+        elapsed = self._timed(fixture.orderbook.handle_order, [(fixture.CLIENT_ID, msg) for msg in msgs])
+        fixture.cancel([msg["order_token"] for msg in msgs])
+        return elapsed
+
+    def _orderbook_match(self, fixture: BookFixture, number: int) -> int:
+        # Orders of quantity 1 priced through the whole of the other side, so they trade at its
+        # best price however much of it earlier rounds have traded away.
+        msgs = [fixture.enter_message(i % 2 == 0, (fixture.ask_ticks if i % 2 == 0 else fixture.bid_ticks)[0] / 10, 1)
+            for i in range(number)]
+        elapsed = self._timed(fixture.orderbook.handle_order, [(fixture.CLIENT_ID, msg) for msg in msgs])
+        fixture.orderbook.get_executions()
+        return elapsed
+
+    def _orderbook_replace(self, fixture: BookFixture, number: int) -> int:
+        tokens = fixture.enter_passive(number)
+        msgs = [fixture.replace_message(token, fixture.passive_price(i % 2 == 0), fixture.QUANTITY // 2)
+            for i, token in enumerate(tokens)]
+        elapsed = self._timed(fixture.orderbook.handle_order, [(fixture.CLIENT_ID, msg) for msg in msgs])
+        fixture.cancel([msg["replacement_order_token"] for msg in msgs])
+        return elapsed
+
+    def _orderbook_cancel(self, fixture: BookFixture, number: int) -> int:
+        tokens = fixture.enter_passive(number)
+        return self._timed(fixture.orderbook.handle_order,
+            [(fixture.CLIENT_ID, {"message_type": "X", "order_token": token, "quantity": 0}) for token in tokens])
+
+    def _processor_enter(self, fixture: BookFixture, number: int) -> int:
+        # Decoding, validation and the orderbook together, as for a message from a client.
+        processor = MessageProcessor(fixture.orderbook)
+        inputs = []
+        for i in range(number):
+            is_bid = i % 2 == 0
+            message = Util.package(["O", fixture.next_token, "benchmark ", "B" if is_bid else "S",
+                fixture.QUANTITY, fixture.ORDERBOOK_ID, "DAY ", fixture.passive_price(is_bid), 99999, 0, "P", "P", 0, "1", "1"])
+            fixture.next_token += 1
+            inputs.append((fixture.CLIENT_ID, message[0:1], message[1:]))
+        elapsed = self._timed(processor._apply_message, inputs)
+        fixture.cancel([fixture.next_token - number + i for i in range(number)])
+        return elapsed
+
+    def _processor_enter_batch(self, fixture: BookFixture, number: int) -> int:
+        # The same orders decoded and validated together, as when replaying the journal.
+        processor = MessageProcessor(fixture.orderbook)
+        messages = []
+        for i in range(number):
+            is_bid = i % 2 == 0
+            messages.append(Util.package(["O", fixture.next_token, "benchmark ", "B" if is_bid else "S",
+                fixture.QUANTITY, fixture.ORDERBOOK_ID, "DAY ", fixture.passive_price(is_bid), 99999, 0, "P", "P", 0, "1", "1"]))
+            fixture.next_token += 1
+        elapsed = self._timed(processor._apply_batch, [([fixture.CLIENT_ID] * number, b"O", b"".join(messages))])
+        fixture.cancel([fixture.next_token - number + i for i in range(number)])
+        return elapsed
+
+    # Message cases.
+
+    # One message of every type, as lists of fields.
+    MESSAGES = {
+        "O": ["O", 1234, "benchmark ", "B", 100, 0, "DAY ", 100.5, 99999, 0, "P", "P", 0, "1", "1"],
+        "U": ["U", 1234, 1235, 100, 100.5, 99999, "P", 0],
+        "X": ["X", 1234, 0],
+        "A": ["A", 0, 1234, "benchmark ", "B", 100, 0, "DAY ", 1005, 99999, 0, "P", "P", 1, 0, "L", "1", "1"],
+        "E": ["E", 0, 1234, 100, 1005, "R", 1],
+        "C": ["C", 0, 1234, 100, "U"]
+    }
+
+    def _util_package(self, number: int) -> int:
+        messages = list(self.MESSAGES.values())
+        return self._timed(Util.package, [(messages[i % len(messages)], ) for i in range(number)])
+
+    def _util_unpackage(self, number: int) -> int:
+        packaged = [Util.package(message) for message in self.MESSAGES.values()]
+        return self._timed(Util.unpackage,
+            [(packaged[i % len(packaged)][0:1], packaged[i % len(packaged)][1:]) for i in range(number)])
+
+    def _inbound_stream(self, number: int) -> bytes:
+        """Returns a stream of inbound messages, as pipelined by a client."""
+        inbound = [Util.package(self.MESSAGES[header]) for header in ("O", "U", "X")]
+        return b"".join(inbound[i % len(inbound)] for i in range(number))
+
+    def _receiver_receive_bytes(self, number: int) -> int:
+        # The messages are sent over a socket pair in one burst, and read as a receiver thread
+        # reads them from a client.
+        stream = self._inbound_stream(number)
+        sender, receiver = socket.socketpair()
+        try:
+            sender.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, len(stream))
+            receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, len(stream))
+            sender.sendall(stream)
+            reader = FrameReader(receiver, Receiver.INBOUND_BODY_LENGTH_DICT)
+            gc.disable()
+            received = 0
+            start = time.perf_counter_ns()
+            while received < number:
+                received += len(Receiver._receive_bytes(None, reader))
+            elapsed = time.perf_counter_ns() - start
+            gc.enable()
+        finally:
+            sender.close()
+            receiver.close()
+        return elapsed
+
+    def _framing_split_frames(self, number: int) -> int:
+        # Splitting without system calls, as the asyncio receiver does.
+        stream = self._inbound_stream(number)
+        reader = FrameReader(None, Receiver.INBOUND_BODY_LENGTH_DICT, buffer_size=len(stream))
+        reader.get_buffer()[:len(stream)] = stream
+        reader.buffer_updated(len(stream))
+        return self._timed(reader.split_frames, [()])
+
+    # Console cases.
+
+    def _console_print(self, fixture: BookFixture, number: int) -> int:
+        # Console output, including the terminal commands it runs, goes to the null device.
+        saved = [os.dup(1), os.dup(2)]
+        null = os.open(os.devnull, os.O_WRONLY)
+        try:
+            sys.stdout.flush()
+            os.dup2(null, 1)
+            os.dup2(null, 2)
+            return self._timed(lambda: Console(loadfrom=fixture.orderbook.get_book()).print(),
+                [() for _ in range(number)])
+        finally:
+            sys.stdout.flush()
+            for fd, descriptor in enumerate(saved, start=1):
+                os.dup2(descriptor, fd)
+                os.close(descriptor)
+            os.close(null)
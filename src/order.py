@@ -0,0 +1,247 @@
+"""
+The OUCH Team
+Order Store
+
+Compact storage of the orders resting in the orderbook, the index used to find them by the
+token their client refers to them with, and the allocator for order numbers.
+"""
+import array
+from bisect import bisect_left
+
+
+class OrderStore:
+    """
+    OrderStore
+
+    Holds the fields of every resting order in parallel typed arrays (one column per field),
+    so an order is a slot number, the same index into every column, rather than a Python
+    object. The prev/next columns link each order into the intrusive doubly linked list of its
+    price level by slot number. The slots of orders which leave the book are kept on a free
+    list, threaded through the next column, and reused before the columns are grown, so the
+    store only grows with the greatest number of orders resting at once.
+    """
+    # class constant: slot number meaning "no order", at the ends of linked lists
+    NONE = -1
+
+    def __init__(self):
+        # Each column holds one item per slot. Prices are kept as floats, as they are used by
+        # the price ladders; the buy/sell indicator is kept as its ascii code.
+        self.price = array.array("d")
+        self.time_received = array.array("Q") # nanoseconds since midnight
+        self.quantity = array.array("I")
+        self.orderbook_id = array.array("I")
+        self.time_in_force = array.array("I")
+        self.order_id = array.array("I")
+        self.token = array.array("I")
+        self.client_id = array.array("I")
+        self.prev = array.array("i")
+        self.next = array.array("i")
+        self.indicator = array.array("B")
+
+        # First slot of the free list, and the number of slots in use.
+        self.free = self.NONE
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def capacity(self) -> int:
+        """Returns the number of slots held, whether in use or free."""
+        return len(self.quantity)
+
+    def add(self, indicator: str, price: float, quantity: int, orderbook_id: int,
+            time_in_force: int, time_received: int, order_id: int, token: int, client_id: int) -> int:
+        """
+        Stores an order in a free slot, growing the columns if there is none. The order is not
+        linked to any other order.
+
+        :returns: The slot of the order.
+        """
+        slot = self.free
+        if slot == self.NONE:
+            slot = len(self.quantity)
+            self.price.append(price)
+            self.time_received.append(time_received)
+            self.quantity.append(quantity)
+            self.orderbook_id.append(orderbook_id)
+            self.time_in_force.append(time_in_force)
+            self.order_id.append(order_id)
+            self.token.append(token)
+            self.client_id.append(client_id)
+            self.prev.append(self.NONE)
+            self.next.append(self.NONE)
+            self.indicator.append(ord(indicator))
+        else:
+            self.free = self.next[slot]
+            self.price[slot] = price
+            self.time_received[slot] = time_received
+            self.quantity[slot] = quantity
+            self.orderbook_id[slot] = orderbook_id
+            self.time_in_force[slot] = time_in_force
+            self.order_id[slot] = order_id
+            self.token[slot] = token
+            self.client_id[slot] = client_id
+            self.prev[slot] = self.NONE
+            self.next[slot] = self.NONE
+            self.indicator[slot] = ord(indicator)
+        self.count += 1
+        return slot
+
+    def free_slot(self, slot: int):
+        """Puts the slot of an order which has left the book on the free list."""
+        self.next[slot] = self.free
+        self.free = slot
+        self.count -= 1
+
+    def to_list(self, slot: int) -> list:
+        """
+        Returns the order in a slot as a new list in the column order used by the console output:
+        [indicator, price, quantity, orderbook_id, time_in_force, time_received, order_id, token]
+        """
+        return [
+            chr(self.indicator[slot]),
+            self.price[slot],
+            self.quantity[slot],
+            self.orderbook_id[slot],
+            self.time_in_force[slot],
+            self.time_received[slot],
+            self.order_id[slot],
+            self.token[slot]
+        ]
+
+
+class OrderIndex:
+    """
+    OrderIndex
+
+    Finds the slot of a live order from its client id and the token currently referring to
+    it. A client's tokens must increase across all of its orders, so each client's tokens are
+    appended to an array in ascending order, with the slot of each order in a parallel array,
+    and looked up by bisection. This costs 8 bytes per order, where a dictionary entry with
+    its key and value objects costs over 100. Removed orders are marked with OrderStore.NONE
+    and compacted away once they are half of a client's entries, and a client's arrays are
+    dropped with its last live order.
+    """
+    def __init__(self):
+        # {client_id: [<tokens array>, <slots array>, live order count]}
+        self.clients = {}
+        self.live = 0
+
+    def __len__(self):
+        return self.live
+
+    def count(self, client_id: int) -> int:
+        """Returns the number of live orders of a client."""
+        entry = self.clients.get(client_id)
+        return 0 if entry is None else entry[2]
+
+    def add(self, client_id: int, token: int, slot: int):
+        """
+        Adds an order under a token greater than every token the client has added before.
+
+        :raises ValueError: The token is not greater than the client's previous tokens.
+        """
+        entry = self.clients.get(client_id)
+        if entry is None:
+            entry = self.clients[client_id] = [array.array("I"), array.array("i"), 0]
+        tokens = entry[0]
+        if tokens and token <= tokens[-1]:
+            raise ValueError(f"Token {token} of client {client_id} is not ascending.")
+        tokens.append(token)
+        entry[1].append(slot)
+        entry[2] += 1
+        self.live += 1
+
+    def get(self, client_id: int, token: int) -> int:
+        """Returns the slot of a client's live order, or OrderStore.NONE if there is none."""
+        entry = self.clients.get(client_id)
+        if entry is None:
+            return OrderStore.NONE
+        tokens = entry[0]
+        # Clients usually number their orders consecutively (see _search).
+        i = len(tokens) - 1 - (tokens[-1] - token)
+        if i < 0 or i >= len(tokens) or tokens[i] != token:
+            i = self._search(tokens, token)
+            if i < 0:
+                return OrderStore.NONE
+        return entry[1][i]
+
+    def pop(self, client_id: int, token: int) -> int:
+        """
+        Removes a client's live order from the index.
+
+        :returns: The slot of the order.
+        :raises KeyError: The token does not refer to a live order of the client.
+        """
+        entry = self.clients.get(client_id)
+        if entry is None:
+            raise KeyError((client_id, token))
+        tokens, slots, live = entry
+        i = len(tokens) - 1 - (tokens[-1] - token)
+        if i < 0 or i >= len(tokens) or tokens[i] != token:
+            i = self._search(tokens, token)
+        if i < 0 or slots[i] == OrderStore.NONE:
+            raise KeyError((client_id, token))
+        slot = slots[i]
+        slots[i] = OrderStore.NONE
+        entry[2] = live = live - 1
+        self.live -= 1
+        if live == 0:
+            del self.clients[client_id]
+        elif live*2 < len(tokens):
+            keep = [j for j, kept in enumerate(slots) if kept != OrderStore.NONE]
+            entry[0] = array.array("I", [tokens[j] for j in keep])
+            entry[1] = array.array("i", [slots[j] for j in keep])
+        return slot
+
+    @staticmethod
+    def _search(tokens: array.array, token: int) -> int:
+        """
+        Returns the position of a token in a client's tokens by bisection, or -1 if it is not
+        there. Clients usually number their orders consecutively, and removed orders keep their
+        place until they are compacted away, so get and pop first try the position counted back
+        from the last token, and only search if the token is not there.
+        """
+        i = bisect_left(tokens, token)
+        if i == len(tokens) or tokens[i] != token:
+            return -1
+        return i
+
+
+class IdAllocator:
+    """
+    IdAllocator
+
+    Hands out dense, monotonically increasing unsigned 32 bit ids. Each id is allocated exactly
+    once, so ids never collide, and over 4 billion ids are available before the allocator is
+    exhausted. An allocator with a step greater than one allocates an interleaved subsequence,
+    so several allocators can share one id space without overlapping.
+    """
+    MAX_ID = 2**32 - 1
+
+    def __init__(self, start: int = 1, step: int = 1):
+        self.start = start
+        self.next_id = start
+        self.step = step
+
+    def allocate(self) -> int:
+        """
+        Returns the next unused id.
+
+        :raises OverflowError: All unsigned 32 bit ids have been allocated.
+        """
+        allocated = self.next_id
+        if allocated > self.MAX_ID:
+            raise OverflowError("No unsigned 32 bit ids left to allocate.")
+        self.next_id = allocated + self.step
+        return allocated
+
+    def skip_past(self, allocated: int):
+        """
+        Makes sure the next id allocated is greater than an id allocated before, such as an id
+        restored from a snapshot. Ids are still allocated from this allocator's subsequence.
+        """
+        if allocated < self.next_id:
+            return
+        steps = (allocated - self.start) // self.step + 1
+        self.next_id = self.start + steps*self.step
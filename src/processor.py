@@ -0,0 +1,253 @@
+"""
+The OUCH Team
+Message Processor
+
+Decoding, validation and orderbook handling of client messages, shared by the Exchange and
+the matching processes of a sharded exchange.
+"""
+from src.OrderBook import OrderBook
+from src.util import Util
+import src.batch_codec as batch_codec
+
+try:
+    import numpy as np
+except ImportError:
+    np = None # Messages are decoded one at a time (see batch_codec).
+
+
+class MessageProcessor():
+    PRICE_MAX = 214748364.6
+    QUANTITY_MAX = 2147483647 
+
+    # class constant: fewest messages decoded and validated together by _apply_batch. Fewer
+    # messages are decoded one at a time, as each batch has a fixed cost.
+    BATCH_MIN = 64
+
+    def __init__(self, orderbook: OrderBook):
+        """
+        Applies messages from clients to an orderbook and builds the replies to send back.
+
+        :param orderbook: OrderBook which valid orders are passed into.
+        """
+        # Whether the exchange accepts orders, reported to clients when they connect.
+        self.open = True
+        self.orderbook = orderbook
+
+    def process_message(self, msg: dict) -> list:
+        """
+        Handles one message from the receiver's queue. Any lock protecting the orderbook must
+        be held by the caller.
+
+        :param msg: Connection or message dictionary from the receiver's queue.
+        :returns: List of (client_id, bytes) replies to send, in order.
+        """
+        # A new client has established a connection.
+        if msg["type"] == "C":
+            # Acknowledge the connection by returning a server event message.
+            if not self.open:
+                outbound = ["S", Util.get_server_time(), "S"]
+            else:
+                outbound = ["S", Util.get_server_time(), "E"]
+            return [(msg["id"], Util.package(outbound))]
+
+        # A client has disconnected.
+        if msg["type"] == "D":
+            self.orderbook.end_session(msg["id"])
+            return []
+
+        # Parse message if it's not a connection or disconnection.
+        client_id = msg["id"]
+        outbound, executions = self._apply_message(client_id, msg["header"], msg["body"])
+        if len(outbound) == 0: 
+            return []
+
+        # Send outbound message back to client.
+        replies = [(client_id, Util.package(outbound))]
+
+        # Executions are reported to both parties after the response to the order.
+        for exec_client_id, exec_outbound in executions:
+            replies.append((exec_client_id, Util.package(exec_outbound)))
+        return replies
+
+    def _apply_message(self, client_id: int, header: bytes, body: bytes): # -> (list, list):
+        """
+        Decodes and validates a client message, and applies it to the orderbook. Used directly
+        when replaying messages, whose replies are not needed.
+
+        :returns: The outbound response to the message (empty if there is none), and the
+            (client_id, outbound) executions it caused.
+        """
+        content = Util.unpackage(header, body)
+
+        # Validate order fields according to the OUCH protocol.
+        valid, outbound = self._validate_order_syntax(content, client_id)
+        return self._apply_content(client_id, content, valid, outbound)
+
+    def _apply_batch(self, client_ids: list, header: bytes, buffer) -> list:
+        """
+        Decodes, validates and applies consecutive client messages of one type, in order. The
+        messages are decoded and validated together if NumPy is installed, and there are at
+        least BATCH_MIN of them.
+
+        :param client_ids: Client which sent each message.
+        :param header: Header byte of the messages.
+        :param buffer: The messages, headers included, one after another.
+        :returns: The (outbound, executions) of each message, as returned by _apply_message.
+        """
+        codec = batch_codec.INBOUND.get(header)
+        if codec is None or len(client_ids) < self.BATCH_MIN:
+            size = len(buffer) // len(client_ids) if client_ids else 0
+            return [
+                self._apply_message(client_id, header, buffer[i*size+1:(i+1)*size])
+                for i, client_id in enumerate(client_ids)
+            ]
+
+        array = codec.decode(buffer)
+        if len(array) != len(client_ids):
+            raise ValueError(f"Buffer holds {len(array)} messages from {len(client_ids)} clients.")
+        err_codes = self._validate_batch_syntax(array).tolist()
+        results = []
+        for client_id, content, err_code in zip(client_ids, codec.unpack(array), err_codes):
+            if err_code:
+                valid, outbound = self._syntax_error(content, err_code)
+            else:
+                valid, outbound = True, []
+            results.append(self._apply_content(client_id, content, valid, outbound))
+        return results
+
+    def _apply_content(self, client_id: int, content: dict, valid: bool, outbound: list): # -> (list, list):
+        """Applies a decoded and validated client message to the orderbook."""
+        msg_type = content["message_type"]
+        cancel_repl_reason = None
+        if not valid:
+            # If a replacement order is not valid, cancel the order.
+            if msg_type == 'U':
+                # Section 6.3
+                msg_type == "X"
+                content = {
+                    "message_type": "X",
+                    "order_token": content["existing_order_token"],
+                    "quantity": content["quantity"]
+                }
+                valid = True
+                cancel_repl_reason = outbound[0] # Remember order cancelled reason
+        
+        # Pass valid order into the orderbook
+        executions = []
+        if valid:
+            success, outbound = self.orderbook.handle_order(client_id, content)
+            executions = self.orderbook.get_executions()
+
+        if cancel_repl_reason != None and len(outbound) != 0:
+            if len(outbound) != 5:
+                raise ValueError("Expected cancel message but was not the same length.")
+            else:
+                outbound[4] = cancel_repl_reason
+        return outbound, executions
+
+    def _validate_order_syntax(self, content: dict, client_id: int): # -> (bool, list):
+        """
+        Validates the formatting of the order from a specfic client.
+
+        :param content: Decoded and parsed messaged sent by the client.
+        :param client_id: Unique Integer ID assigned to each client by the receiver.
+        :returns: boolean of whether the order is allowed or not.
+        """
+        msg_type = content["message_type"]
+        err_code = None
+        outbound = []
+        if msg_type == 'O':
+            # Checking Error rejected reasons in Table 3 Section 7.7.
+            # Not Implemented: H, V, i, R, F, L, C, O
+            if content["orderbook_id"] > 3 or content["orderbook_id"] < 0:
+                err_code = "S"
+            elif content["price"] > self.PRICE_MAX:
+                err_code = "X"
+            elif content["quantity"] > self.QUANTITY_MAX or content["quantity"] <= 0:
+                err_code = "Z"
+            elif content["minimum_quantity"] > 0 and content["time_in_force"] != 0:
+                err_code = "N"
+            elif content["buy_sell_indicator"] not in ("B", "S", "T", "E") or \
+                    content["order_classification"] not in ("1", "3", "4", "5", "6") or \
+                    content["time_in_force"] not in (0, 99999):
+                err_code = "Y"
+            elif content["display"] not in ("P", " "):
+                err_code = "D"
+            elif content["cash_margin_type"] not in ("1", "2", "3", "4", "5"):
+                err_code = "G"
+            else:
+                return True, outbound
+            return self._syntax_error(content, err_code)
+        elif msg_type == 'U':
+            if content["price"] > self.PRICE_MAX:
+                err_code = "X"
+            elif content["quantity"] > self.QUANTITY_MAX:
+                err_code = "Z"
+            elif content["minimum_quantity"] > 0 and content["time_in_force"] != 0:
+                err_code = "N"
+            elif content["time_in_force"] not in (0, 99999):
+                err_code = "Y"
+            elif content["display"] not in ("P", " "):
+                err_code = "D"
+            else:
+                return True, outbound
+            return self._syntax_error(content, err_code)
+        elif msg_type == 'X':
+            return True, outbound
+        else:
+            raise ValueError(f"Invalid header detected in Exchange validation.")
+
+    def _syntax_error(self, content: dict, err_code: str): # -> (bool, list):
+        """
+        Returns the outbound response to an order which failed validation: an Order Rejected
+        message for an enter order, or the cancelled reason for a replace order.
+        """
+        if content["message_type"] == 'O':
+            return False, ["J", Util.get_server_time(), content["order_token"], err_code]
+        return False, [err_code]
+
+    def _validate_batch_syntax(self, array) -> "np.ndarray":
+        """
+        Validates a batch of orders of one type decoded by batch_codec, with the same checks as
+        _validate_order_syntax applied to whole columns at once.
+
+        :returns: Array of the error code of each order, which is empty for a valid order.
+        """
+        if len(array) == 0:
+            return np.full(0, "")
+        byte_table = batch_codec.byte_table
+        msg_type = chr(array["message_type"][0])
+        if msg_type == 'O':
+            time_in_force = array["time_in_force"]
+            conditions = [
+                array["orderbook_id"] > 3,
+                array["price"] / 10 > self.PRICE_MAX,
+                (array["quantity"] > self.QUANTITY_MAX) | (array["quantity"] <= 0),
+                (array["minimum_quantity"] > 0) & (time_in_force != 0),
+                ~byte_table(b"BSTE")[array["buy_sell_indicator"]] |
+                    ~byte_table(b"13456")[array["order_classification"]] |
+                    ((time_in_force != 0) & (time_in_force != 99999)),
+                ~byte_table(b"P" + batch_codec.BLANK)[array["display"]],
+                ~byte_table(b"12345")[array["cash_margin_type"]]
+            ]
+            err_codes = ["S", "X", "Z", "N", "Y", "D", "G"]
+        elif msg_type == 'U':
+            time_in_force = array["time_in_force"]
+            conditions = [
+                array["price"] / 10 > self.PRICE_MAX,
+                array["quantity"] > self.QUANTITY_MAX,
+                (array["minimum_quantity"] > 0) & (time_in_force != 0),
+                (time_in_force != 0) & (time_in_force != 99999),
+                ~byte_table(b"P" + batch_codec.BLANK)[array["display"]]
+            ]
+            err_codes = ["X", "Z", "N", "Y", "D"]
+        elif msg_type == 'X':
+            return np.full(len(array), "")
+        else:
+            raise ValueError(f"Invalid header detected in Exchange validation.")
+        # The first failed check of each order gives its error code, as in _validate_order_syntax,
+        # so the checks are applied from last to first.
+        result = np.full(len(array), "")
+        for condition, err_code in zip(reversed(conditions), reversed(err_codes)):
+            result[condition] = err_code
+        return result
@@ -20,11 +20,165 @@ with the exchange.
 """
 import socket
 import threading
+import time
+from collections import deque
 from queue import Queue
 import pprint
 import configparser
 
 from src.util import Util
+from src.framing import FrameReader
+import src.codec as codecs
+
+class _ClientWriter:
+    """
+    Outbound buffer of a single client connection, drained by its own writer thread so that
+    the exchange never blocks on the client's socket. Bytes are written in the order they were
+    queued, and a send which only writes part of them is resumed from where it stopped.
+
+    The writer thread owns the connection, and closes it once it stops.
+    """
+    def __init__(self, receiver, connection, client_id: int, backlog=()):
+        """
+        :param backlog: Iterable of bytes written before anything queued with put, such as a
+            replay of earlier replies. It is iterated by the writer thread as it writes.
+        """
+        self.receiver = receiver
+        self.connection = connection
+        self.client_id = client_id
+        self.backlog = backlog
+
+        # Bytes queued by the exchange and not yet written, and the number of them, which
+        # includes bytes taken by the writer thread until they have been sent.
+        self.pending = deque()
+        self.pending_bytes = 0
+        self.condition = threading.Condition()
+
+        # closed discards unsent bytes, and finishing stops the writer once they are sent.
+        self.closed = False
+        self.finishing = False
+
+        # Bytes dropped since the buffer last had room, under the "drop" policy.
+        self.dropped = 0
+
+        self.thread = threading.Thread(
+            name = "writer"+str(client_id),
+            target = lambda: self._write_thread(),
+            daemon = True
+        )
+        self.thread.start()
+
+    def put(self, data: bytes):
+        """
+        Queues bytes to be written to the client. If the client has not read enough of its
+        replies for them to fit in the receiver's send_buffer, the slow_consumer policy is
+        applied instead.
+        """
+        self.condition.acquire()
+        try:
+            if self.closed or self.finishing:
+                return
+            # Once replies are being dropped, they are dropped until half the buffer is free.
+            limit = self.receiver.send_buffer // 2 if self.dropped else self.receiver.send_buffer
+            if self.pending_bytes + len(data) > limit:
+                if self.receiver.slow_consumer == "drop":
+                    if not self.dropped:
+                        self.receiver._log(f"client_id {self.client_id} is not reading its replies, dropping them.")
+                    self.dropped += len(data)
+                else:
+                    self.receiver._log(f"client_id {self.client_id} is not reading its replies, disconnecting.")
+                    self._close()
+                return
+            if self.dropped:
+                self.receiver._log(f"client_id {self.client_id} caught up after {self.dropped} bytes were dropped.")
+                self.dropped = 0
+            self.pending.append(data)
+            self.pending_bytes += len(data)
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def finish(self):
+        """Stops the writer thread once every queued byte has been written."""
+        self.condition.acquire()
+        self.finishing = True
+        self.condition.notify()
+        self.condition.release()
+
+    def close(self):
+        """
+        Discards unsent bytes and stops the writer thread. The connection is shut down, which
+        wakes both the writer and the client's listener thread from a blocking send or recv.
+        """
+        self.condition.acquire()
+        self._close()
+        self.condition.release()
+
+    def _close(self):
+        """close, with the condition's lock already held."""
+        if self.closed:
+            return
+        self.closed = True
+        self.pending.clear()
+        self.pending_bytes = 0
+        self.condition.notify()
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _write_thread(self):
+        """Writes queued bytes to the connection until the writer is closed or finished."""
+        connection = self.connection
+        condition = self.condition
+        pending = self.pending
+        for data in self.backlog:
+            if self.closed or not self._write(data, False):
+                break
+        self.backlog = None
+        while True:
+            condition.acquire()
+            while not pending and not self.closed and not self.finishing:
+                condition.wait()
+            if self.closed or not pending:
+                condition.release()
+                break
+            data = pending[0] if len(pending) == 1 else b"".join(pending)
+            pending.clear()
+            condition.release()
+            if not self._write(data, True):
+                break
+        # Shut the connection down before closing it, to wake the client's listener thread.
+        try:
+            connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        connection.close()
+
+    def _write(self, data: bytes, queued: bool) -> bool:
+        """
+        Writes bytes to the connection, resuming partial sends. Bytes which were queued are
+        taken off pending_bytes as they are sent.
+
+        :returns: False if the client disconnected, which closes the writer.
+        """
+        condition = self.condition
+        view = memoryview(data)
+        try:
+            while view:
+                sent = self.connection.send(view)
+                view = view[sent:]
+                if queued:
+                    condition.acquire()
+                    if not self.closed:
+                        self.pending_bytes -= sent
+                    condition.release()
+        except OSError:
+            # The client disconnected. Its listener thread logs the disconnection.
+            self.close()
+            return False
+        return True
+
 
 class Receiver():
 
@@ -42,7 +196,29 @@ class Receiver():
         b'J' : 13,  # REJECTED
     }
 
-    def __init__(self):
+    # class constant: Body length of each message a client may send. BODY_LENGTH_DICT can only
+    # hold one length for b'U', which is the length of the outbound Order Replaced message.
+    INBOUND_BODY_LENGTH_DICT = {header: codec.body_size for header, codec in codecs.INBOUND.items()}
+
+    # class constant: number of recent messages kept in the message log. The full history of
+    # messages is kept by the exchange's journal, if it has one.
+    MESSAGE_LOG_SIZE = 1000
+
+    # class constant: number of recent connections and disconnections kept in the connection log.
+    CONNECTION_LOG_SIZE = 1000
+
+    # class constant: bytes of replies each client may leave unread before the slow consumer
+    # policy is applied to it.
+    SEND_BUFFER = 1024 * 1024
+
+    # class constant: what happens to replies for a client which has left SEND_BUFFER bytes
+    # unread - it is disconnected, or its replies are dropped until half the buffer is free.
+    SLOW_CONSUMER_POLICIES = ("disconnect", "drop")
+
+    # class constant: seconds terminate waits for each client's remaining replies to be written.
+    FLUSH_TIMEOUT = 1.0
+
+    def __init__(self, client_no: int = 0, stamp: bool = False, send_buffer: int = SEND_BUFFER, slow_consumer: str = "disconnect"):
         """
         This class accepts connections from multiple clients by spawning a new thread
         whenever a client connects to the socket. On initialisation, this class will
@@ -50,29 +226,44 @@ class Receiver():
 
         Messages from the client will be placed into a shared queue, which can be retrieved
         by a context which calls the get_queue function.
+
+        :param client_no: Client id given to the first connection. Client ids are never reused,
+            so an exchange recovering its orderbook starts after the ids it has already seen.
+        :param stamp: Whether to stamp each message with the perf_counter_ns time it was
+            received, as "received" (see StageStats).
+        :param send_buffer: Bytes of replies each client may leave unread. Replies are written
+            by a thread per client, so a client which does not read them never blocks the exchange.
+        :param slow_consumer: Policy applied to a client which has left send_buffer bytes
+            unread, one of SLOW_CONSUMER_POLICIES.
         """
+        self._validate_send_options(send_buffer, slow_consumer)
+        self.send_buffer = send_buffer
+        self.slow_consumer = slow_consumer
+
         # Message queue which will be retrieved by the exchange
         self.queue = Queue() 
+        self.stamp = stamp
 
         # Prepare socket
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._setup_socket()
 
-        # {client_id: socket}
+        # {client_id: _ClientWriter} of connected clients.
         self.client_dict = {}
         self.client_dict_lock = threading.Lock()
-        self.client_no = 0
+        self.client_no = client_no
+        self.client_no_lock = threading.Lock()
 
-        # List of all messages received by the server socket in sequence - for debugging.
+        # The most recent messages received by the server socket in sequence - for debugging.
         self.message_log_lock = threading.Lock()
-        self.message_log = []
+        self.message_log = deque(maxlen=self.MESSAGE_LOG_SIZE)
 
-        # List of connections and disconnections - for debugging.
+        # The most recent connections and disconnections - for debugging.
         self.connection_log_lock = threading.Lock()
-        self.connection_log = []
+        self.connection_log = deque(maxlen=self.CONNECTION_LOG_SIZE)
 
-        # List of client Thread objects.
-        self.threads = []
+        # Thread of each connected client. {client_id: Thread}
+        self.threads = {}
         self.thread_lock = threading.Lock()
 
         # Daemon thread which listens for and accepts connections.
@@ -85,17 +276,45 @@ class Receiver():
     
     def send_message(self, client_id: int, msg: bytes):
         """
-        Sends a byte message to the connection hashed to by the client_id.
+        Queues a byte message to be written to the connection hashed to by the client_id. This
+        never blocks on the socket. Messages for a client which has not connected to this
+        receiver, such as a client of a previous run of a recovered exchange, or which has
+        disconnected, are dropped.
         """
+        self._validate_message(msg)
+        self._send(client_id, msg)
+
+    def send_messages(self, client_id: int, msgs: list):
+        """
+        Queues a list of byte messages to be written to the connection hashed to by the
+        client_id together.
+        """
+        for msg in msgs:
+            self._validate_message(msg)
+        self._send(client_id, b"".join(msgs))
+
+    def _send(self, client_id: int, data: bytes):
+        self.client_dict_lock.acquire()
+        writer = self.client_dict.get(client_id)
+        self.client_dict_lock.release()
+        if writer is not None:
+            writer.put(data)
+
+    def _validate_send_options(self, send_buffer: int, slow_consumer: str):
+        """Checks the outbound buffer size and slow consumer policy."""
+        if send_buffer < 1:
+            raise ValueError(f"Send buffer of {send_buffer} bytes must be at least 1 byte.")
+        if slow_consumer not in self.SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Slow consumer policy {slow_consumer} not defined.")
+
+    def _validate_message(self, msg: bytes):
+        """Checks that an outbound message has a valid header and length."""
         header = msg[0:1]
         if header in self.BODY_LENGTH_DICT.keys():
             if len(msg)-1 != self.BODY_LENGTH_DICT[header]:
                 raise ValueError(f"Message {msg} has invalid length {len(msg)}")
         else:
             raise ValueError(f"Sending message with invalid header '{header}'")
-        self.client_dict_lock.acquire()
-        self.client_dict[client_id].send(msg)
-        self.client_dict_lock.release()
 
     def get_queue(self) -> Queue:
         """Returns the message queue."""
@@ -109,7 +328,7 @@ class Receiver():
         print("-----------")
         pprint.pprint(self.message_log)
         self.message_log_lock.release()
-        print("Address: " + str(self.DEFAULT_ADDRESS))
+        print("Address: " + str(Util.get_addr()))
     
     def print_connections(self):
         """Prints the log of connections to and disconnections from the server."""
@@ -121,27 +340,76 @@ class Receiver():
             print(event)
         self.connection_log_lock.release()
 
+    def get_connection_log(self, count: int) -> list:
+        """Returns a copy of the most recent count entries of the connection log."""
+        self.connection_log_lock.acquire()
+        events = list(self.connection_log)[-count:] if count > 0 else []
+        self.connection_log_lock.release()
+        return events
+
+    def get_session_counts(self) -> dict:
+        """Returns the number of connected clients, and of client threads still running."""
+        self.client_dict_lock.acquire()
+        connections = len(self.client_dict)
+        self.client_dict_lock.release()
+        self.thread_lock.acquire()
+        threads = len(self.threads)
+        self.thread_lock.release()
+        return {
+            "connections": connections,
+            "threads": threads
+        }
+
+    def _log(self, event: str):
+        """Appends an event to the connection log."""
+        self.connection_log_lock.acquire()
+        self.connection_log.append(f"{Util.get_server_time()}: {event}")
+        self.connection_log_lock.release()
+
     def terminate(self):
         """Close all threads and shut down receiver."""
+        # Stop accepting connections, waking the listener from a blocking accept.
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+        self.daemon_listener.join()
+
+        # Write the replies already queued, then shut every connection down to wake its
+        # threads from a blocking send or recv.
         self.client_dict_lock.acquire()
-        for conn in self.client_dict.values():
-            conn.close()
+        writers = list(self.client_dict.values())
         self.client_dict_lock.release()
+        for writer in writers:
+            writer.finish()
+        deadline = time.monotonic() + self.FLUSH_TIMEOUT
+        for writer in writers:
+            writer.thread.join(max(deadline - time.monotonic(), 0))
+            writer.close()
+            writer.thread.join()
         self.thread_lock.acquire()
-        for thread in self.threads:
-            thread.join()
+        threads = list(self.threads.values())
         self.thread_lock.release()
+        for thread in threads:
+            thread.join()
     
     def _setup_socket(self):
         """Bind socket and listen for connections."""
         host, port = Util.get_addr()
+        # Allow the exchange to be restarted while old connections are in TIME_WAIT.
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket.bind((host, port))
         self.socket.listen(100)
 
     def _receive_connections_thread(self):
         """Wrapper function for threading _receive_connections."""
         while True:
-            self._receive_connections()
+            try:
+                self._receive_connections()
+            except OSError:
+                # The listening socket was closed by terminate.
+                break
 
     def _receive_connections(self):
         """
@@ -149,10 +417,11 @@ class Receiver():
         assigns a client id to each connection.
         """
         connection, addr = self.socket.accept()
-        client_id = hash((addr, self.client_no))
+        client_id = self._new_client_id()
+        writer = _ClientWriter(self, connection, client_id)
 
         self.client_dict_lock.acquire()
-        self.client_dict[client_id] = connection
+        self.client_dict[client_id] = writer
         self.client_dict_lock.release()
 
         self.connection_log_lock.acquire()
@@ -164,60 +433,77 @@ class Receiver():
             "id": client_id
         })
         client = threading.Thread(
-            name = "client"+str(self.client_no), 
-            target = lambda: self._handle_client(connection, client_id),
+            name = "client"+str(client_id),
+            target = lambda: self._handle_client(connection, client_id, writer),
             daemon = True
         )
-        client.start()
-
         self.thread_lock.acquire()
-        self.threads.append(client)
+        self.threads[client_id] = client
         self.thread_lock.release()
+        client.start()
 
+    def _new_client_id(self) -> int:
+        """
+        Returns the next client id. Other transports feeding the same queue (see ShmGateway)
+        take their client ids from the receiver too, so ids are taken under a lock.
+        """
+        self.client_no_lock.acquire()
+        client_id = self.client_no
         self.client_no += 1
+        self.client_no_lock.release()
+        return client_id
 
-    def _handle_client(self, connection, client_id):
+    def _handle_client(self, connection, client_id, writer):
         """
-        Listens to the client and puts any non-empty byte message into the queue.
+        Listens to the client and puts every complete message into the queue.
         A new thread running handle_client is spawned whenever the receiver accepts
-        a new connection.
+        a new connection. Once the client disconnects, its writer is closed, the exchange
+        is notified and the client is forgotten.
         """
+        reader = FrameReader(connection, self.INBOUND_BODY_LENGTH_DICT)
+        stamp = self.stamp
         while True:
             try:
-                header, body = self._receive_bytes(connection)
-                if body != 0x00:
-                    self.queue.put({
+                frames = self._receive_bytes(reader)
+                received = time.perf_counter_ns() if stamp else None
+                for header, body in frames:
+                    msg = {
                         "type": "M", # Message
                         "id": client_id, 
                         "header": header,
                         "body": body
-                    })
+                    }
+                    if stamp:
+                        msg["received"] = received
+                    self.queue.put(msg)
                     self.message_log_lock.acquire()
                     self.message_log.append(["id: " + str(client_id), header + body])
                     self.message_log_lock.release()
             except Exception:
+                self.client_dict_lock.acquire()
+                self.client_dict.pop(client_id, None)
+                self.client_dict_lock.release()
+                writer.close()
                 self.connection_log_lock.acquire()
                 self.connection_log.append(f"{Util.get_server_time()}: client_id {client_id} disconnected.")
                 self.connection_log_lock.release()
+                self.queue.put({
+                    "type": "D",
+                    "id": client_id
+                })
+                self.thread_lock.acquire()
+                self.threads.pop(client_id, None)
+                self.thread_lock.release()
                 break
 
-    def _receive_bytes(self, connection: socket): # -> (bytes, bytes):
+    def _receive_bytes(self, reader: FrameReader) -> list:
         """
-        Body is appropriately sized to match the header, according to Japannext OUCH Specs.
-        All illegal headers are returned with a single null byte as body.
-        """
-        # Store header byte
-        header = connection.recv(1)
+        Blocks until at least one complete message has been received from the client, and
+        returns every complete message received so far as (header, body) pairs. Bodies are
+        appropriately sized to match the header, according to Japannext OUCH Specs. A message
+        split across reads is held back until it is complete.
 
-        # Calculates expected size of body, using bodyLengthDict
-        body_length = 0
-        if header in self.BODY_LENGTH_DICT.keys():
-            body_length = self.BODY_LENGTH_DICT[header]
-        else:
-            raise ValueError(f"Invalid header type '{header}'")
-
-        # grab body,
-        body = connection.recv(body_length) if body_length != 0 else 0x00
-
-        # output
-        return header, body
\ No newline at end of file
+        :raises ValueError: The client sent an illegal header.
+        :raises ConnectionError: The client disconnected.
+        """
+        return reader.read_frames()
@@ -0,0 +1,758 @@
+"""
+The OUCH Team
+Session Layer
+
+Sequenced sessions over TCP in the style of SoupBinTCP. A client logs in with a username and
+the sequence number of the next reply it expects. Every reply to a username is numbered in
+sequence and kept for the rest of the run, so a client which reconnects after losing its
+connection is sent every reply it missed before any new one. Both sides send heartbeats when
+they have nothing else to send, and a connection which has been silent for too long is closed.
+
+Every packet is a 2-byte big-endian length (counting the packet type and payload), a 1-byte
+packet type, and a payload:
+- Sent by clients: 'L' Login Request (username 6, password 10, session 10, sequence number 20),
+  'U' Unsequenced Data (one inbound OUCH message), 'R' Client Heartbeat and 'O' Logout Request.
+- Sent by the exchange: 'A' Login Accepted (session 10, sequence number 20), 'J' Login Rejected
+  (reason 1), 'S' Sequenced Data (one outbound OUCH message), 'H' Server Heartbeat and
+  'Z' End of Session.
+Text fields are ASCII, alphanumeric fields padded on the right with spaces, and the session
+and sequence number padded on the left with spaces.
+
+Replays are written by the writer thread of the client's connection (see _ClientWriter) from
+the session's store, so any number of clients can reconnect at once without the exchange
+reprocessing an order or waiting for a replay.
+"""
+import itertools
+import mmap
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+
+import src.codec as codecs
+from src.framing import PacketReader
+from src.receiver import Receiver, _ClientWriter
+from src.util import Util
+
+
+# Length and packet type at the start of every packet.
+PACKET = struct.Struct("!Hc")
+
+# Payloads of the login packets.
+LOGIN_REQUEST = struct.Struct("!6s10s10s20s")
+LOGIN_ACCEPTED = struct.Struct("!10s20s")
+
+# Login Rejected reasons.
+NOT_AUTHORIZED = b'A'
+SESSION_NOT_AVAILABLE = b'S'
+REJECT_REASONS = {
+    NOT_AUTHORIZED: "not authorized",
+    SESSION_NOT_AVAILABLE: "session not available"
+}
+
+# Longest packets sent by clients and by the exchange, including the length field.
+MAX_INBOUND_PACKET = PACKET.size + max(LOGIN_REQUEST.size, *(codec.size for codec in codecs.INBOUND.values()))
+MAX_OUTBOUND_PACKET = PACKET.size + max(LOGIN_ACCEPTED.size, *(codec.size for codec in codecs.OUTBOUND.values()))
+
+
+def packet(packet_type: bytes, payload: bytes = b"") -> bytes:
+    """Returns a packet of the given type and payload."""
+    return PACKET.pack(len(payload) + 1, packet_type) + payload
+
+
+SERVER_HEARTBEAT = packet(b'H')
+CLIENT_HEARTBEAT = packet(b'R')
+END_OF_SESSION = packet(b'Z')
+LOGOUT_REQUEST = packet(b'O')
+
+
+class SessionStore:
+    """
+    SessionStore
+
+    Sequenced Data packets of one session, numbered from 1. Each packet is written into a
+    fixed-size slot of a memory-mapped segment file, so the slot of any sequence number is
+    found without an index, and the segments are sparse files which only take up the space
+    written to. The most recent RING_SIZE packets are also held in memory, so a client which
+    reconnects after a short interruption is replayed without touching the segments.
+
+    Only one thread may append packets, while any number of threads read them.
+    """
+    # Bytes per packet, which fits the longest outbound message.
+    SLOT_SIZE = PACKET.size + max(codec.size for codec in codecs.OUTBOUND.values())
+
+    # Packets per segment file.
+    SEGMENT_SLOTS = 65536
+
+    # Packets held in memory.
+    RING_SIZE = 1024
+
+    # Most packets returned by each read of a replay.
+    REPLAY_CHUNK = 256
+
+    SUFFIX = ".session"
+
+    def __init__(self, directory: str, name: str):
+        """
+        :param directory: Directory which the segment files are created in.
+        :param name: Name of the session, which the segment files are named after.
+        """
+        self.directory = directory
+        self.name = name
+
+        # Memory maps of the segments, in order.
+        self.segments = []
+
+        # Sequence number of the next packet to be appended.
+        self.next_sequence = 1
+
+        # Packet with sequence number s is ring[s % RING_SIZE], for the last RING_SIZE packets.
+        self.ring = [None]*self.RING_SIZE
+
+        self.closed = False
+
+    def append(self, message: bytes) -> bytes:
+        """
+        Appends an outbound message as the next Sequenced Data packet.
+
+        :returns: The packet.
+        """
+        sequence = self.next_sequence
+        data = PACKET.pack(len(message) + 1, b'S') + message
+        segment, slot = divmod(sequence - 1, self.SEGMENT_SLOTS)
+        if segment == len(self.segments):
+            self._new_segment()
+        offset = slot*self.SLOT_SIZE
+        self.segments[segment][offset:offset+len(data)] = data
+        self.ring[sequence % self.RING_SIZE] = data
+        # Packets are only read once the sequence number has been published.
+        self.next_sequence = sequence + 1
+        return data
+
+    def read(self, first: int, last: int) -> bytes:
+        """
+        Returns the packets from sequence number first up to, but not including, last, which
+        must already have been appended.
+
+        :raises ValueError, IndexError: The store has been closed.
+        """
+        ring = self.ring
+        size = self.RING_SIZE
+        if first > self.next_sequence - size:
+            packets = [ring[sequence % size] for sequence in range(first, last)]
+            # The packets are only valid if none were overwritten while they were read.
+            if first > self.next_sequence - size:
+                return b"".join(packets)
+        packets = []
+        unpack_from = PACKET.unpack_from
+        for index in range(first - 1, last - 1):
+            segment, slot = divmod(index, self.SEGMENT_SLOTS)
+            mapped = self.segments[segment]
+            offset = slot*self.SLOT_SIZE
+            packets.append(mapped[offset:offset+PACKET.size-1+unpack_from(mapped, offset)[0]])
+        return b"".join(packets)
+
+    def replay(self, first: int, last: int):
+        """
+        Yields the packets from sequence number first up to, but not including, last, in
+        chunks of up to REPLAY_CHUNK packets. Stops early if the store is closed.
+        """
+        for start in range(first, last, self.REPLAY_CHUNK):
+            if self.closed:
+                return
+            try:
+                data = self.read(start, min(start + self.REPLAY_CHUNK, last))
+            except (ValueError, IndexError):
+                # The store was closed while it was read.
+                return
+            yield data
+
+    def close(self):
+        """Unmaps and deletes the segment files."""
+        self.closed = True
+        for segment, mapped in enumerate(self.segments):
+            mapped.close()
+            os.remove(self._path(segment))
+        self.segments = []
+
+    def _new_segment(self):
+        path = self._path(len(self.segments))
+        size = self.SEGMENT_SLOTS*self.SLOT_SIZE
+        with open(path, "w+b") as f:
+            f.truncate(size)
+            self.segments.append(mmap.mmap(f.fileno(), size))
+
+    def _path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{self.name}_{segment:06d}{self.SUFFIX}")
+
+
+class _Session:
+    """
+    Logical session of one username, which keeps its client id and sequence numbers across
+    every connection logged in to it. At most one connection is logged in at a time.
+    """
+    def __init__(self, username: str, client_id: int, store: SessionStore):
+        self.username = username
+        self.client_id = client_id
+        self.store = store
+
+        # Held while appending to the store or attaching a connection, so that a connection
+        # receives every packet exactly once, either replayed or as it is sent.
+        self.lock = threading.Lock()
+
+        # Writer of the logged in connection, or None.
+        self.writer = None
+
+        # monotonic time anything was last queued for the logged in connection.
+        self.last_sent = 0.0
+
+        # Set once End of Session has been sent, after which nothing more is sent.
+        self.ended = False
+
+    def attach(self, receiver, connection, sequence: int, session_name: str) -> tuple:
+        """
+        Logs a connection in, taking over from any connection already logged in. The new
+        connection is sent Login Accepted, then every packet from sequence number sequence
+        (or from the next packet, if sequence is 0 or beyond it), then new packets.
+
+        :returns: (writer of the connection, writer of the connection taken over or None)
+        """
+        self.lock.acquire()
+        last = self.store.next_sequence
+        first = sequence if 1 <= sequence < last else last
+        accepted = packet(b'A', LOGIN_ACCEPTED.pack(session_name.encode(), f"{first:>20}".encode()))
+        writer = _ClientWriter(receiver, connection, self.client_id,
+            backlog=itertools.chain((accepted, ), self.store.replay(first, last)))
+        replaced = self.writer
+        self.writer = writer
+        self.last_sent = time.monotonic()
+        self.lock.release()
+        return writer, replaced
+
+    def detach(self, writer: _ClientWriter):
+        """Closes a connection's writer, and logs it out if it is still logged in."""
+        self.lock.acquire()
+        if self.writer is writer:
+            self.writer = None
+        self.lock.release()
+        writer.close()
+
+    def send(self, msgs: list):
+        """Appends outbound messages to the store, and queues them for the logged in connection."""
+        self.lock.acquire()
+        if not self.ended:
+            append = self.store.append
+            data = b"".join([append(msg) for msg in msgs])
+            if self.writer is not None:
+                self.writer.put(data)
+                self.last_sent = time.monotonic()
+        self.lock.release()
+
+    def heartbeat(self, now: float, interval: float):
+        """Sends a heartbeat to the logged in connection if nothing was sent for interval seconds."""
+        self.lock.acquire()
+        if self.writer is not None and not self.ended and now - self.last_sent >= interval:
+            self.writer.put(SERVER_HEARTBEAT)
+            self.last_sent = now
+        self.lock.release()
+
+    def end(self) -> _ClientWriter:
+        """
+        Sends End of Session to the logged in connection, after which nothing more is sent.
+
+        :returns: Writer of the logged in connection, which finishes once it has written
+            everything queued, or None.
+        """
+        self.lock.acquire()
+        self.ended = True
+        writer = self.writer
+        if writer is not None:
+            writer.put(END_OF_SESSION)
+            writer.finish()
+        self.lock.release()
+        return writer
+
+
+class SessionReceiver(Receiver):
+    """
+    SessionReceiver
+
+    Receiver of sequenced sessions (see the module docstring). Each username is one client of
+    the exchange for the whole run: the exchange is told it connected on its first login, and
+    never that it disconnected, since the client may log in again and receive the replies it
+    missed. Replies are only ever dropped by disconnecting the connection, as a client can
+    recover from a disconnection but not from a gap in its sequence numbers.
+    """
+    # class constant: seconds a connection may take to log in.
+    LOGIN_TIMEOUT = 5.0
+
+    # class constant: seconds without sending anything after which a heartbeat is sent.
+    HEARTBEAT_INTERVAL = 1.0
+
+    # class constant: seconds without receiving anything after which a connection is closed.
+    HEARTBEAT_TIMEOUT = 15.0
+
+    def __init__(self, client_no: int = 0, stamp: bool = False, send_buffer: int = Receiver.SEND_BUFFER, slow_consumer: str = "disconnect", directory: str = None):
+        """
+        :param directory: Directory which the session stores are created in, or None for a
+            temporary directory which is deleted on terminate. The stores are deleted on
+            terminate either way, as sessions only last for one run of the exchange.
+
+        See Receiver for the other parameters.
+        """
+        # Session name sent in Login Accepted, which is different for every run.
+        self.session_name = str(int(time.time()))[-10:].rjust(10)
+
+        self.own_directory = directory is None
+        self.directory = tempfile.mkdtemp(prefix="ouch_sessions_") if directory is None else directory
+        os.makedirs(self.directory, exist_ok=True)
+
+        # {username: _Session}, and the same sessions by client id in client_dict, both
+        # guarded by client_dict_lock.
+        self.sessions = {}
+
+        # Number given to the next connection, which names its thread until it logs in.
+        self.connection_no = 0
+
+        self.stopped = threading.Event()
+        self.heartbeat_thread = threading.Thread(
+            name = "heartbeat",
+            target = lambda: self._heartbeat_thread(),
+            daemon = True
+        )
+
+        super().__init__(client_no, stamp=stamp, send_buffer=send_buffer, slow_consumer=slow_consumer)
+        self.heartbeat_thread.start()
+
+    def send_message(self, client_id: int, msg: bytes):
+        """
+        Sequences a byte message for the session of the client_id, and queues it to be
+        written to the session's connection if one is logged in. This never blocks on the
+        socket.
+        """
+        self._validate_message(msg)
+        self._send_sequenced(client_id, (msg, ))
+
+    def send_messages(self, client_id: int, msgs: list):
+        """Sequences a list of byte messages for the session of the client_id together."""
+        for msg in msgs:
+            self._validate_message(msg)
+        self._send_sequenced(client_id, msgs)
+
+    def _send_sequenced(self, client_id: int, msgs):
+        self.client_dict_lock.acquire()
+        session = self.client_dict.get(client_id)
+        self.client_dict_lock.release()
+        if session is not None:
+            session.send(msgs)
+
+    def _validate_send_options(self, send_buffer: int, slow_consumer: str):
+        super()._validate_send_options(send_buffer, slow_consumer)
+        if slow_consumer != "disconnect":
+            raise ValueError("Sequenced sessions cannot drop replies, slow consumers can only be disconnected.")
+
+    def get_session_counts(self) -> dict:
+        """
+        Returns the number of sessions, the number of them with a connection logged in, and
+        the number of connection threads still running.
+        """
+        self.client_dict_lock.acquire()
+        sessions = list(self.sessions.values())
+        self.client_dict_lock.release()
+        self.thread_lock.acquire()
+        threads = len(self.threads)
+        self.thread_lock.release()
+        return {
+            "sessions": len(sessions),
+            "connections": sum(session.writer is not None for session in sessions),
+            "threads": threads
+        }
+
+    def terminate(self):
+        """Sends End of Session to every connection, closes all threads and deletes the stores."""
+        self.stopped.set()
+        self.heartbeat_thread.join()
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+        self.daemon_listener.join()
+
+        self.client_dict_lock.acquire()
+        sessions = list(self.sessions.values())
+        self.client_dict_lock.release()
+        writers = [writer for writer in (session.end() for session in sessions) if writer is not None]
+        deadline = time.monotonic() + self.FLUSH_TIMEOUT
+        for writer in writers:
+            writer.thread.join(max(deadline - time.monotonic(), 0))
+            writer.close()
+            writer.thread.join()
+        self.thread_lock.acquire()
+        threads = list(self.threads.values())
+        self.thread_lock.release()
+        for thread in threads:
+            thread.join()
+
+        for session in sessions:
+            session.store.close()
+        if self.own_directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _heartbeat_thread(self):
+        """Sends heartbeats to every connection which has not been sent anything recently."""
+        while not self.stopped.wait(self.HEARTBEAT_INTERVAL / 2):
+            self.client_dict_lock.acquire()
+            sessions = list(self.sessions.values())
+            self.client_dict_lock.release()
+            now = time.monotonic()
+            for session in sessions:
+                session.heartbeat(now, self.HEARTBEAT_INTERVAL)
+
+    def _receive_connections(self):
+        """
+        Daemon thread spawning a new thread whenever a client connects. Client ids are
+        assigned once the connection has logged in.
+        """
+        connection, addr = self.socket.accept()
+        # Login Accepted and the replies after it are small writes which must not wait for
+        # the client to acknowledge each other.
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection_no = self.connection_no
+        self.connection_no += 1
+        client = threading.Thread(
+            name = "connection"+str(connection_no),
+            target = lambda: self._handle_session(connection, connection_no),
+            daemon = True
+        )
+        self.thread_lock.acquire()
+        self.threads[connection_no] = client
+        self.thread_lock.release()
+        client.start()
+
+    def _handle_session(self, connection, connection_no):
+        """
+        Logs a connection in, then puts every message it sends into the queue until it logs
+        out, disconnects, breaks the protocol or stays silent for HEARTBEAT_TIMEOUT.
+        """
+        reader = PacketReader(connection, MAX_INBOUND_PACKET)
+        session = writer = None
+        try:
+            connection.settimeout(self.LOGIN_TIMEOUT)
+            packets = reader.read_frames()
+            session, writer = self._login(connection, packets[0])
+            if session is not None:
+                connection.settimeout(self.HEARTBEAT_TIMEOUT)
+                packets = packets[1:]
+                while self._put_packets(session.client_id, packets):
+                    packets = reader.read_frames()
+        except Exception:
+            pass
+        if writer is not None:
+            session.detach(writer)
+            self._log(f"client_id {session.client_id} ({session.username}) logged out.")
+        else:
+            connection.close()
+        self.thread_lock.acquire()
+        self.threads.pop(connection_no, None)
+        self.thread_lock.release()
+
+    def _login(self, connection, login: tuple) -> tuple:
+        """
+        Handles the first packet of a connection, which must be a Login Request.
+
+        :returns: (session, writer) of the connection, or (None, None) if the login was rejected.
+        :raises ValueError: The packet is not a Login Request.
+        """
+        packet_type, payload = login
+        if packet_type != b'L' or len(payload) != LOGIN_REQUEST.size:
+            raise ValueError(f"Expected a login request, not '{packet_type}'")
+        username, _, session_name, sequence = LOGIN_REQUEST.unpack(payload)
+        username = username.decode("ascii").strip()
+        session_name = session_name.decode("ascii").strip()
+        sequence = int(sequence.strip() or b"0")
+        if not username:
+            connection.sendall(packet(b'J', NOT_AUTHORIZED))
+            return None, None
+        if session_name and session_name != self.session_name.strip():
+            self._log(f"{username} rejected from session {session_name}.")
+            connection.sendall(packet(b'J', SESSION_NOT_AVAILABLE))
+            return None, None
+
+        self.client_dict_lock.acquire()
+        session = self.sessions.get(username)
+        new = session is None
+        if new:
+            client_id = self._new_client_id()
+            session = _Session(username, client_id, SessionStore(self.directory, str(client_id)))
+            self.sessions[username] = session
+            self.client_dict[client_id] = session
+        self.client_dict_lock.release()
+        if new:
+            self.queue.put({
+                "type": "C",
+                "id": session.client_id
+            })
+
+        writer, replaced = session.attach(self, connection, sequence, self.session_name)
+        if replaced is not None:
+            replaced.close()
+        self._log(f"client_id {session.client_id} ({username}) logged in from sequence number {sequence}.")
+        return session, writer
+
+    def _put_packets(self, client_id: int, packets: list) -> bool:
+        """
+        Puts the message of every Unsequenced Data packet into the queue.
+
+        :returns: False if the client logged out.
+        :raises ValueError: A packet is not valid.
+        """
+        lengths = self.INBOUND_BODY_LENGTH_DICT
+        received = time.perf_counter_ns() if self.stamp else None
+        for packet_type, payload in packets:
+            if packet_type == b'U':
+                header = payload[0:1]
+                body = payload[1:]
+                if lengths.get(header) != len(body):
+                    raise ValueError(f"Invalid message {payload}")
+                msg = {
+                    "type": "M", # Message
+                    "id": client_id,
+                    "header": header,
+                    "body": body
+                }
+                if received is not None:
+                    msg["received"] = received
+                self.queue.put(msg)
+                self.message_log_lock.acquire()
+                self.message_log.append(["id: " + str(client_id), payload])
+                self.message_log_lock.release()
+            elif packet_type == b'O':
+                return False
+            elif packet_type != b'R':
+                raise ValueError(f"Unexpected packet type '{packet_type}'")
+        return True
+
+
+class SessionClient:
+    """
+    SessionClient
+
+    Client side of a session. Messages sent are wrapped in Unsequenced Data packets, and the
+    messages of Sequenced Data packets are returned by read_frames, which keeps count of the
+    sequence number of the next reply. When the connection is lost, read_frames logs in again
+    from that sequence number, so the exchange replays every reply sent meanwhile, and sends
+    waiting for the new connection are retried on it. Resent orders are safe to retry, as the
+    exchange ignores an order token which has already been used.
+
+    A heartbeat is sent whenever nothing has been sent for HEARTBEAT_INTERVAL. The exchange does
+    the same, so a connection which receives nothing for HEARTBEAT_TIMEOUT is treated as lost,
+    as after a network failure the connection may never be closed.
+    """
+    HEARTBEAT_INTERVAL = 1.0
+    HEARTBEAT_TIMEOUT = 3*HEARTBEAT_INTERVAL
+
+    # Attempts to log in again after losing the connection, and the delay before the first,
+    # which doubles after every failed attempt.
+    RECONNECT_ATTEMPTS = 8
+    RECONNECT_DELAY = 0.05
+
+    def __init__(self, username: str, password: str = "", sequence: int = 0, session: str = ""):
+        """
+        Connects to the exchange and logs in.
+
+        :param username: Username of the session, up to 6 characters.
+        :param password: Password, up to 10 characters. Not checked by the exchange.
+        :param sequence: Sequence number of the first reply to receive, or 0 for only new replies.
+        :param session: Session to log in to, or "" for the current session.
+        :raises ConnectionRefusedError: The login was rejected.
+        """
+        if not 1 <= len(username) <= 6 or len(password) > 10 or len(session) > 10:
+            raise ValueError("Username must be 1 to 6 characters, and password and session up to 10 characters.")
+        if sequence < 0:
+            raise ValueError(f"Sequence number {sequence} must not be negative.")
+        self.addr = Util.get_addr()
+        self.username = username
+        self.password = password
+        self.session = session
+
+        # Sequence number of the next Sequenced Data packet.
+        self.next_sequence = sequence
+
+        # Connection and its reader, replaced under the condition when logging in again, and
+        # packets received with Login Accepted.
+        self.reader = None
+        self.pending = []
+        self.connected = threading.Condition()
+
+        self.send_lock = threading.Lock()
+        self.last_sent = 0.0
+        self.closed = False
+        self.ended = False
+        self._login()
+
+        self.stopped = threading.Event()
+        self.heartbeat_thread = threading.Thread(
+            name = "heartbeat",
+            target = lambda: self._heartbeat_thread(),
+            daemon = True
+        )
+        self.heartbeat_thread.start()
+
+    @staticmethod
+    def wrap(msgs: list) -> bytes:
+        """Returns inbound OUCH messages as Unsequenced Data packets."""
+        return b"".join([packet(b'U', msg) for msg in msgs])
+
+    def send(self, data: bytes):
+        """
+        Sends packets (see wrap) to the exchange. If the connection has been lost, waits
+        until read_frames has logged in again and sends them on the new connection.
+
+        :raises ConnectionError: The session was closed or ended, or could not log in again.
+        """
+        while True:
+            reader = self.reader
+            try:
+                self._send(reader.connection, data)
+                return
+            except OSError:
+                with self.connected:
+                    while self.reader is reader and not self.closed and not self.ended:
+                        self.connected.wait()
+                if self.closed or self.ended:
+                    raise ConnectionError("Session closed.")
+
+    def read_frames(self) -> list:
+        """
+        Blocks until at least one reply has been received, and returns every reply received
+        so far as (header, body) pairs, in sequence.
+
+        :raises ConnectionError: The session was closed or ended, or could not log in again.
+        :raises ValueError: The exchange sent an invalid packet.
+        """
+        while True:
+            packets = self.pending
+            self.pending = []
+            if not packets:
+                if self.ended:
+                    raise ConnectionError("End of session.")
+                reader = self.reader
+                try:
+                    packets = reader.read_frames()
+                except OSError:
+                    if self.closed:
+                        raise ConnectionError("Session closed.")
+                    self._reconnect()
+                    continue
+            frames = []
+            for packet_type, payload in packets:
+                if packet_type == b'S':
+                    frames.append((payload[0:1], payload[1:]))
+                elif packet_type == b'Z':
+                    self.ended = True
+                    with self.connected:
+                        self.connected.notify_all()
+                    break
+            self.next_sequence += len(frames)
+            if frames:
+                return frames
+
+    def close(self):
+        """Logs out and closes the connection, which wakes a blocking read_frames."""
+        self.closed = True
+        self.stopped.set()
+        with self.connected:
+            self.connected.notify_all()
+        connection = self.reader.connection
+        try:
+            self._send(connection, LOGOUT_REQUEST)
+        except OSError:
+            pass
+        try:
+            connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        connection.close()
+
+    def _send(self, connection, data: bytes):
+        with self.send_lock:
+            connection.sendall(data)
+            self.last_sent = time.monotonic()
+
+    def _login(self):
+        """
+        Connects and logs in from next_sequence.
+
+        :raises ConnectionRefusedError: The login was rejected.
+        :raises ConnectionError: The exchange could not be reached, or the connection was lost.
+        """
+        try:
+            connection = socket.create_connection(self.addr)
+        except OSError:
+            # Not ConnectionRefusedError, which means that the login was rejected.
+            raise ConnectionError(f"Could not connect to {self.addr}.")
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Reads which time out raise socket.timeout, an OSError like any other lost connection.
+        connection.settimeout(self.HEARTBEAT_TIMEOUT)
+        reader = PacketReader(connection, MAX_OUTBOUND_PACKET)
+        try:
+            connection.sendall(packet(b'L', LOGIN_REQUEST.pack(
+                self.username.ljust(6).encode(),
+                self.password.ljust(10).encode(),
+                self.session.rjust(10).encode(),
+                f"{self.next_sequence:>20}".encode()
+            )))
+            packets = reader.read_frames()
+        except (OSError, ValueError):
+            connection.close()
+            raise ConnectionError("Connection lost while logging in.")
+        packet_type, payload = packets[0]
+        if packet_type != b'A':
+            connection.close()
+            if packet_type == b'J':
+                raise ConnectionRefusedError(f"Login rejected: {REJECT_REASONS.get(payload, payload)}.")
+            raise ConnectionError(f"Expected a login response, not '{packet_type}'")
+        session, sequence = LOGIN_ACCEPTED.unpack(payload)
+        with self.connected:
+            self.session = session.decode("ascii").strip()
+            self.next_sequence = int(sequence)
+            self.pending = packets[1:]
+            self.reader = reader
+            self.last_sent = time.monotonic()
+            self.connected.notify_all()
+
+    def _reconnect(self):
+        """
+        Closes the lost connection and logs in again from next_sequence.
+
+        :raises ConnectionError: Every attempt failed, or the session was closed meanwhile.
+        """
+        self.reader.connection.close()
+        delay = self.RECONNECT_DELAY
+        for _ in range(self.RECONNECT_ATTEMPTS):
+            time.sleep(delay)
+            if self.closed:
+                break
+            try:
+                self._login()
+                return
+            except ConnectionRefusedError:
+                break
+            except OSError:
+                delay *= 2
+        self.ended = True
+        with self.connected:
+            self.connected.notify_all()
+        raise ConnectionError("Could not log in again.")
+
+    def _heartbeat_thread(self):
+        while not self.stopped.wait(self.HEARTBEAT_INTERVAL / 2):
+            if time.monotonic() - self.last_sent >= self.HEARTBEAT_INTERVAL:
+                try:
+                    self._send(self.reader.connection, CLIENT_HEARTBEAT)
+                except OSError:
+                    pass
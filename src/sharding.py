@@ -0,0 +1,282 @@
+"""
+The OUCH Team
+Sharded Matching
+
+Runs matching in several processes so that it is not limited to one core by the GIL. Orders
+for different orderbook IDs never interact, so each orderbook ID is assigned to one of the
+matching processes (shards), each of which has its own OrderBook. The exchange process acts as
+a router: it reads just enough of each message to pick its shard, and forwards the raw message
+over a shared memory ring. Replies come back over a second ring per shard and are sent to the
+clients by the exchange process.
+"""
+import multiprocessing
+import struct
+import threading
+import time
+
+from src.OrderBook import OrderBook
+from src.processor import MessageProcessor
+from src.shm_ring import ShmRing
+from src.util import Util
+
+
+# Ring records are a client id followed by one OUCH message. A client id on its own marks the
+# end of the client's session.
+CLIENT_ID = struct.Struct("!I")
+
+# Fields read by the router, at fixed offsets in the message body.
+TOKEN = struct.Struct("!I")
+REPLACE_TOKENS = struct.Struct("!II")
+ORDERBOOK_ID_OFFSET = 19 # Enter Order: token (4), client reference (10), indicator (1), quantity (4)
+
+
+# Most records a matching process drains from its inbound ring and processes with the server
+# time frozen once, as the Exchange does for a batch (see Exchange._operate_batch).
+SHARD_BATCH = 256
+
+# Seconds a matching process waits for a record before checking that the exchange process is
+# still alive.
+PARENT_CHECK_INTERVAL = 1.0
+
+
+def run_shard(shard: int, shards: int, inbound_name: str, outbound_name: str):
+    """
+    Main function of a matching process. Processes messages from the inbound ring until an
+    empty record is received, or the exchange process has died, and writes every reply to the
+    outbound ring. Once a record arrives, every record already in the ring (up to SHARD_BATCH)
+    is processed with it.
+    """
+    inbound = ShmRing.attach(inbound_name, shared_tracker=True)
+    outbound = ShmRing.attach(outbound_name, shared_tracker=True)
+    processor = MessageProcessor(OrderBook(shard, shards))
+    parent = multiprocessing.parent_process()
+    try:
+        running = True
+        while running:
+            record = inbound.get_wait(PARENT_CHECK_INTERVAL)
+            if record is None:
+                if not parent.is_alive():
+                    return
+                continue
+            batch = [record]
+            while len(batch) < SHARD_BATCH:
+                record = inbound.get()
+                if record is None:
+                    break
+                batch.append(record)
+
+            # Every message in the batch, and every reply to it, has the same timestamp.
+            Util.freeze_server_time()
+            for record in batch:
+                if len(record) == 0:
+                    running = False
+                    break
+                if len(record) == CLIENT_ID.size:
+                    msg = {
+                        "type": "D",
+                        "id": CLIENT_ID.unpack_from(record)[0]
+                    }
+                else:
+                    msg = {
+                        "type": "M",
+                        "id": CLIENT_ID.unpack_from(record)[0],
+                        "header": record[4:5],
+                        "body": record[5:]
+                    }
+                for client_id, reply in processor.process_message(msg):
+                    reply_record = CLIENT_ID.pack(client_id) + reply
+                    while not outbound.put_wait(reply_record, PARENT_CHECK_INTERVAL):
+                        if not parent.is_alive():
+                            return
+            Util.unfreeze_server_time()
+    finally:
+        inbound.close()
+        outbound.close()
+
+
+class ShardRouter:
+    """
+    ShardRouter
+
+    Starts the matching processes and routes client messages to them. Enter orders are routed
+    by orderbook ID. Replace and cancel orders do not carry an orderbook ID, so the router
+    remembers which shard each client's order tokens were sent to.
+
+    Order tokens must increase across all of a client's orders, but each shard only sees the
+    orders for its own orderbook IDs. The router therefore drops enter orders and replacements
+    whose new token is not greater than every token the client has already used, as the
+    OrderBook would. Unlike a single OrderBook, the router counts tokens of orders which are
+    then rejected by syntax validation as used.
+
+    A token is forgotten once it has been cancelled or replaced. The router does not see
+    executions, so tokens of filled orders are only forgotten at the end of their client's
+    session, along with the rest of the client's state.
+    """
+    # class constants: ring sizes. Inbound records hold at most an Enter Order (48 bytes) and
+    # outbound records at most an Order Accepted (65 bytes), each after a 4 byte client id.
+    INBOUND_SLOTS = 65536
+    INBOUND_SLOT_SIZE = 64
+    OUTBOUND_SLOTS = 131072
+    OUTBOUND_SLOT_SIZE = 128
+
+    # class constant: maximum number of replies collected from the shards before sending.
+    COLLECT_BATCH = 1024
+
+    # class constant: seconds terminate waits for each matching process to take its stop
+    # record and exit, before killing it.
+    TERMINATE_TIMEOUT = 5.0
+
+    def __init__(self, shards: int, connection_manager):
+        """
+        :param shards: Number of matching processes.
+        :param connection_manager: Receiver which replies are sent through.
+        """
+        self.shards = shards
+        self.connection_manager = connection_manager
+
+        # Order token bookkeeping per client.
+        # {client_id: {order_token: shard}}
+        self.client_tokens = {}
+        # {client_id: greatest order token used}
+        self.greatest_tokens = {}
+
+        self.inbound = [ShmRing(slots=self.INBOUND_SLOTS, slot_size=self.INBOUND_SLOT_SIZE) for _ in range(shards)]
+        self.outbound = [ShmRing(slots=self.OUTBOUND_SLOTS, slot_size=self.OUTBOUND_SLOT_SIZE) for _ in range(shards)]
+
+        # Matching processes are spawned rather than forked, as the exchange process is
+        # already running receiver threads.
+        context = multiprocessing.get_context("spawn")
+        self.processes = []
+        for shard in range(shards):
+            process = context.Process(
+                name = f"shard{shard}",
+                target = run_shard,
+                args = (shard, shards, self.inbound[shard].name, self.outbound[shard].name),
+                daemon = True
+            )
+            process.start()
+            self.processes.append(process)
+
+        # Thread which sends replies from the shards back to the clients.
+        self.stopped = threading.Event()
+        self.collector = threading.Thread(
+            name = "collector",
+            target = lambda: self._collect_replies(),
+            daemon = True
+        )
+        self.collector.start()
+
+    def route(self, msg: dict):
+        """
+        Forwards a message from the receiver's queue to the shard which handles it. Messages
+        for orders the router does not know about are dropped, as the OrderBook would ignore them.
+        """
+        client_id = msg["id"]
+        header = msg["header"]
+        body = msg["body"]
+        tokens = self.client_tokens.get(client_id)
+        if tokens is None:
+            tokens = self.client_tokens[client_id] = {}
+            self.greatest_tokens[client_id] = -1
+
+        if header == b'O':
+            token = TOKEN.unpack_from(body, 0)[0]
+            if token <= self.greatest_tokens[client_id]:
+                return
+            shard = TOKEN.unpack_from(body, ORDERBOOK_ID_OFFSET)[0] % self.shards
+            tokens[token] = shard
+            self.greatest_tokens[client_id] = token
+        elif header == b'U':
+            exst_token, repl_token = REPLACE_TOKENS.unpack_from(body, 0)
+            shard = tokens.get(exst_token)
+            if shard is None or repl_token <= self.greatest_tokens[client_id]:
+                return
+            # The existing token no longer refers to an order, whether or not the replacement
+            # is valid, as an invalid replacement cancels the order.
+            del tokens[exst_token]
+            tokens[repl_token] = shard
+            self.greatest_tokens[client_id] = repl_token
+        elif header == b'X':
+            shard = tokens.pop(TOKEN.unpack_from(body, 0)[0], None)
+            if shard is None:
+                return
+        else:
+            raise ValueError(f"Invalid header {header} caught in ShardRouter.")
+        self.inbound[shard].put_wait(CLIENT_ID.pack(client_id) + header + body)
+
+    def end_session(self, client_id: int):
+        """Forgets a client which has disconnected, and ends its session in every shard."""
+        self.client_tokens.pop(client_id, None)
+        self.greatest_tokens.pop(client_id, None)
+        record = CLIENT_ID.pack(client_id)
+        for ring in self.inbound:
+            ring.put_wait(record)
+
+    def get_counts(self) -> dict:
+        """Returns the number of clients and order tokens the router holds."""
+        return {
+            "clients": len(self.client_tokens),
+            "tokens": sum(len(tokens) for tokens in list(self.client_tokens.values()))
+        }
+
+    def terminate(self):
+        """
+        Stops the matching processes and the reply collector, and removes the rings. A matching
+        process which does not stop within TERMINATE_TIMEOUT, such as one which has died with
+        its ring full, is killed.
+        """
+        for ring, process in zip(self.inbound, self.processes):
+            if process.is_alive():
+                ring.put_wait(b"", self.TERMINATE_TIMEOUT)
+        for process in self.processes:
+            process.join(self.TERMINATE_TIMEOUT)
+            if process.is_alive():
+                process.kill()
+                process.join()
+        self.stopped.set()
+        self.collector.join()
+        for ring in self.inbound + self.outbound:
+            ring.close()
+
+    def _collect_replies(self):
+        """
+        Reply collector thread. Takes every available reply from the shards and sends each
+        client its replies with one send.
+        """
+        sleep = ShmRing.SLEEP_MIN
+        while not self.stopped.is_set():
+            # {client_id: [bytes, ...]}
+            replies = {}
+            collected = 0
+            for ring in self.outbound:
+                while collected < self.COLLECT_BATCH:
+                    record = ring.get()
+                    if record is None:
+                        break
+                    if len(record) <= CLIENT_ID.size:
+                        # Not a reply. Skipped rather than ending the collector, which would
+                        # lose every later reply.
+                        continue
+                    client_id = CLIENT_ID.unpack_from(record)[0]
+                    client_replies = replies.get(client_id)
+                    if client_replies is None:
+                        replies[client_id] = [record[4:]]
+                    else:
+                        client_replies.append(record[4:])
+                    collected += 1
+
+            if collected == 0:
+                time.sleep(sleep)
+                sleep = min(sleep*2, ShmRing.SLEEP_MAX)
+                continue
+            sleep = ShmRing.SLEEP_MIN
+
+            for client_id, client_replies in replies.items():
+                try:
+                    self.connection_manager.send_messages(client_id, client_replies)
+                except (OSError, KeyError):
+                    # The client has disconnected.
+                    pass
+                except ValueError:
+                    # A malformed reply, which the receiver refuses to send.
+                    pass
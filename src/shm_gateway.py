@@ -0,0 +1,623 @@
+"""
+The OUCH Team
+Shared Memory Gateway
+
+Transport for clients running on the same machine as the exchange, which exchanges OUCH
+messages with them over shared memory rings (see ShmRing) instead of TCP. Each client has an
+inbound ring, which it writes its messages into and the exchange reads, and an outbound ring,
+which the exchange writes the client's replies into. Every record is one whole OUCH message,
+as produced by Util.package.
+
+A client connects to the gateway's Unix control socket, which replies with its client id, the
+names of its rings and the exchange's process id. The control connection then only carries
+one-byte wake-ups: a consumer which has found its ring empty for a short while marks itself
+as waiting and blocks, and the producer sends a wake-up only when it sees the mark. A busy
+client and exchange therefore exchange messages without any system call or thread handoff,
+while neither keeps a core busy once idle. Consumers yield the processor (and the GIL) while
+they poll, so that polling never holds up the exchange's other threads. The control connection
+closing ends the client's session.
+
+The gateway wraps the exchange's receiver: local clients share its client ids and connection
+log, and replies are sent through the gateway to local clients or the receiver. The gateway
+also stands in for the receiver's queue, reading the inbound rings from the exchange's own
+thread as it takes messages (see get_batch), so the messages of local clients never pass
+through the queue.
+"""
+import os
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+
+from src.receiver import Receiver
+from src.shm_ring import ShmRing
+from src.util import Util
+
+
+# Byte sent on a control connection to wake the other side.
+WAKE = b"\0"
+
+
+class _LocalClient:
+    """
+    Rings and control connection of one local client. The exchange may send from more than
+    one thread, so writes to the outbound ring are made under the lock.
+    """
+    def __init__(self, client_id: int, connection: socket.socket, inbound: ShmRing, outbound: ShmRing):
+        self.client_id = client_id
+        self.connection = connection
+        self.inbound = inbound
+        self.outbound = outbound
+        self.lock = threading.Lock()
+
+        # Cleared once the client has sent an illegal message, after which its inbound ring is
+        # no longer read.
+        self.readable = True
+
+        # Wait count of the client for which a wake-up was last sent.
+        self.woken = 0
+
+        # Replies dropped since the outbound ring last had room, under the "drop" policy.
+        self.dropped = 0
+
+        # Set once the gateway has closed the rings, after which nothing more is sent.
+        self.closed = False
+
+
+class ShmGateway:
+    """
+    ShmGateway
+
+    Accepts local clients on the control socket at Util.get_gateway_path from a control
+    thread, which also notices their disconnections and wake-ups. The exchange takes messages
+    from the gateway rather than from the receiver's queue: get_batch reads the inbound rings
+    and the queue together, and blocks on the queue once they have all been empty for
+    SPIN_TIME, after marking every inbound ring as waiting. A client which finds the mark wakes
+    the control thread, which puts WAKE_MESSAGE into the queue. Replies to local clients are
+    written into their outbound rings by the thread sending them. A client which leaves
+    OUTBOUND_SLOTS replies unread has the receiver's slow consumer policy applied to it.
+
+    Provides the methods of a receiver which the exchange uses, and passes calls for clients
+    which are not local on to the receiver.
+    """
+    # class constants: ring sizes. Inbound records hold at most an Enter Order (48 bytes) and
+    # outbound records at most an Order Accepted (65 bytes).
+    INBOUND_SLOTS = 4096
+    INBOUND_SLOT_SIZE = 64
+    OUTBOUND_SLOTS = 16384
+    OUTBOUND_SLOT_SIZE = 128
+
+    # class constant: most messages read from one client's ring at a time, and taken by get
+    # to be returned one by one.
+    DRAIN_BATCH = 256
+
+    # class constant: seconds get_batch keeps polling the inbound rings and the queue after
+    # they empty, before it blocks waiting for a wake-up.
+    SPIN_TIME = 0.0005
+
+    # class constant: put into the receiver's queue to wake the exchange, and never returned.
+    WAKE_MESSAGE = {"type": "W"}
+
+    def __init__(self, receiver: Receiver):
+        """
+        Starts listening on the control socket.
+
+        :param receiver: Receiver whose queue, client ids and connection log are shared.
+        """
+        self.receiver = receiver
+        self.queue = receiver.get_queue()
+        self.lengths = Receiver.INBOUND_BODY_LENGTH_DICT
+
+        # {client_id: _LocalClient} of connected local clients, added by the control thread
+        # and removed by the exchange's thread.
+        self.clients = {}
+        self.client_lock = threading.Lock()
+
+        # ("C" or "D", _LocalClient) connections and disconnections noticed by the control
+        # thread, for the exchange's thread to act on in order with the clients' messages.
+        self.events = deque()
+
+        # Clients whose inbound rings are read. Only used by the exchange's thread, under the
+        # read lock, which terminate also takes before closing the rings.
+        self.readers = []
+        self.read_lock = threading.Lock()
+
+        # Messages taken by get but not yet returned.
+        self.pending = deque()
+
+        # Whether get_batch reads the rings before the queue, alternated so that neither
+        # crowds out the other.
+        self.rings_first = True
+
+        self.path = Util.get_gateway_path()
+        if os.path.exists(self.path):
+            # Left behind by an exchange which did not shut down.
+            os.unlink(self.path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(self.path)
+        self.socket.listen(100)
+        self.socket.setblocking(False)
+        # Written to by terminate to stop the control thread.
+        self.stop_reader, self.stop_writer = socket.socketpair()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ, None)
+        self.selector.register(self.stop_reader, selectors.EVENT_READ, None)
+
+        self.controller = threading.Thread(
+            name = "gateway",
+            target = lambda: self._control_thread(),
+            daemon = True
+        )
+        self.controller.start()
+
+    def send_message(self, client_id: int, msg: bytes):
+        """Sends a byte message to a local client, or through the receiver."""
+        client = self._get_client(client_id)
+        if client is None:
+            self.receiver.send_message(client_id, msg)
+        else:
+            self.receiver._validate_message(msg)
+            self._send(client, (msg, ))
+
+    def send_messages(self, client_id: int, msgs: list):
+        """Sends a list of byte messages to a local client, or through the receiver."""
+        client = self._get_client(client_id)
+        if client is None:
+            self.receiver.send_messages(client_id, msgs)
+        else:
+            for msg in msgs:
+                self.receiver._validate_message(msg)
+            self._send(client, msgs)
+
+    def get_queue(self):
+        """
+        Returns the gateway itself, which the exchange takes messages from in place of the
+        receiver's queue, with get, get_batch and qsize.
+        """
+        return self
+
+    def get(self) -> dict:
+        """
+        Returns the next message from a local client or the receiver's queue, waiting for one.
+        Messages are taken DRAIN_BATCH at a time and returned one by one. Only one thread may
+        take messages.
+        """
+        if not self.pending:
+            self.pending.extend(self.get_batch(self.DRAIN_BATCH))
+        return self.pending.popleft()
+
+    def get_batch(self, limit: int) -> list:
+        """
+        Returns up to limit messages, from local clients and the receiver's queue, waiting for
+        at least one. Only one thread may take messages.
+
+        Local clients' connections and disconnections are returned as the receiver's are, in
+        order with their messages. The messages of each client keep their order.
+        """
+        batch = []
+        idle_since = None
+        while True:
+            self.read_lock.acquire()
+            try:
+                while self.events and len(batch) < limit:
+                    self._handle_event(batch, limit)
+                if self.rings_first:
+                    self._drain(batch, limit)
+                    self._take_queue(batch, limit)
+                else:
+                    self._take_queue(batch, limit)
+                    self._drain(batch, limit)
+                self.rings_first = not self.rings_first
+            finally:
+                self.read_lock.release()
+            if batch:
+                return batch
+
+            now = time.perf_counter()
+            if idle_since is None:
+                idle_since = now
+            if now - idle_since < self.SPIN_TIME:
+                os.sched_yield()
+                continue
+            idle_since = None
+            msg = self._wait()
+            if msg is not self.WAKE_MESSAGE:
+                batch.append(msg)
+
+    def qsize(self) -> int:
+        """Returns the number of messages waiting in the inbound rings and the receiver's queue."""
+        self.read_lock.acquire()
+        size = len(self.pending) + sum([len(client.inbound) for client in self.readers])
+        self.read_lock.release()
+        return size + self.queue.qsize()
+
+    def get_session_counts(self) -> dict:
+        """Returns the receiver's counts, and the number of connected local clients."""
+        counts = self.receiver.get_session_counts()
+        self.client_lock.acquire()
+        counts["local_clients"] = len(self.clients)
+        self.client_lock.release()
+        return counts
+
+    def get_connection_log(self, count: int) -> list:
+        return self.receiver.get_connection_log(count)
+
+    def print_connections(self):
+        self.receiver.print_connections()
+
+    def print_log(self):
+        self.receiver.print_log()
+
+    def terminate(self):
+        """Disconnects every local client, removes the control socket, and terminates the receiver."""
+        self.stop_writer.send(WAKE)
+        self.controller.join()
+        self.read_lock.acquire()
+        self.readers = []
+        self.events.clear()
+        self.client_lock.acquire()
+        clients = list(self.clients.values())
+        self.clients.clear()
+        self.client_lock.release()
+        for client in clients:
+            self._close(client)
+        self.read_lock.release()
+        self.selector.close()
+        self.stop_reader.close()
+        self.stop_writer.close()
+        self.socket.close()
+        os.unlink(self.path)
+        self.receiver.terminate()
+
+    def _get_client(self, client_id: int) -> _LocalClient:
+        self.client_lock.acquire()
+        client = self.clients.get(client_id)
+        self.client_lock.release()
+        return client
+
+    def _send(self, client: _LocalClient, msgs):
+        """Writes replies into a local client's outbound ring, and wakes the client if it is waiting."""
+        client.lock.acquire()
+        try:
+            if client.closed:
+                return
+            ring = client.outbound
+            # Once replies are being dropped, they are dropped until half the ring is free.
+            limit = ring.slots // 2 if client.dropped else ring.slots
+            try:
+                used = len(ring)
+            except Exception as e:
+                self._fail(client, e)
+                return
+            if used + len(msgs) > limit:
+                if self.receiver.slow_consumer == "drop":
+                    if not client.dropped:
+                        self.receiver._log(f"client_id {client.client_id} is not reading its replies, dropping them.")
+                    client.dropped += len(msgs)
+                else:
+                    self.receiver._log(f"client_id {client.client_id} is not reading its replies, disconnecting.")
+                    self._shutdown(client)
+                return
+            if client.dropped:
+                self.receiver._log(f"client_id {client.client_id} caught up after {client.dropped} replies were dropped.")
+                client.dropped = 0
+            try:
+                put = ring.put
+                for msg in msgs:
+                    put(msg)
+                waiting = ring.waiting()
+            except Exception as e:
+                self._fail(client, e)
+                return
+            if waiting and waiting != client.woken:
+                client.woken = waiting
+                try:
+                    client.connection.send(WAKE)
+                except OSError:
+                    # Wake-ups the client has not read are enough to wake it.
+                    pass
+        finally:
+            client.lock.release()
+
+    def _wait(self) -> dict:
+        """
+        Marks every inbound ring as waiting and blocks on the receiver's queue, unless a ring
+        has a message. A local client which sends a message while the rings are marked has the
+        control thread put WAKE_MESSAGE into the queue.
+
+        :returns: The message taken from the queue, or WAKE_MESSAGE if none was.
+        """
+        self.read_lock.acquire()
+        ready = all([client.inbound.begin_wait() for client in self.readers])
+        self.read_lock.release()
+        msg = self.queue.get() if ready else self.WAKE_MESSAGE
+        self.read_lock.acquire()
+        for client in self.readers:
+            client.inbound.end_wait()
+        self.read_lock.release()
+        return msg
+
+    def _take_queue(self, batch: list, limit: int):
+        """Moves messages already in the receiver's queue into the batch, up to limit."""
+        queue = self.queue
+        if not queue.queue or len(batch) >= limit:
+            return
+        # The queue is unbounded, so no producer is ever waiting to be notified.
+        with queue.mutex:
+            pending = queue.queue
+            while pending and len(batch) < limit:
+                msg = pending.popleft()
+                if msg is not self.WAKE_MESSAGE:
+                    batch.append(msg)
+
+    def _drain(self, batch: list, limit: int, readers: list = None):
+        """Moves messages from the inbound rings into the batch, up to DRAIN_BATCH from each ring and limit in all."""
+        stamp = self.receiver.stamp
+        lengths = self.lengths
+        received = time.perf_counter_ns() if stamp else None
+        for client in self.readers if readers is None else readers:
+            if len(batch) >= limit:
+                break
+            if not client.readable:
+                continue
+            get = client.inbound.get
+            client_id = client.client_id
+            records = []
+            for _ in range(min(self.DRAIN_BATCH, limit - len(batch))):
+                try:
+                    record = get()
+                except Exception as e:
+                    client.readable = False
+                    self._fail(client, e)
+                    break
+                if record is None:
+                    break
+                header = record[0:1]
+                if lengths.get(header) != len(record) - 1:
+                    # Like a connection which sends an illegal header, the client is disconnected.
+                    self.receiver._log(f"client_id {client_id} sent an illegal message, disconnecting.")
+                    client.readable = False
+                    self._shutdown(client)
+                    break
+                records.append(record)
+                msg = {
+                    "type": "M", # Message
+                    "id": client_id,
+                    "header": header,
+                    "body": record[1:]
+                }
+                if stamp:
+                    msg["received"] = received
+                batch.append(msg)
+            if records:
+                log = self.receiver.message_log
+                self.receiver.message_log_lock.acquire()
+                for record in records:
+                    log.append(["id: " + str(client_id), record])
+                self.receiver.message_log_lock.release()
+
+    def _handle_event(self, batch: list, limit: int):
+        """Starts or stops reading a client's inbound ring, as noticed by the control thread."""
+        kind, client = self.events.popleft()
+        if kind == "C":
+            self.readers.append(client)
+            batch.append({
+                "type": "C",
+                "id": client.client_id
+            })
+            return
+        # Take the client's last messages before it is disconnected, over as many batches as
+        # they need.
+        self._drain(batch, limit, readers=[client])
+        if client.readable and len(client.inbound) and len(batch) >= limit:
+            self.events.appendleft((kind, client))
+            return
+        self.readers.remove(client)
+        self.client_lock.acquire()
+        self.clients.pop(client.client_id, None)
+        self.client_lock.release()
+        self._close(client)
+        self.receiver._log(f"client_id {client.client_id} disconnected.")
+        batch.append({
+            "type": "D",
+            "id": client.client_id
+        })
+
+    def _control_thread(self):
+        """
+        Accepts clients, and notices disconnections and wake-ups, which are passed on to the
+        exchange's thread through the events and the receiver's queue. Blocks on the control
+        socket and connections.
+        """
+        while True:
+            for key, _ in self.selector.select():
+                client = key.data
+                if key.fileobj is self.stop_reader:
+                    return
+                if client is None:
+                    self._accept()
+                    continue
+                try:
+                    data = client.connection.recv(4096)
+                except BlockingIOError:
+                    continue
+                except OSError:
+                    data = b""
+                if not data:
+                    self.selector.unregister(client.connection)
+                    self.events.append(("D", client))
+                self.queue.put(self.WAKE_MESSAGE)
+
+    def _accept(self):
+        """Creates the rings of a new client, and sends it its client id and their names."""
+        try:
+            connection, _ = self.socket.accept()
+        except BlockingIOError:
+            return
+        client_id = self.receiver._new_client_id()
+        client = _LocalClient(client_id, connection,
+            ShmRing(slots=self.INBOUND_SLOTS, slot_size=self.INBOUND_SLOT_SIZE),
+            ShmRing(slots=self.OUTBOUND_SLOTS, slot_size=self.OUTBOUND_SLOT_SIZE))
+        try:
+            connection.sendall(f"{client_id} {client.inbound.name} {client.outbound.name} {os.getpid()}\n".encode())
+        except OSError:
+            connection.close()
+            client.inbound.close()
+            client.outbound.close()
+            return
+        connection.setblocking(False)
+
+        self.receiver._log(f"client_id {client_id} connected over shared memory.")
+        self.client_lock.acquire()
+        self.clients[client_id] = client
+        self.client_lock.release()
+        self.selector.register(connection, selectors.EVENT_READ, client)
+        self.events.append(("C", client))
+        self.queue.put(self.WAKE_MESSAGE)
+
+    def _fail(self, client: _LocalClient, error: Exception):
+        """Disconnects a client whose ring could not be used, without stopping the calling thread."""
+        self.receiver._log(f"client_id {client.client_id} ring failed ({error!r}), disconnecting.")
+        self._shutdown(client)
+
+    def _shutdown(self, client: _LocalClient):
+        """Shuts down a client's control connection, which the control thread sees as a disconnection."""
+        try:
+            client.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _close(self, client: _LocalClient):
+        """Removes a client's rings and closes its control connection."""
+        client.lock.acquire()
+        client.closed = True
+        client.inbound.close()
+        client.outbound.close()
+        client.lock.release()
+        self._shutdown(client)
+        client.connection.close()
+
+
+class ShmClient:
+    """
+    ShmClient
+
+    Client side of the gateway. Must run on the same machine as the exchange. Messages are
+    written into the client's inbound ring, and replies read from its outbound ring, waiting
+    on the control connection when there are none. Only one thread may send and one read.
+    """
+    # Polls of the outbound ring before waiting on the control connection.
+    SPIN = 200
+
+    def __init__(self):
+        """
+        Connects to the gateway and attaches to the client's rings.
+
+        :raises ConnectionError: The gateway could not be reached.
+        """
+        self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.connection.connect(Util.get_gateway_path())
+            reply = b""
+            while not reply.endswith(b"\n"):
+                data = self.connection.recv(256)
+                if not data:
+                    raise ConnectionError("Connection closed by the gateway.")
+                reply += data
+        except OSError as e:
+            self.connection.close()
+            raise ConnectionError(f"Could not connect to the gateway: {e}")
+        client_id, inbound_name, outbound_name, pid = reply.decode().split()
+        self.client_id = int(client_id)
+        # A client in the exchange's own process shares its resource tracker.
+        shared_tracker = int(pid) == os.getpid()
+        self.inbound = ShmRing.attach(inbound_name, shared_tracker=shared_tracker)
+        self.outbound = ShmRing.attach(outbound_name, shared_tracker=shared_tracker)
+        self.lengths = {header[0]: length + 1 for header, length in Receiver.INBOUND_BODY_LENGTH_DICT.items()}
+
+        # Wait count of the exchange for which a wake-up was last sent.
+        self.woken = 0
+        self.closed = False
+
+    def send(self, msg: bytes):
+        """Sends one message, waiting for room in the inbound ring if it is full."""
+        self._put(msg)
+        self._wake()
+
+    def sendall(self, data: bytes):
+        """Sends one or more consecutive messages."""
+        lengths = self.lengths
+        pos = 0
+        while pos < len(data):
+            length = lengths.get(data[pos])
+            if length is None or pos + length > len(data):
+                raise ValueError(f"Invalid message at byte {pos}")
+            self._put(data[pos:pos+length])
+            pos += length
+        self._wake()
+
+    def read_frames(self) -> list:
+        """
+        Blocks until at least one reply has arrived, and returns every reply which has arrived
+        as (header, body) pairs.
+
+        :raises ConnectionError: The gateway disconnected the client, or the client was shut down.
+        """
+        ring = self.outbound
+        get = ring.get
+        spins = 0
+        while True:
+            if self.closed:
+                raise ConnectionError("Client shut down.")
+            frames = []
+            record = get()
+            while record is not None:
+                frames.append((record[0:1], record[1:]))
+                record = get()
+            if frames:
+                return frames
+            spins += 1
+            if spins < self.SPIN:
+                os.sched_yield()
+                continue
+            if ring.begin_wait():
+                try:
+                    data = self.connection.recv(4096)
+                    if not data:
+                        raise ConnectionError("Connection closed by the gateway.")
+                finally:
+                    ring.end_wait()
+            else:
+                ring.end_wait()
+
+    def shutdown(self):
+        """Ends the session, waking a blocking read_frames."""
+        self.closed = True
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        """Detaches from the rings. Call once no thread is sending or reading."""
+        self.shutdown()
+        self.connection.close()
+        self.inbound.close()
+        self.outbound.close()
+
+    def _put(self, record: bytes):
+        if not self.inbound.put(record):
+            # The exchange may be waiting for a wake-up to empty the ring.
+            self._wake()
+            self.inbound.put_wait(record)
+
+    def _wake(self):
+        """Wakes the exchange if it is waiting for local clients' messages."""
+        waiting = self.inbound.waiting()
+        if waiting and waiting != self.woken:
+            self.woken = waiting
+            try:
+                self.connection.send(WAKE)
+            except OSError:
+                pass
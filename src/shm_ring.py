@@ -0,0 +1,246 @@
+"""
+The OUCH Team
+Shared Memory Ring
+
+Single-producer single-consumer ring buffer in a multiprocessing.shared_memory block, for
+passing small messages between two processes without pickling or going through a pipe.
+"""
+import platform
+import struct
+import threading
+import time
+from multiprocessing import shared_memory, resource_tracker
+
+
+class ShmRing:
+    """
+    ShmRing
+
+    The shared memory block is laid out as:
+    - bytes 0-15: number of slots and slot size (written once by the creator).
+    - bytes 64-71: head, the number of records read so far (written only by the consumer).
+    - bytes 128-135: tail, the number of records written so far (written only by the producer).
+    - bytes 192-199: wait count, odd while the consumer is blocked waiting for a record
+      elsewhere, such as on a socket (written only by the consumer).
+    - from byte 256: slots, each holding a 2 byte record length followed by the record.
+    Head and tail are on separate cache lines and only ever increase, so the producer and the
+    consumer never write to the same memory. A record is written into its slot before the tail
+    is advanced past it, and the 8 byte aligned counters are written with a single store
+    through a memoryview cast to "Q" (struct.pack_into would clear the counter before writing
+    it, letting the other process read 0), which makes the ring safe for exactly one producer and one consumer process on x86-64. Python
+    has no memory fences, and other machines (such as ARM) may make the tail visible before the
+    record it covers, so rings can only be created or attached on the MACHINES listed below.
+
+    x86-64 may still let a load complete before an earlier store to another address, so the
+    wait count and the tail are fenced where both sides store one and then load the other (see
+    begin_wait and waiting). Python has no fence of its own, but acquiring a lock executes a
+    locked instruction, which is a full fence on x86-64.
+    """
+    META = struct.Struct("QQ")
+    LENGTH = struct.Struct("H")
+    HEAD = 64
+    TAIL = 128
+    WAITS = 192
+    DATA = 256
+
+    # class constants: indices of the counters in the block's first DATA bytes as 8 byte words.
+    HEAD_INDEX = HEAD // 8
+    TAIL_INDEX = TAIL // 8
+    WAITS_INDEX = WAITS // 8
+
+    # class constant: platform.machine() names of the machines whose stores become visible to
+    # other cores in program order (x86-64 under Linux/macOS and Windows respectively).
+    MACHINES = ("x86_64", "AMD64")
+
+    # class constants: polling while waiting, spin first and then sleep with backoff.
+    SPIN = 200
+    SLEEP_MIN = 0.00005
+    SLEEP_MAX = 0.001
+
+    def __init__(self, name: str = None, slots: int = 65536, slot_size: int = 128):
+        """
+        Creates a new ring. Use ShmRing.attach to open the ring from the other process.
+
+        :param name: Name of the shared memory block, or None to generate one.
+        :param slots: Number of records the ring can hold.
+        :param slot_size: Size of each slot in bytes. Records can be up to slot_size-2 bytes.
+        :raises RuntimeError: The ring is not safe on this machine.
+        """
+        self._check_machine()
+        size = self.DATA + slots*slot_size
+        self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        # A new block is zero-filled, so the counters start at 0.
+        self.META.pack_into(self.shm.buf, 0, slots, slot_size)
+        self._setup(owner=True)
+
+    @classmethod
+    def attach(cls, name: str, shared_tracker: bool = False):
+        """
+        Opens an existing ring created by another process.
+
+        :param name: Name of the ring's shared memory block.
+        :param shared_tracker: Whether this process shares the creator's resource tracker, as
+            processes started by the creator through multiprocessing do.
+        :raises RuntimeError: The ring is not safe on this machine.
+        """
+        cls._check_machine()
+        ring = cls.__new__(cls)
+        ring.shm = shared_memory.SharedMemory(name=name, create=False)
+        # Only the creating process should unlink the block when it exits, so the block must
+        # not be left registered with a resource tracker of this process's own.
+        if not shared_tracker:
+            resource_tracker.unregister(ring.shm._name, "shared_memory")
+        ring._setup(owner=False)
+        return ring
+
+    @classmethod
+    def _check_machine(cls):
+        machine = platform.machine()
+        if machine not in cls.MACHINES:
+            raise RuntimeError(f"Shared memory rings rely on x86-64 store ordering and are not supported on {machine or 'this machine'}.")
+
+    def _setup(self, owner: bool):
+        self.owner = owner
+        self.name = self.shm.name
+        self.buf = self.shm.buf
+        self.slots, self.slot_size = self.META.unpack_from(self.buf, 0)
+        self.max_record = self.slot_size - self.LENGTH.size
+        self.counters = self.buf[:self.DATA].cast("Q")
+
+        # Lock acquired and released only for the fence it executes.
+        self.fence = threading.Lock()
+
+        # Local copies of the counters this side writes.
+        self.head = self.counters[self.HEAD_INDEX]
+        self.tail = self.counters[self.TAIL_INDEX]
+        self.waits = self.counters[self.WAITS_INDEX]
+
+    def put(self, record: bytes) -> bool:
+        """
+        Writes a record if there is space for it. Producer side only.
+
+        :returns: Whether the record was written.
+        :raises ValueError: The record does not fit in a slot.
+        """
+        length = len(record)
+        if length > self.max_record:
+            raise ValueError(f"Record of {length} bytes does not fit in a {self.slot_size} byte slot.")
+        tail = self.tail
+        if tail - self.counters[self.HEAD_INDEX] >= self.slots:
+            return False
+        offset = self.DATA + (tail % self.slots)*self.slot_size
+        self.LENGTH.pack_into(self.buf, offset, length)
+        self.buf[offset+2:offset+2+length] = record
+        self.tail = tail + 1
+        self.counters[self.TAIL_INDEX] = self.tail
+        return True
+
+    def put_wait(self, record: bytes, timeout: float = None) -> bool:
+        """
+        Writes a record, waiting for the consumer to make space if the ring is full.
+
+        :returns: Whether the record was written, False if timeout seconds passed first.
+        """
+        waited = 0
+        sleep = self.SLEEP_MIN
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.put(record):
+            waited += 1
+            if waited > self.SPIN:
+                if deadline is not None and time.monotonic() >= deadline:
+                    return False
+                time.sleep(sleep)
+                sleep = min(sleep*2, self.SLEEP_MAX)
+        return True
+
+    def get(self):
+        """
+        Reads the next record. Consumer side only.
+
+        :returns: The record as bytes, or None if the ring is empty.
+        """
+        head = self.head
+        # A tail behind the head can only be misread, and is never read past.
+        if head >= self.counters[self.TAIL_INDEX]:
+            return None
+        offset = self.DATA + (head % self.slots)*self.slot_size
+        length = self.LENGTH.unpack_from(self.buf, offset)[0]
+        record = self.buf[offset+2:offset+2+length].tobytes()
+        self.head = head + 1
+        self.counters[self.HEAD_INDEX] = self.head
+        return record
+
+    def get_wait(self, timeout: float = None):
+        """
+        Reads the next record, waiting for the producer if the ring is empty.
+
+        :returns: The record as bytes, or None if timeout seconds passed without a record.
+        """
+        waited = 0
+        sleep = self.SLEEP_MIN
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            record = self.get()
+            if record is not None:
+                return record
+            waited += 1
+            if waited > self.SPIN:
+                if deadline is not None and time.monotonic() >= deadline:
+                    return None
+                time.sleep(sleep)
+                sleep = min(sleep*2, self.SLEEP_MAX)
+
+    def begin_wait(self) -> bool:
+        """
+        Marks the consumer as blocked waiting to be woken by the producer, which checks
+        waiting after every put. Consumer side only, followed by end_wait once woken.
+
+        :returns: False if the ring is not empty, in which case the consumer should read it
+            rather than block.
+        """
+        self.waits += 1
+        self.counters[self.WAITS_INDEX] = self.waits
+        # The tail must be loaded only once the wait count is visible to the producer.
+        self.fence.acquire()
+        self.fence.release()
+        return self.head >= self.counters[self.TAIL_INDEX]
+
+    def end_wait(self):
+        """Marks the consumer as no longer blocked. Consumer side only."""
+        if self.waits % 2 == 1:
+            self.waits += 1
+            self.counters[self.WAITS_INDEX] = self.waits
+
+    def waiting(self) -> int:
+        """
+        Producer side: returns the wait count if the consumer is blocked waiting, otherwise 0.
+        Call after putting records, and wake the consumer if this is not 0. Either the consumer
+        sees the records before it blocks, or this sees it waiting, so a wake-up is never missed
+        and the consumer can block without a timeout. The producer only needs to wake the
+        consumer once for each wait count.
+        """
+        self.fence.acquire()
+        self.fence.release()
+        waits = self.counters[self.WAITS_INDEX]
+        return waits if waits % 2 == 1 else 0
+
+    def __len__(self):
+        """Number of records written but not yet read, never negative."""
+        return max(self.counters[self.TAIL_INDEX] - self.counters[self.HEAD_INDEX], 0)
+
+    def close(self):
+        """Detaches from the ring, and removes it if this process created it."""
+        # The block cannot be closed while views of it are held.
+        self.counters.release()
+        self.counters = None
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def __del__(self):
+        # A ring which is never closed still lets the SharedMemory close its block as it is
+        # collected, which the counters' view would prevent.
+        counters = getattr(self, "counters", None)
+        if counters is not None:
+            counters.release()
@@ -0,0 +1,417 @@
+"""
+The OUCH Team
+Orderbook Snapshots
+
+Dumps the resting orders of an OrderBook to a file, and loads them back. Two formats are
+supported:
+- CSV, in the layout described in res/orderbookFormat.md (see res/orderbookSample.csv), for
+  people and other tools to read.
+- A columnar binary format, which holds every field needed to restart the exchange from the
+  snapshot. Each field of the orders is stored as one contiguous array, so a snapshot can be
+  memory-mapped and its columns read directly without parsing.
+
+A snapshot is first captured from the orderbook into columns, then written. dump_background
+captures and writes the snapshot in a forked child process, which sees a copy-on-write image
+of the orderbook as it was when forked, so the orderbook lock is only held while forking.
+"""
+import array
+import mmap
+import os
+import struct
+import sys
+import threading
+import traceback
+
+from src.OrderBook import OrderBook
+
+
+class Snapshot:
+    """
+    Snapshot
+
+    Binary snapshot layout (little-endian):
+    - header: magic, version, number of orders, number of clients, next order number, next
+      match number.
+    - one array per order column, in the order of COLUMNS, each with one item per order.
+    - two arrays of client ids and the greatest order token each client has used.
+    Orders are stored in book order (by orderbook ID, bids then asks, best price first and
+    time priority within each price), so loading them in sequence rebuilds the same book.
+    """
+    MAGIC = b"OUCHSNAP"
+    VERSION = 1
+    HEADER = struct.Struct("<8sIQQQQ")
+
+    # (name, array typecode) of each order column. 8 byte columns come first so that every
+    # column is aligned to its item size.
+    COLUMNS = (
+        ("time_received", "Q"), # nanoseconds since midnight
+        ("price", "q"), # price*10
+        ("order_id", "I"),
+        ("orderbook_id", "I"),
+        ("quantity", "I"),
+        ("time_in_force", "I"),
+        ("token", "I"),
+        ("client_id", "I"),
+        ("indicator", "B") # ascii code of the buy/sell indicator
+    )
+    CLIENT_COLUMNS = (("client_id", "I"), ("greatest_token", "I"))
+
+    # Symbols of orderbook IDs 0-3 in the CSV format (res/orderbookFormat.md).
+    SYMBOLS = ("BTC", "ETH", "LTC", "FTM")
+
+    # Orders loaded from a CSV snapshot have no client or token, so they are owned by this
+    # client id, which no connection is ever given, and use their order number as their token.
+    CSV_CLIENT_ID = 2**32 - 1
+
+    @staticmethod
+    def dump(orderbook: OrderBook, path: str, binary: bool = False):
+        """
+        Writes a snapshot of the orderbook to a file. The orderbook must not change while the
+        snapshot is captured, so any lock protecting it must be held by the caller.
+        """
+        Snapshot._write(Snapshot._capture(orderbook), path, binary)
+
+    @staticmethod
+    def dump_background(orderbook: OrderBook, lock: threading.Lock, path: str, binary: bool = False):
+        """
+        Writes a snapshot of the orderbook as it is now to a file, without holding the lock
+        while the snapshot is written. Where fork is available, the snapshot is captured and
+        written by a child process forked while holding the lock. Otherwise, the snapshot is
+        captured while holding the lock and written by a thread.
+
+        :returns: SnapshotWriter thread which finishes once the snapshot has been written, or
+            has failed to be.
+        """
+        if hasattr(os, "fork"):
+            with lock:
+                pid = os.fork()
+            if pid == 0:
+                # Child process: only this thread exists, and the orderbook is a frozen copy.
+                # os._exit skips the interpreter's cleanup, so the traceback of a failure must
+                # be flushed to stderr before exiting.
+                status = 1
+                try:
+                    Snapshot.dump(orderbook, path, binary)
+                    status = 0
+                except BaseException:
+                    traceback.print_exc()
+                finally:
+                    sys.stderr.flush()
+                    os._exit(status)
+            target = lambda: Snapshot._wait_child(pid, path)
+        else:
+            with lock:
+                columns = Snapshot._capture(orderbook)
+            target = lambda: Snapshot._write(columns, path, binary)
+        writer = SnapshotWriter(target)
+        writer.start()
+        return writer
+
+    @staticmethod
+    def _wait_child(pid: int, path: str):
+        """
+        Waits for a child process writing a snapshot to exit.
+
+        :raises ChildProcessError: The child process failed, or was killed by a signal.
+        """
+        _, status = os.waitpid(pid, 0)
+        code = os.waitstatus_to_exitcode(status)
+        if code != 0:
+            raise ChildProcessError(f"Snapshot process {pid} writing {path} exited with code {code}.")
+
+    @staticmethod
+    def load(orderbook: OrderBook, path: str):
+        """
+        Loads the orders of a snapshot into an empty orderbook. The format is detected from
+        the file's contents.
+
+        :raises ValueError: The orderbook is not empty, or the file is not a valid snapshot.
+        """
+        if len(orderbook.order_index) or orderbook.greatest_tokens:
+            raise ValueError("Snapshots can only be loaded into an empty orderbook.")
+        with open(path, "rb") as f:
+            binary = f.read(len(Snapshot.MAGIC)) == Snapshot.MAGIC
+        if binary:
+            Snapshot._load_binary(orderbook, path)
+        else:
+            Snapshot._load_csv(orderbook, path)
+
+    @staticmethod
+    def _capture(orderbook: OrderBook) -> dict:
+        """Copies the resting orders and the state needed to restore them into columns."""
+        columns = {name: array.array(code) for name, code in Snapshot.COLUMNS}
+        time_received = columns["time_received"].append
+        price = columns["price"].append
+        order_id = columns["order_id"].append
+        orderbook_id = columns["orderbook_id"].append
+        quantity = columns["quantity"].append
+        time_in_force = columns["time_in_force"].append
+        token = columns["token"].append
+        client_id = columns["client_id"].append
+        indicator = columns["indicator"].append
+        orders = orderbook.orders
+        for book_id in sorted(orderbook.ladders):
+            for ladder in orderbook.ladders[book_id]:
+                for key in reversed(ladder.keys):
+                    level = ladder.levels[key]
+                    level_price = round(level.price*10)
+                    for slot in level:
+                        time_received(orders.time_received[slot])
+                        price(level_price)
+                        order_id(orders.order_id[slot])
+                        orderbook_id(book_id)
+                        quantity(orders.quantity[slot])
+                        time_in_force(orders.time_in_force[slot])
+                        token(orders.token[slot])
+                        client_id(orders.client_id[slot])
+                        indicator(orders.indicator[slot])
+
+        clients = {name: array.array(code) for name, code in Snapshot.CLIENT_COLUMNS}
+        for client, greatest_token in orderbook.greatest_tokens.items():
+            clients["client_id"].append(client)
+            clients["greatest_token"].append(greatest_token)
+
+        return {
+            "orders": columns,
+            "clients": clients,
+            "next_order_id": orderbook.order_ids.next_id,
+            "next_match_id": orderbook.match_numbers.next_id
+        }
+
+    @staticmethod
+    def _write(snapshot: dict, path: str, binary: bool):
+        """Writes captured columns to a temporary file, then moves it over the path."""
+        temp_path = path + ".tmp"
+        if binary:
+            Snapshot._write_binary(snapshot, temp_path)
+        else:
+            Snapshot._write_csv(snapshot, temp_path)
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def _write_binary(snapshot: dict, path: str):
+        orders = snapshot["orders"]
+        clients = snapshot["clients"]
+        with open(path, "wb") as f:
+            f.write(Snapshot.HEADER.pack(
+                Snapshot.MAGIC,
+                Snapshot.VERSION,
+                len(orders["order_id"]),
+                len(clients["client_id"]),
+                snapshot["next_order_id"],
+                snapshot["next_match_id"]
+            ))
+            for name, _ in Snapshot.COLUMNS:
+                Snapshot._little_endian(orders[name]).tofile(f)
+            for name, _ in Snapshot.CLIENT_COLUMNS:
+                Snapshot._little_endian(clients[name]).tofile(f)
+
+    @staticmethod
+    def _write_csv(snapshot: dict, path: str):
+        """
+        Writes one row per order: order number (hex), seconds since midnight, symbol, price,
+        quantity (negative for sells), total (price*quantity) and the running sum of totals.
+        """
+        orders = snapshot["orders"]
+        symbols = Snapshot.SYMBOLS
+        rows = []
+        running = 0
+        for order_id, time_received, orderbook_id, indicator, price, quantity in zip(
+                orders["order_id"],
+                orders["time_received"],
+                orders["orderbook_id"],
+                orders["indicator"],
+                orders["price"],
+                orders["quantity"]):
+            if chr(indicator) in OrderBook.SELL_INDICATORS:
+                quantity = -quantity
+            total = price*quantity # in tenths
+            running += total
+            symbol = symbols[orderbook_id] if orderbook_id < len(symbols) else str(orderbook_id)
+            rows.append(
+                f"{order_id:06x},{time_received // 1_000_000_000},{symbol},"
+                f"{Snapshot._tenths(price)},{quantity},{Snapshot._tenths(total)},{Snapshot._tenths(running)}\n"
+            )
+        with open(path, "w") as f:
+            f.writelines(rows)
+
+    @staticmethod
+    def _load_binary(orderbook: OrderBook, path: str):
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # Every view of the mapping must be released before it can be closed.
+        views = [memoryview(mapped)]
+        try:
+            view = views[0]
+            if len(view) < Snapshot.HEADER.size or view[:len(Snapshot.MAGIC)] != Snapshot.MAGIC:
+                raise ValueError(f"{path} is not a valid snapshot.")
+            magic, version, order_count, client_count, next_order_id, next_match_id = \
+                Snapshot.HEADER.unpack_from(view, 0)
+            if version != Snapshot.VERSION:
+                raise ValueError(f"Unsupported snapshot version {version}.")
+
+            # Map every column straight onto the file.
+            offset = Snapshot.HEADER.size
+            columns = {}
+            clients = {}
+            for table, names, count in ((columns, Snapshot.COLUMNS, order_count), (clients, Snapshot.CLIENT_COLUMNS, client_count)):
+                for name, code in names:
+                    size = array.array(code).itemsize*count
+                    if offset + size > len(view):
+                        raise ValueError(f"{path} is truncated.")
+                    views.append(view[offset:offset+size])
+                    table[name] = Snapshot._column(views[-1], code)
+                    if isinstance(table[name], memoryview):
+                        views.append(table[name])
+                    offset += size
+
+            indicators = [chr(i) for i in range(256)]
+            orders = (
+                (indicators[indicator], price/10, quantity, orderbook_id, time_in_force,
+                    time_received, order_id, token, client_id)
+                for time_received, price, order_id, orderbook_id, quantity, time_in_force, token,
+                    client_id, indicator in zip(*(columns[name] for name, _ in Snapshot.COLUMNS))
+            )
+            tokens = zip(clients["client_id"], clients["greatest_token"])
+            Snapshot._restore(orderbook, orders, tokens, next_order_id, next_match_id)
+        finally:
+            for view in reversed(views):
+                view.release()
+            mapped.close()
+
+    @staticmethod
+    def _load_csv(orderbook: OrderBook, path: str):
+        """
+        Loads a CSV snapshot. The side is taken from the sign of the quantity, or of the price
+        as in the example in res/orderbookFormat.md. Orders are given to CSV_CLIENT_ID.
+        """
+        symbols = {symbol: i for i, symbol in enumerate(Snapshot.SYMBOLS)}
+        client_id = Snapshot.CSV_CLIENT_ID
+
+        def orders(f):
+            for line_no, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                fields = [field.strip() for field in line.split(",")]
+                if len(fields) < 5:
+                    raise ValueError(f"{path}:{line_no}: expected at least 5 columns.")
+                order_id = int(fields[0], 16)
+                symbol = fields[2]
+                orderbook_id = symbols[symbol] if symbol in symbols else int(symbol)
+                price = float(fields[3])
+                quantity = int(fields[4])
+                indicator = "S" if price < 0 or quantity < 0 else "B"
+                yield (indicator, abs(price), abs(quantity), orderbook_id, 99999,
+                    int(fields[1])*1_000_000_000, order_id, order_id, client_id)
+
+        with open(path, "r") as f:
+            Snapshot._restore(orderbook, orders(f), (), 0, 0)
+        # The client's tokens are held in ascending order, so its greatest token is the last.
+        if orderbook.order_index.count(client_id):
+            orderbook.greatest_tokens[client_id] = orderbook.order_index.clients[client_id][0][-1]
+
+    @staticmethod
+    def _restore(orderbook: OrderBook, orders, tokens, next_order_id: int, next_match_id: int):
+        """
+        Rests orders in the orderbook in sequence, and restores the id allocators. Each order
+        is a tuple of the arguments of OrderStore.add.
+        """
+        ladders = orderbook.ladders
+        sell_indicators = OrderBook.SELL_INDICATORS
+        add = orderbook.orders.add
+        greatest_order_id = 0
+        # Orders are in book order, so most orders join the level of the order before them.
+        level = None
+        level_ladder = None
+        level_price = None
+        # The order index takes each client's tokens in ascending order, so they are sorted once
+        # every order has been rested. {client_id: [(token, slot), ...]}
+        client_slots = {}
+        for order in orders:
+            indicator, price, quantity, orderbook_id, time_in_force, time_received, order_id, token, client_id = order
+            slot = add(*order)
+            book = ladders.get(orderbook_id)
+            if book is None:
+                book = orderbook._get_ladders(orderbook_id)
+            ladder = book[1 if indicator in sell_indicators else 0]
+            if ladder is level_ladder and price == level_price:
+                level.append(slot)
+            else:
+                level = ladder.add(slot)
+                level_ladder = ladder
+                level_price = price
+            own_slots = client_slots.get(client_id)
+            if own_slots is None:
+                own_slots = client_slots[client_id] = []
+            own_slots.append((token, slot))
+            if order_id > greatest_order_id:
+                greatest_order_id = order_id
+
+        index = orderbook.order_index
+        for client_id, own_slots in client_slots.items():
+            own_slots.sort()
+            for token, slot in own_slots:
+                index.add(client_id, token, slot)
+
+        for client_id, greatest_token in tokens:
+            orderbook.greatest_tokens[client_id] = greatest_token
+
+        orderbook.order_ids.skip_past(max(greatest_order_id, next_order_id - 1))
+        orderbook.match_numbers.skip_past(next_match_id - 1)
+        orderbook.depth_changed.update(ladders)
+
+    @staticmethod
+    def _column(view: memoryview, code: str):
+        """Returns a column of the mapped file as a sequence of ints."""
+        if sys.byteorder == "little":
+            return view.cast(code)
+        column = array.array(code)
+        column.frombytes(view)
+        column.byteswap()
+        return column
+
+    @staticmethod
+    def _little_endian(column: array.array) -> array.array:
+        if sys.byteorder == "little":
+            return column
+        column = array.array(column.typecode, column)
+        column.byteswap()
+        return column
+
+    @staticmethod
+    def _tenths(value: int) -> str:
+        """Formats an integer number of tenths as a decimal, without a trailing .0"""
+        sign = "-" if value < 0 else ""
+        whole, tenths = divmod(abs(value), 10)
+        return f"{sign}{whole}.{tenths}" if tenths else f"{sign}{whole}"
+
+
+class SnapshotWriter(threading.Thread):
+    """
+    SnapshotWriter
+
+    Thread which writes a snapshot, or waits for the child process writing it. A failure is
+    kept in error rather than lost with the thread, and raised by wait.
+    """
+    def __init__(self, target):
+        super().__init__(name="snapshot", daemon=True)
+        self.write = target
+        self.error = None
+
+    def run(self):
+        try:
+            self.write()
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        """
+        Waits until the snapshot has been written.
+
+        :raises OSError: The snapshot could not be written. ChildProcessError if it was being
+            written by a child process, whose traceback is printed to stderr.
+        """
+        self.join()
+        if self.error is not None:
+            raise self.error
@@ -1,6 +1,8 @@
 from datetime import datetime, date, timedelta
-import struct
 import configparser
+import time
+
+import src.codec as codecs
 
 
 class Util():
@@ -10,14 +12,62 @@ class Util():
     Contains utility methods for retrieving the server time, packaging outbound messages into
     bytes and unpackaging inbound messages into dictionaries according to the OUCH protocol.
     """
+    # Codecs of every message type except 'U', whose codec depends on the message length.
+    PACKAGE_CODECS = {**codecs.OUTBOUND, **codecs.INBOUND}
+    del PACKAGE_CODECS[b'U']
+
+    # Server time state: (perf_counter_ns at the last local midnight, perf_counter_ns at the
+    # next local midnight), set once per day. Held in one tuple so that it is replaced at once.
+    _server_day = (0, 0)
+
+    # Server time returned to every caller while the server time is frozen, or None.
+    _frozen_server_time = None
+
     @staticmethod
     def get_server_time():
         """
-        Returns nanoseconds elasped since midnight - 0 nanoseconds as datetime only has microsecond accuracy.
-        the time module has no way of returning the timestamp of midnight.
+        Returns nanoseconds elapsed since local midnight. The time is taken from the
+        perf_counter_ns clock, so it has nanosecond resolution and never goes backwards within
+        a day, and the perf_counter_ns time of midnight is only worked out once per day. While
+        the server time is frozen (see freeze_server_time), the frozen time is returned.
+        """
+        frozen = Util._frozen_server_time
+        if frozen is not None:
+            return frozen
+        now = time.perf_counter_ns()
+        midnight, next_midnight = Util._server_day
+        if now >= next_midnight:
+            midnight, next_midnight = Util._set_server_day()
+        return now - midnight
+
+    @staticmethod
+    def freeze_server_time():
+        """
+        Freezes the server time at the current time until unfreeze_server_time is called, so
+        that every message of a batch (and every reply to it) is stamped with one time read
+        once for the batch. Only the thread processing messages should freeze the server time;
+        other threads calling get_server_time meanwhile also receive the frozen time.
         """
-        seconds = (datetime.now() - datetime.combine(date.today(), datetime.min.time())).total_seconds() 
-        return int(1000*seconds / (timedelta(microseconds=1).total_seconds()))
+        # Unfreeze first, so that a new time is read even if the time is already frozen.
+        Util._frozen_server_time = None
+        Util._frozen_server_time = Util.get_server_time()
+
+    @staticmethod
+    def unfreeze_server_time():
+        Util._frozen_server_time = None
+
+    @staticmethod
+    def _set_server_day():
+        """Works out the perf_counter_ns times of the last and next local midnight."""
+        wall = time.time_ns()
+        counter = time.perf_counter_ns()
+        today = date.fromtimestamp(wall // 1_000_000_000)
+        # Local midnights fall on whole seconds, and are a day apart except across a change of
+        # daylight saving time.
+        midnight = int(datetime.combine(today, datetime.min.time()).timestamp()) * 1_000_000_000
+        next_midnight = int(datetime.combine(today + timedelta(days=1), datetime.min.time()).timestamp()) * 1_000_000_000
+        Util._server_day = (counter - (wall - midnight), counter + (next_midnight - wall))
+        return Util._server_day
 
     @staticmethod
     def package(package: list):
@@ -28,36 +78,16 @@ class Util():
         :returns: packaged bytes object of package.
         :raises Exception: Inbound order has invalid header.
         """
-        for i in range(len(package)):
-            if isinstance(package[i], str):
-                package[i] = bytes(package[i], encoding="ascii")
         header = package[0]
-        format_s = None
-        if header == b'O': # Place Order
-            format_s = "!cI10scII4sIIIccIcc"
-            package[7] = int(package[7]*10) # Convert decimal price to integer
-        elif header == b'U':
-            if len(package) == 14: # Order Replacecd
-                package[7] = int(package[7]*10) # Convert decimal price to integer
-                format_s = "!cQIcII4sIIcQIcI"
-            else: # Replace Order
-                package[4] = int(package[4]*10) # Convert decimal price to integer
-                format_s = "!cIIIIIcI"
-        elif header == b'X': # Cancel Order
-            format_s = "!cII"
-        elif header == b"S": # Server event
-            format_s = "!cQc" 
-        elif header == b"J": # Order rejected
-            format_s = "!cQIc"
-        elif header == b'A': # Order Accepted
-            format_s = "!cQI10scII4sIIIccQIccc"
-        elif header == b'C': # Order Cancelled
-            format_s = "!cQIIc"
+        if isinstance(header, str):
+            header = bytes(header, encoding="ascii")
+        if header == b'U': # Order Replaced has 14 fields, Replace Order has 8
+            codec = codecs.ORDER_REPLACED if len(package) == 14 else codecs.REPLACE_ORDER
         else:
-            raise Exception(f"Unsupported message type '{header}'")
-        package = tuple(package) 
-
-        return struct.pack(format_s, *package)
+            codec = Util.PACKAGE_CODECS.get(header)
+            if codec is None:
+                raise Exception(f"Unsupported message type '{header}'")
+        return codec.pack(package)
 
     @staticmethod
     def unpackage(header: bytes, body: bytes) -> dict:
@@ -69,188 +99,18 @@ class Util():
         :returns: Dictionary with fields formatted according to the OUCH protocol.
         :raises Exception: Header is an invalid byte.
         """
-        
-        message_dict = None 
-        if header == b'O': # Place Order
-            message_dict = Util._unpackage_enter_order(body)
-        elif header == b'U':
-            if len(body) == 25: # Replace Order
-                message_dict = Util._unpackage_replace_order(body)
-            elif len(body) == 51: # Order Replaced
-                message_dict = Util._unpackage_replace_message(body)
+        if header == b'U':
+            if len(body) == codecs.REPLACE_ORDER.body_size: # Replace Order
+                codec = codecs.REPLACE_ORDER
+            elif len(body) == codecs.ORDER_REPLACED.body_size: # Order Replaced
+                codec = codecs.ORDER_REPLACED
             else:
                 raise Exception(f"Unsupported replace order length {len(body)}")
-        elif header == b'X': # Cancel Order
-            message_dict = Util._unpackage_cancel_order(body)
-        elif header == b'S': # System Event
-            message_dict = Util._unpackage_system_message(body)
-        elif header == b'J': # Order Rejected
-            message_dict = Util._unpackage_order_rejected(body)
-        elif header == b'A': # Order Accepted
-            message_dict = Util._unpackage_order_accepted(body)
-        elif header == b'C': # Order Cancelled
-            message_dict = Util._unpackage_order_cancelled(body)
         else:
-            raise Exception(f"Unsupported message type '{header}'")
-
-        return message_dict
-
-    @staticmethod
-    def _unpackage_enter_order(body: bytes):
-        """Unpackages an enter order. For internal use only."""
-        names = (
-            "message_type",
-            "order_token",
-            "client_reference",
-            "buy_sell_indicator",
-            "quantity",
-            "orderbook_id",
-            "group",
-            "price",
-            "time_in_force",
-            "firm_id",
-            "display",
-            "capacity",
-            "minimum_quantity",
-            "order_classification",
-            "cash_margin_type"
-        )
-        format_s = "!I10scII4sIIIccIcc"
-        msg_dict = Util._unpackage(names, body, format_s, 'O')
-        return msg_dict
-
-    @staticmethod
-    def _unpackage_replace_order(body: bytes):
-        """Unpackages a replace order. For internal use only."""
-        names = (
-            "message_type",
-            "existing_order_token",
-            "replacement_order_token",
-            "quantity",
-            "price",
-            "time_in_force",
-            "display",
-            "minimum_quantity"
-        )
-        format_s = "!IIIiIcI"
-        msg_dict = Util._unpackage(names, body, format_s, 'U')
-        return msg_dict 
-
-    @staticmethod
-    def _unpackage_cancel_order(body: bytes):
-        """Unpackages a cancel order. For internal use only."""
-        names = (
-            "message_type",
-            "order_token",
-            "quantity"
-        )
-        format_s = "!II"
-        msg_dict = Util._unpackage(names, body, format_s, 'X')
-        return msg_dict
-
-    @staticmethod
-    def _unpackage_replace_message(body: bytes):
-        names = (
-            "message_type",
-            "timestamp",
-            "replacement_order_token",
-            "buy_sell_indicator",
-            "quantity",
-            "orderbook_id",
-            "group",
-            "price",
-            "time_in_force",
-            "display",
-            "order_number",
-            "minimum_quantity",
-            "order_state",
-            "previous_order_token"
-        )
-        format_s = "!QIcII4sIIcQIcI"
-        msg_dict = Util._unpackage(names, body, format_s, 'U')
-        return msg_dict
-    
-    @staticmethod
-    def _unpackage_system_message(body: bytes):
-        names = (
-            "message_type",
-            "timestamp",
-            "system_event"
-        )
-        format_s = "!Qc"
-        msg_dict = Util._unpackage(names, body, format_s, 'S')
-        return msg_dict
-
-    @staticmethod
-    def _unpackage_order_rejected(body: bytes):
-        names = (
-            "message_type",
-            "timestamp",
-            "order_token",
-            "order_rejected_reason"
-        )
-        format_s = "!QIc"
-        msg_dict = Util._unpackage(names, body, format_s, 'J')
-        return msg_dict
-    
-    @staticmethod
-    def _unpackage_order_accepted(body: bytes):
-        names = (
-            "message_type",
-            "timestamp",
-            "order_token",
-            "client_reference",
-            "buy_sell_indicator",
-            "quantity",
-            "orderbook_id",
-            "group",
-            "price",
-            "time_in_force",
-            "firm_id",
-            "display",
-            "capacity",
-            "order_number",
-            "minimum_quantity",
-            "order_state",
-            "order_classification",
-            "cash_margin_type"
-        )
-        format_s = "!QI10scII4sIIIccQIccc"
-        msg_dict = Util._unpackage(names, body, format_s, 'A')
-        return msg_dict
-
-    @staticmethod
-    def _unpackage_order_cancelled(body: bytes):
-        names = (
-            "message_type",
-            "timestamp",
-            "order_token",
-            "decrement_quantity",
-            "order_cancelled_reason"
-        )
-        format_s = "!QIIc"
-        msg_dict = Util._unpackage(names, body, format_s, 'C')
-        return msg_dict
-
-    @staticmethod
-    def _unpackage(names: tuple, body: bytes, format_s: str, prefix=None):
-        """General method for unpackaging orders"""
-        fields = struct.unpack(format_s, body)
-
-        if prefix != None and isinstance(prefix, str):
-            fields = (prefix, ) + fields
-        msg_dict = dict(zip(names, fields))
-
-        if "price" in msg_dict.keys():
-            msg_dict["price"] = msg_dict["price"]/10
-
-        for key in msg_dict.keys():
-            if isinstance(msg_dict[key], bytes):
-                msg_dict[key] = msg_dict[key].decode("ascii").strip()
-            if msg_dict[key] == "":
-                msg_dict[key] = " "
-        
-        return msg_dict
+            codec = Util.PACKAGE_CODECS.get(header)
+            if codec is None:
+                raise Exception(f"Unsupported message type '{header}'")
+        return codec.unpack(body)
     
     @staticmethod
     def unsigned_int(n: int):
@@ -263,4 +123,31 @@ class Util():
         config.read("config.ini")
         host = config['DEFAULT']['host']
         port = int(config['DEFAULT']['port'])
-        return host, port
\ No newline at end of file
+        return host, port
+
+    @staticmethod
+    def get_market_data_addr() -> dict:
+        """
+        Get the market data feed addresses defined in the config file.
+
+        :returns: {"group": multicast group, "interface": address of the interface to publish on,
+            "port": incremental feed port, "snapshot_port": snapshot feed port,
+            "recovery_port": retransmission request port}
+        """
+        config = configparser.ConfigParser()
+        config.read("config.ini")
+        section = config["MARKET_DATA"]
+        return {
+            "group": section["group"],
+            "interface": section["interface"],
+            "port": int(section["port"]),
+            "snapshot_port": int(section["snapshot_port"]),
+            "recovery_port": int(section["recovery_port"])
+        }
+
+    @staticmethod
+    def get_gateway_path() -> str:
+        """Get the path of the shared memory gateway's control socket defined in the config file."""
+        config = configparser.ConfigParser()
+        config.read("config.ini")
+        return config["SHM_GATEWAY"]["path"]